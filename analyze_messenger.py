@@ -17,6 +17,9 @@ from datetime import timedelta
 # for the names to id conversion
 import setup
 
+import csv_export
+import instrumentation
+
 class MessengerParser(HTMLParser):
 
     # the current thread dictionary
@@ -79,27 +82,46 @@ class MessengerParser(HTMLParser):
             threads.append(self.current_thread)
             self.current_thread = None
            
+# print the stage measurements as json if debugging, or write them to setup.stage_report if it is set
+def write_stage_report():
+    filename = getattr(setup, "stage_report", None)
+    if filename != None or setup.debug:
+        instrumentation.write_report(filename)
+
 def main(messages_url):
+    # measure every stage, see instrumentation.py
+    instrumentation.reset()
+    instrumentation.trace_memory = getattr(setup, "trace_memory", False)
+
     messengerParser = MessengerParser()
     messengerParser.convert_charrefs = True
 
-    with open(messages_url, "r") as messages_file:
-        messengerParser.feed(messages_file.read())
+    with instrumentation.stage("parse"):
+        with open(messages_url, "r") as messages_file:
+            messengerParser.feed(messages_file.read())
+        instrumentation.message_count = sum(len(thread["messages"]) for thread in threads)
 
     # group threads that are split due to too many messages
-    group_threads()
+    with instrumentation.stage("group_threads"):
+        group_threads()
 
     # sort the messages
-    sort_messages()
+    with instrumentation.stage("sort_messages"):
+        sort_messages()
 
     # create convos
-    create_convos()
+    with instrumentation.stage("create_conversations"):
+        create_convos()
 
     # meta data rules
-    calculate_meta_data()
+    with instrumentation.stage("calculate_meta_data"):
+        calculate_meta_data()
 
     # time interval data for neat graphs
-    generate_time_interval_data()
+    with instrumentation.stage("generate_time_interval_data"):
+        generate_time_interval_data()
+
+    write_stage_report()
 
 
 
@@ -359,54 +381,14 @@ def add_months(sourcedate,months):
 
 # interval parameter can be "daily", "weekly" or "monthly" or "yearly"
 # thread is indexed
+# the rows are streamed to f (or stdout) one at a time, see csv_export.py
 def csv_export_interval_data(thread, interval, data, f = None):
-    # export dict
-    export_dict = threads[thread]["time_data"][interval]
-
-    start_date = threads[thread]["messages"][0]["date"].date()
-    end_date = threads[thread]["messages"][len(threads[thread]["messages"])-1]["date"].date()
+    csv_export.export_interval_data(threads[thread], interval, data, f)
 
-    if interval == "daily":
-        s = "Date"
-        for data_point in export_dict[start_date][data]:
-            s += "," + str(data_point)
-        s += "\n"
 
-        date_count = (end_date - start_date).days + 1
-        for n in range(date_count):
-            d = start_date + timedelta(days = n)
-            s += str(d)
-            for data_point in export_dict[d][data]:
-                s += "," + str(export_dict[d][data][data_point])
-            s += "\n"
-
-        if f == None:
-            print(s)
-        else:
-            # print to file
-            with open(f, "w") as fi:
-                fi.write(s)
-    elif interval == "monthly":
-        month_start = start_date.replace(day = 1)
-        s = "Date"
-        for data_point in export_dict[month_start][data]:
-            s += "," + str(data_point)
-        s += "\n"
-
-        month_count = diff_month(end_date, start_date) + 1
-        for n in range(month_count):
-            d = add_months(month_start, n)
-            s += str(d)
-            for data_point in export_dict[d][data]:
-                s += "," + str(export_dict[d][data][data_point])
-            s += "\n"
-
-        if f == None:
-            print(s)
-        else:
-            # print to file
-            with open(f, "w") as fi:
-                fi.write(s)
+# export every data key of every thread, for all intervals, as one csv file per interval in directory
+def csv_export_all_interval_data(directory, intervals = csv_export.intervals):
+    return csv_export.export_all_interval_data(threads, directory, intervals)
 
 
 
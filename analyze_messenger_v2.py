@@ -13,11 +13,17 @@ threads = []
 from html.parser import HTMLParser
 from datetime import datetime
 from datetime import timedelta
+from array import array
 import os
 
 # for the names to id conversion
 import setup
 
+import csv_export
+import read_ahead
+import export_archive
+import instrumentation
+
 class MessengerParser(HTMLParser):
 
     # the current thread dictionary
@@ -97,8 +103,7 @@ class MessengerParser(HTMLParser):
                     return
                 self.current_thread["messages"][self.n_messages - 1]["content"] = data
             elif self.next_content == "reactions":
-                # for now, have simplistic format
-                self.current_thread["messages"][self.n_messages -1]["reactions"].append(data)
+                self.current_thread["messages"][self.n_messages -1]["reactions"].append(parse_reaction(data))
 
 
     def handle_endtag(self, tag):
@@ -113,40 +118,130 @@ class MessengerParser(HTMLParser):
             threads.append(self.current_thread)
             self.current_thread = None
 
+# a reaction is written as the emoji followed by the name of who reacted, like "😍Anna Andersson"
+# returns a dictionary with "reaction" and "actor", like the reactions in the json export
+def parse_reaction(data):
+    i = 0
+    # the emoji is everything before the first letter of the name (emoji can be several code points)
+    while i < len(data) and not data[i].isalnum():
+        i += 1
+    name = data[i:].strip()
+    if name in setup.names_per_id:
+        name = setup.names_per_id[name]
+    return {"reaction": data[:i].strip(), "actor": name}
+
 def debug_log(s):
     if setup.debug:
         print(s)
            
-def main(messages_directory):
+# progress reporting while parsing the files, see instrumentation.py
+# setup.progress_bar shows a progress bar, and setup.metrics_file appends the progress as json lines to that file
+# total_bytes and total_threads can be given instead, for threads that are not read from files
+def ingestion_progress(filenames, total_bytes = None, total_threads = None):
+    sinks = []
+    if getattr(setup, "progress_bar", False):
+        sinks.append(instrumentation.ProgressBar())
+    if getattr(setup, "metrics_file", None) != None:
+        sinks.append(instrumentation.MetricsFile(setup.metrics_file))
+    if total_bytes == None:
+        total_bytes = sum(os.path.getsize(filename) for filename in filenames)
+    if total_threads == None:
+        total_threads = len(filenames)
+    return instrumentation.Progress(total_threads, total_bytes, sinks)
+
+# print the stage measurements as json if debugging, or write them to setup.stage_report if it is set
+def write_stage_report():
+    filename = getattr(setup, "stage_report", None)
+    if filename != None or setup.debug:
+        instrumentation.write_report(filename)
+
+def parse_directory(messages_directory):
     messengerParser = MessengerParser()
     messengerParser.convert_charrefs = True
 
-    # open each file in the designated directory
-    for filename in os.listdir(messages_directory):
-        # only read html files
-        if not filename.endswith(".html"):
-            continue
+    # only read html files
+    entries = [entry for entry in os.scandir(messages_directory) if entry.name.endswith(".html")]
+    progress = ingestion_progress([entry.path for entry in entries])
+    # the next files are read ahead by a pool of I/O threads while one is parsed, see read_ahead.py
+    contents = read_ahead.read_files([entry.path for entry in entries],
+                                     getattr(setup, "read_ahead", read_ahead.default_depth),
+                                     getattr(setup, "io_threads", read_ahead.default_threads), "r")
+    for entry, (path, data) in zip(entries, contents):
         # read each thread and add it
-        with open(messages_directory + "/" + filename, "r") as messages_file:
-            print(filename)
-            messengerParser.feed(messages_file.read())
+        debug_log(entry.name)
+        thread_count = len(threads)
+        messengerParser.feed(data)
+        progress.update(threads = len(threads) - thread_count,
+                        messages = sum(len(thread["messages"]) for thread in threads[thread_count:]),
+                        bytes_read = entry.stat().st_size)
+    progress.finish()
+
+
+# read the .html files straight from the zip archives of an export, without extracting them (see export_archive.py)
+# the files are decompressed and parsed in a pool of setup.loader_processes processes (all cores if it is None)
+def load_archives(paths):
+    global threads
+    members = export_archive.html_members(paths)
+    progress = ingestion_progress([], sum(m["compressed_size"] for m in members), len(members))
+    for m, parsed in zip(members, export_archive.parallel_map(parse_archive_member, members, getattr(setup, "loader_processes", None))):
+        debug_log(m["name"])
+        for thread in parsed:
+            thread["index"] = len(threads)
+            threads.append(thread)
+        progress.update(threads = len(parsed),
+                        messages = sum(len(thread["messages"]) for thread in parsed),
+                        bytes_read = m["compressed_size"])
+    progress.finish()
+
+
+# parse one .html member of an archive, and return the threads in it
+# runs in the processes of load_archives, where the parser adds the threads to that process' own threads list
+def parse_archive_member(m):
+    parser = MessengerParser()
+    parser.convert_charrefs = True
+    thread_count = len(threads)
+    parser.feed(export_archive.read_member(m).decode("utf-8"))
+    parsed = threads[thread_count:]
+    del threads[thread_count:]
+    return parsed
+
+
+def main(messages_directory):
+    # measure every stage, see instrumentation.py
+    instrumentation.reset()
+    instrumentation.trace_memory = getattr(setup, "trace_memory", False)
+
+    # open each file in the designated directory, or read them from the zip archives of the export
+    with instrumentation.stage("parse"):
+        if export_archive.is_archive(messages_directory):
+            load_archives(export_archive.archive_paths(messages_directory))
+        else:
+            parse_directory(messages_directory)
+        instrumentation.message_count = sum(len(thread["messages"]) for thread in threads)
 
     # group threads that are split due to too many messages
     #group_threads()
 
     # sort the messages
-    sort_messages()
+    with instrumentation.stage("sort_messages"):
+        sort_messages()
 
     # create conversations
-    create_conversations()
+    with instrumentation.stage("create_conversations"):
+        create_conversations()
 
     # meta data rules
-    calculate_meta_data()
+    with instrumentation.stage("calculate_meta_data"):
+        calculate_meta_data()
 
     # time interval data for neat graphs
-    generate_time_interval_data()
+    with instrumentation.stage("generate_time_interval_data"):
+        generate_time_interval_data()
 
-    generate_global_time_data()
+    with instrumentation.stage("generate_global_time_data"):
+        generate_global_time_data()
+
+    write_stage_report()
 
 
     # temporary
@@ -196,9 +291,38 @@ def group_threads():
 
 
 
+# interned member and reaction identities, for the reaction table
+# member_ids maps a name to its id and member_names maps an id back to the name, and the same for the reactions
+member_ids = {}
+member_names = []
+reaction_ids = {}
+reaction_names = []
+
+def member_id(name):
+    if name not in member_ids:
+        member_ids[name] = len(member_names)
+        member_names.append(name)
+    return member_ids[name]
+
+def reaction_id(reaction):
+    if reaction not in reaction_ids:
+        reaction_ids[reaction] = len(reaction_names)
+        reaction_names.append(reaction)
+    return reaction_ids[reaction]
+
+
+# one entry per reaction, as compact arrays, collected by calculate_meta_data while it goes through the messages
+# "thread" is the thread index and "message" the index of the message in the (sorted) thread, "actor" is the member id
+# of who reacted and "receiver" of who sent the message, "reaction" is the reaction id (see reaction_id),
+# and "month" is the month the message was sent, as months since January 1970
+reaction_columns = None
+
 def calculate_meta_data():
     # calculating extra data, such as number of messages per person, number of words per person, and so forth
     global threads
+    global reaction_columns
+    reaction_columns = {"thread": array("i"), "message": array("i"), "actor": array("i"), "receiver": array("i"),
+                        "reaction": array("i"), "month": array("i")}
     for thread in threads:
 
         # relevant data lists
@@ -216,6 +340,8 @@ def calculate_meta_data():
         mobbade_conversations_per_member = {}
         top_words_per_member = {}
         all_words_per_member_count = {}
+        reactions_given_per_member = {}
+        reactions_received_per_member = {}
 
         # initialize all to zero
         for member in members:
@@ -226,11 +352,27 @@ def calculate_meta_data():
             mobbade_conversations_per_member[member] = 0
             top_words_per_member[member] = []
             all_words_per_member_count[member] = {}
+            reactions_given_per_member[member] = 0
+            reactions_received_per_member[member] = 0
 
         skip_words = {"det", "är", "jag", "att", "inte", "på", "vi", "du", "har", "man", "och", "eller", "så", "i"}
 
         # iterate over each message, and update the relevant metrics
-        for message in messages:
+        for i, message in enumerate(messages):
+            if len(message["reactions"]) > 0:
+                receiver = member_id(message["sender"])
+                month = (message["date"].year - 1970) * 12 + message["date"].month - 1
+                for reaction in message["reactions"]:
+                    reaction_columns["thread"].append(thread["index"])
+                    reaction_columns["message"].append(i)
+                    reaction_columns["actor"].append(member_id(reaction["actor"]))
+                    reaction_columns["receiver"].append(receiver)
+                    reaction_columns["reaction"].append(reaction_id(reaction["reaction"]))
+                    reaction_columns["month"].append(month)
+                    if reaction["actor"] in members:
+                        reactions_given_per_member[reaction["actor"]] += 1
+                    if message["sender"] in members:
+                        reactions_received_per_member[message["sender"]] += 1
             if message["sender"] in members:
                 messages_per_member[message["sender"]] += 1
                 words_per_member[message["sender"]] += len(message["content"].split())
@@ -280,11 +422,43 @@ def calculate_meta_data():
         meta["conversations_ended_per_member"] = conversations_ended_per_member
         meta["mobbade_conversations_per_member"] = mobbade_conversations_per_member
         meta["top_words_per_member"] = top_words_per_member
+        meta["reactions_given_per_member"] = reactions_given_per_member
+        meta["reactions_received_per_member"] = reactions_received_per_member
         
 
         # finally, add the meta data to the thread dictionary
         thread["meta_data"] = meta
 
+
+# reactions given and received, per member, per thread and member, per month and member and per reaction,
+# from the reaction table of calculate_meta_data
+# returns a dictionary of numpy arrays. the member axis is indexed by member id, the thread axis by thread index,
+# and the month axis by the months from "first_month" (a numpy month) on.
+def reaction_statistics():
+    import numpy as np
+    columns = {name: np.frombuffer(column, dtype=np.int32).astype(np.int64) for name, column in reaction_columns.items()}
+    member_count = len(member_names)
+    thread_count = len(threads)
+
+    actor = columns["actor"]
+    receiver = columns["receiver"]
+    thread = columns["thread"]
+    months = columns["month"]
+    first_month = months.min() if len(months) > 0 else 0
+    month_count = int(months.max() - first_month) + 1 if len(months) > 0 else 0
+    month_rows = months - first_month
+
+    statistics = {}
+    statistics["given"] = np.bincount(actor, minlength=member_count)
+    statistics["received"] = np.bincount(receiver, minlength=member_count)
+    statistics["given_per_thread"] = np.bincount(thread * member_count + actor, minlength=thread_count * member_count).reshape(thread_count, member_count)
+    statistics["received_per_thread"] = np.bincount(thread * member_count + receiver, minlength=thread_count * member_count).reshape(thread_count, member_count)
+    statistics["given_per_month"] = np.bincount(month_rows * member_count + actor, minlength=month_count * member_count).reshape(month_count, member_count)
+    statistics["received_per_month"] = np.bincount(month_rows * member_count + receiver, minlength=month_count * member_count).reshape(month_count, member_count)
+    statistics["per_reaction"] = np.bincount(columns["reaction"], minlength=len(reaction_names))
+    statistics["first_month"] = np.datetime64(int(first_month), "M")
+    return statistics
+
         
 
 def generate_time_interval_data():
@@ -470,11 +644,10 @@ def add_months(sourcedate,months):
 
 
 # plot using pyplot
-from matplotlib import pyplot as plt
-from matplotlib import dates as pltdates
 # times is list of datetimes. series is list of dicts containing "label" string and "datapoints" list.
 def plot_time_data(times, series, stackplot=True):
-    #dates = pltdates.date2num(times)
+    # matplotlib takes most of a second to import, so it is only imported when something is plotted
+    from matplotlib import pyplot as plt
     if not stackplot:
         for sery in series:
             plt.plot(times,sery["datapoints"],label=sery["label"],linestyle="-",marker="")
@@ -553,54 +726,14 @@ def show_arvid_per_thread(worm, threshold=1000, movingaverage=50):
 
 # interval parameter can be "daily", "weekly" or "monthly" or "yearly"
 # thread is indexed
+# the rows are streamed to f (or stdout) one at a time, see csv_export.py
 def csv_export_interval_data(thread, interval, data, f = None):
-    # export dict
-    export_dict = threads[thread]["time_data"][interval]
+    csv_export.export_interval_data(threads[thread], interval, data, f)
 
-    start_date = threads[thread]["messages"][0]["date"].date()
-    end_date = threads[thread]["messages"][len(threads[thread]["messages"])-1]["date"].date()
-
-    if interval == "daily":
-        s = "Date"
-        for data_point in export_dict[start_date][data]:
-            s += "," + str(data_point)
-        s += "\n"
-
-        date_count = (end_date - start_date).days + 1
-        for n in range(date_count):
-            d = start_date + timedelta(days = n)
-            s += str(d)
-            for data_point in export_dict[d][data]:
-                s += "," + str(export_dict[d][data][data_point])
-            s += "\n"
-
-        if f == None:
-            print(s)
-        else:
-            # print to file
-            with open(f, "w") as fi:
-                fi.write(s)
-    elif interval == "monthly":
-        month_start = start_date.replace(day = 1)
-        s = "Date"
-        for data_point in export_dict[month_start][data]:
-            s += "," + str(data_point)
-        s += "\n"
 
-        month_count = diff_month(end_date, start_date) + 1
-        for n in range(month_count):
-            d = add_months(month_start, n)
-            s += str(d)
-            for data_point in export_dict[d][data]:
-                s += "," + str(export_dict[d][data][data_point])
-            s += "\n"
-
-        if f == None:
-            print(s)
-        else:
-            # print to file
-            with open(f, "w") as fi:
-                fi.write(s)
+# export every data key of every thread, for all intervals, as one csv file per interval in directory
+def csv_export_all_interval_data(directory, intervals = csv_export.intervals):
+    return csv_export.export_all_interval_data(threads, directory, intervals)
 
 
 
@@ -698,4 +831,8 @@ def print_threads():
 
 import sys
 if __name__ == "__main__":
-    main(sys.argv[1]) 
+    if len(sys.argv) > 2:
+        # the zip archives of a split export
+        main(sys.argv[1:])
+    else:
+        main(sys.argv[1])
@@ -15,86 +15,488 @@ from datetime import datetime
 from datetime import timedelta
 import os
 import random
-import ftfy
+import heapq
+from collections import OrderedDict
+from collections.abc import Mapping
+from array import array
+from bisect import bisect_left
 
 # for the names to id conversion
 import setup
 
+import csv_export
+import read_ahead
+import export_archive
+import interval_tree
+import instrumentation
+import columnar_export
+import content_buffer
+import message_database
+import sketches
+import spill
+from word_index import WordIndex
+from word_index import terms as word_terms
+
 def debug_log(s):
     if setup.debug:
         print(s)
 
-def load_data(messages_directory):
-    for threadname in os.listdir(messages_directory):
-        if threadname.startswith('.'):
+# if database is the filename of an sqlite database, every thread is also stored there (see message_database.py)
+# threads whose file has not changed since they were stored are not written again
+# if lazy is True, only the metadata of each thread is loaded now, and the messages when they are needed (see LazyThread)
+# messages_directory can also be the path of a zip archive of the export, or a list of them (see load_archives)
+def load_data(messages_directory, database = None, lazy = False):
+    invalidate_derived_data()
+    if export_archive.is_archive(messages_directory):
+        load_archives(export_archive.archive_paths(messages_directory), database)
+        return
+    conn = None
+    if database != None:
+        conn = message_database.connect(database)
+    threadnames, filenames = thread_files(messages_directory)
+    progress = ingestion_progress(filenames)
+    global threads
+    stats = [os.stat(filename) for filename in filenames]
+    stored = [conn != None and message_database.is_stored(conn, threadname, stat.st_size, stat.st_mtime)
+              for threadname, stat in zip(threadnames, stats)]
+    # the files that have to be read are read ahead by a pool of I/O threads, while the ones before them are parsed
+    # (see read_ahead.py). at most setup.read_ahead files are in memory at once.
+    contents = read_ahead.read_files([filename for filename, is_stored in zip(filenames, stored) if not (lazy and is_stored)],
+                                     getattr(setup, "read_ahead", read_ahead.default_depth),
+                                     getattr(setup, "io_threads", read_ahead.default_threads))
+    for threadname, filename, stat, is_stored in zip(threadnames, filenames, stats, stored):
+        if lazy and is_stored:
+            # the database already knows everything about the thread that a lazy thread needs up front
+            threaddict = LazyThread(filename, message_database.thread_metadata(conn, threadname))
+        elif lazy and conn == None:
+            threaddict = LazyThread(filename, scan_thread(filename, next(contents)[1]))
+        else:
+            threaddict = read_thread(filename, next(contents)[1])
+            # upsert into the database
+            if conn != None and not is_stored:
+                debug_log("storing " + threadname + " in the database")
+                message_database.store_thread(conn, threadname, threaddict, stat.st_size, stat.st_mtime)
+            if lazy:
+                threaddict = LazyThread(filename, thread_metadata(threaddict))
+        threaddict['path'] = threadname
+        # add index
+        threaddict['index'] = len(threads)
+        threads.append(threaddict)
+        progress.update(messages = threaddict['message_count'], bytes_read = stat.st_size)
+    progress.finish()
+    if conn != None:
+        conn.close()
+
+
+# the names of the thread directories in an export directory, and the message.json files in them
+def thread_files(messages_directory):
+    threadnames = []
+    for entry in os.scandir(messages_directory):
+        if entry.name.startswith('.'):
             continue
-        if threadname == 'stickers_used':
+        if entry.name == 'stickers_used':
             continue
-        # the messages are stored in the "message.json" file in the threadname directory
-        # we want to load those json dictionaries, put them in the threads list, and do some data conversion
-        filename = os.path.join(messages_directory, threadname, "message.json")
-        threaddict = {}
-        with open(filename) as f:
-            threaddict = json.load(f)
-        # alter every message a bit
-        for message in threaddict['messages']:
-            # now convert the timestamp into a real datetime object
-            message['date'] = datetime.fromtimestamp(message['timestamp'])
-            # for consistency, change sender_name to sender
-            message['sender'] = message['sender_name']
-            if 'content' not in message:
-                message['content'] = ''
-            message['content'] = ftfy.ftfy(message['content'])
-            message['sender'] = ftfy.ftfy(message['sender'])
-        # for consistency, copy participants to members
-        threaddict['members'] = []
-        if 'participants' in threaddict:
-            for participant in threaddict['participants']:
-                threaddict['members'].append(ftfy.ftfy(participant))
-        threaddict['title'] = ftfy.ftfy(threaddict['title'])
-        threaddict['members'].append(setup.user)
-        # add index
-        global threads
+        # the directory entry already tells if it is a directory, without another stat
+        if not entry.is_dir():
+            continue
+        threadnames.append(entry.name)
+    # the messages are stored in the "message.json" file in the threadname directory
+    return threadnames, [os.path.join(messages_directory, threadname, "message.json") for threadname in threadnames]
+
+
+# fix the mojibake that facebook writes non-ascii text as
+# ftfy is slow to import, so it is only imported when the first text is fixed
+def fix_text(s):
+    import ftfy
+    return ftfy.ftfy(s)
+
+
+# read the threads straight from the zip archives of an export, without extracting them (see export_archive.py)
+# the files are decompressed and parsed in a pool of setup.loader_processes processes (all cores if it is None)
+# the threads are always loaded with their messages, since a lazy thread needs a file to read them from later
+def load_archives(paths, database = None):
+    global threads
+    conn = None
+    if database != None:
+        conn = message_database.connect(database)
+    archive_threads = export_archive.json_threads(paths)
+    progress = ingestion_progress([], sum(m["compressed_size"] for members in archive_threads.values() for m in members), len(archive_threads))
+    threadnames = list(archive_threads)
+    read = export_archive.parallel_map(read_archive_thread, [archive_threads[threadname] for threadname in threadnames],
+                                       getattr(setup, "loader_processes", None))
+    for threadname, threaddict in zip(threadnames, read):
+        members = archive_threads[threadname]
+        size = sum(m["size"] for m in members)
+        mtime = max(m["mtime"] for m in members)
+        if conn != None and not message_database.is_stored(conn, threadname, size, mtime):
+            debug_log("storing " + threadname + " in the database")
+            message_database.store_thread(conn, threadname, threaddict, size, mtime)
+        threaddict['path'] = threadname
+        threaddict['index'] = len(threads)
+        threads.append(threaddict)
+        progress.update(messages = threaddict['message_count'], bytes_read = sum(m["compressed_size"] for m in members))
+    progress.finish()
+    if conn != None:
+        conn.close()
+
+
+# read the message*.json members of one thread from the archives, and return the thread dictionary
+# runs in the processes of load_archives
+def read_archive_thread(members):
+    return thread_from_json([json.loads(export_archive.read_member(m)) for m in members])
+
+
+# read a message.json file, and return the thread dictionary
+# data is the contents of the file, if it has already been read
+def read_thread(filename, data = None):
+    if data == None:
+        with open(filename, "rb") as f:
+            data = f.read()
+    return thread_from_json([json.loads(data)])
+
+
+# the thread dictionary of the json of a thread, which may be split over several files (message_1.json, message_2.json, ...)
+def thread_from_json(jsons):
+    # we want to load those json dictionaries, put them in the threads list, and do some data conversion
+    threaddict = Thread(jsons[0])
+    for other in jsons[1:]:
+        threaddict['messages'].extend(other['messages'])
+    # alter every message a bit
+    for message in threaddict['messages']:
+        # now convert the timestamp into a real datetime object
+        message['date'] = datetime.fromtimestamp(message['timestamp'])
+        # for consistency, change sender_name to sender
+        message['sender'] = message['sender_name']
+        if 'content' not in message:
+            message['content'] = ''
+        message['content'] = fix_text(message['content'])
+        message['sender'] = fix_text(message['sender'])
+        # the reactions are a list of dictionaries with "reaction" (an emoji) and "actor" (who reacted)
+        message['reactions'] = [{"reaction": fix_text(reaction['reaction']), "actor": fix_text(reaction['actor'])}
+                                for reaction in message.get('reactions', [])]
+    # for consistency, copy participants to members
+    threaddict['members'] = thread_members(threaddict)
+    threaddict['title'] = fix_text(threaddict['title'])
+    threaddict.update(message_summary(threaddict['messages']))
+    return threaddict
+
+
+def thread_members(threaddict):
+    members = []
+    if 'participants' in threaddict:
+        for participant in threaddict['participants']:
+            members.append(fix_text(participant))
+    members.append(setup.user)
+    return members
+
+
+# number of messages, and the timestamps of the first and the last message
+def message_summary(messages):
+    timestamps = [message['timestamp'] for message in messages]
+    return {'message_count': len(timestamps),
+            'first_timestamp': min(timestamps) if len(timestamps) > 0 else None,
+            'last_timestamp': max(timestamps) if len(timestamps) > 0 else None}
+
+
+# the keys of a thread dictionary that are known without its messages
+metadata_keys = ['title', 'members', 'message_count', 'first_timestamp', 'last_timestamp']
+
+def thread_metadata(threaddict):
+    return {key: threaddict[key] for key in metadata_keys}
+
+
+# read only the metadata of a message.json file
+# the messages are not decoded or converted at all, which is what takes time when reading a thread
+def scan_thread(filename, data = None):
+    if data == None:
+        with open(filename, "rb") as f:
+            data = f.read()
+    threaddict = json.loads(data)
+    metadata = message_summary(threaddict['messages'])
+    metadata['members'] = thread_members(threaddict)
+    metadata['title'] = fix_text(threaddict['title'])
+    return metadata
+
+
+# A thread dictionary, with an index of the dates of its messages for finding the messages in a window of time
+# The index is built the first time it is needed, and must be rebuilt when the messages are changed or sorted.
+class Thread(dict):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dates = None
+
+    def invalidate_date_index(self):
+        self.dates = None
+
+    # the sorted dates of the messages, which must be sorted (see sort_messages)
+    def date_index(self):
+        messages = self["messages"]
+        if self.dates is None or len(self.dates) != len(messages):
+            self.dates = [message["date"] for message in messages]
+        return self.dates
+
+    # the messages from start up to, but not including, end. start and end are dates or datetimes, or None for no limit.
+    def between(self, start = None, end = None):
+        dates = self.date_index()
+        first = 0 if start is None else bisect_left(dates, as_datetime(start))
+        last = len(dates) if end is None else bisect_left(dates, as_datetime(end))
+        return self["messages"][first:last]
+
+    # the dates of the first and the last message, known without the messages, or None if there are no messages
+    def span(self):
+        if self["message_count"] == 0:
+            return None
+        return datetime.fromtimestamp(self["first_timestamp"]).date(), datetime.fromtimestamp(self["last_timestamp"]).date()
+
+
+def as_datetime(d):
+    if isinstance(d, datetime):
+        return d
+    return datetime(d.year, d.month, d.day)
+
+
+# the lazy threads that currently have their messages loaded, least recently used first
+resident_threads = OrderedDict()
+
+# A thread whose messages are read from its file the first time they are used
+# Until then, only the metadata (title, members, message count and first and last timestamp) is in memory.
+# "conversations", "meta_data" and "time_data" are also computed for the thread the first time they are used.
+# At most setup.max_resident_threads lazy threads keep their messages, the least recently used ones are unloaded.
+class LazyThread(Thread):
+
+    # the keys that need the messages
+    lazy_keys = {"messages", "conversations", "meta_data", "time_data"}
+
+    def __init__(self, filename, metadata):
+        super().__init__(metadata)
+        self.filename = filename
+
+    def __getitem__(self, key):
+        if key == "messages" or key == "conversations":
+            make_resident(self)
+        return super().__getitem__(key)
+
+    def __missing__(self, key):
+        if key == "messages":
+            threaddict = read_thread(self.filename)
+            # sort the messages, so that the oldest are first
+            threaddict["messages"].sort(key = lambda message: message["date"])
+            # with a content buffer open, the contents are read from there instead of being kept
+            if message_contents is not None:
+                map_messages(self["index"], threaddict["messages"])
+            self["messages"] = threaddict["messages"]
+        elif key == "conversations":
+            self["conversations"] = thread_conversations(self["messages"])
+        elif key == "meta_data":
+            self["meta_data"] = thread_meta_data(self)
+        elif key == "time_data":
+            if self.spilled():
+                if self["message_count"] == 0:
+                    raise KeyError(key)
+                # it is unloaded again with the messages, since it can be made from the spilled time data again
+                self["time_data"] = spilled_time_data.time_data(self)
+                make_resident(self)
+                return super().__getitem__(key)
+            time_data = thread_time_data(self)
+            if time_data == None:
+                raise KeyError(key)
+            self["time_data"] = time_data
+        else:
+            raise KeyError(key)
+        return super().__getitem__(key)
+
+    # the lazy keys are there before they are computed, so that "time_data" in thread is the same as for a loaded thread
+    # a thread without messages has no time data
+    def __contains__(self, key):
+        if key == "time_data":
+            return self["message_count"] > 0
+        return key in self.lazy_keys or super().__contains__(key)
+
+    def is_loaded(self):
+        return dict.__contains__(self, "messages")
+
+    def unload(self):
+        self.pop("messages", None)
+        self.pop("conversations", None)
+        if self.spilled():
+            self.pop("time_data", None)
+        self.invalidate_date_index()
+
+    # whether the time data of the thread is in spilled_time_data (see out_of_core_analysis)
+    def spilled(self):
+        return spilled_time_data is not None and spilled_time_data.has(self)
+
+
+# the threads are keyed by their identity, since the same file can be loaded more than once
+def make_resident(thread):
+    if id(thread) in resident_threads:
+        resident_threads.move_to_end(id(thread))
+        return
+    resident_threads[id(thread)] = thread
+    while len(resident_threads) > getattr(setup, "max_resident_threads", 16):
+        key, evicted = resident_threads.popitem(last = False)
+        evicted.unload()
+
+
+# unload all lazy threads, so that the threads loaded next start from an empty set of resident threads
+def unload_resident_threads():
+    while resident_threads:
+        key, thread = resident_threads.popitem()
+        thread.unload()
+
+
+# forget everything that is derived from the threads: the message columns and the indexes, histograms and caches built from them,
+# and unload the lazy threads that have their messages loaded
+# called when threads are loaded, so that nothing answers from the data that was loaded before
+# the interned member and reaction ids are kept, since they do not depend on the threads
+def invalidate_derived_data():
+    global message_columns
+    global reaction_columns
+    global range_index
+    global time_histogram
+    global thread_spans
+    global word_index
+    global message_contents
+    global spilled_time_data
+    message_columns = None
+    reaction_columns = None
+    range_index = None
+    time_histogram = None
+    thread_spans = None
+    word_index = None
+    # the messages that are already mapped keep using the old buffer, but new ones are not mapped to it
+    message_contents = None
+    plot_series_cache.clear()
+    unload_resident_threads()
+    spilled_time_data = None
+
+
+# the module globals that hold the loaded threads and what is derived from them
+# a Session (see session.py) loads its own threads with these swapped out, and puts them back afterwards
+loaded_state = ["threads", "message_columns", "reaction_columns", "range_index", "time_histogram", "thread_spans",
+                "word_index", "message_contents", "spilled_time_data"]
+
+
+# progress reporting while loading the files, see instrumentation.py
+# setup.progress_bar shows a progress bar, and setup.metrics_file appends the progress as json lines to that file
+# total_bytes and total_threads can be given instead, for threads that are not read from files
+def ingestion_progress(filenames, total_bytes = None, total_threads = None):
+    sinks = []
+    if getattr(setup, "progress_bar", False):
+        sinks.append(instrumentation.ProgressBar())
+    if getattr(setup, "metrics_file", None) != None:
+        sinks.append(instrumentation.MetricsFile(setup.metrics_file))
+    if total_bytes == None:
+        total_bytes = sum(os.path.getsize(filename) for filename in filenames)
+    if total_threads == None:
+        total_threads = len(filenames)
+    return instrumentation.Progress(total_threads, total_bytes, sinks)
+
+
+# read the threads stored in an sqlite database by load_data, instead of parsing the export again
+# if content_buffer_filename is given, the messages read their contents from that content buffer (see map_message_contents)
+# if it was already written by an earlier run for the same threads, the contents are not read from the database at all
+def load_data_from_database(database, content_buffer_filename = None):
+    global threads
+    invalidate_derived_data()
+    conn = message_database.connect(database)
+    mapped = content_buffer_filename != None and content_buffer.exists(content_buffer_filename)
+    for threaddict in message_database.load_threads(conn, contents = not mapped):
+        threaddict = Thread(threaddict)
+        threaddict.update(message_summary(threaddict['messages']))
         threaddict['index'] = len(threads)
         threads.append(threaddict)
+    conn.close()
+    # the messages are already sorted by the database
+    if mapped:
+        open_message_contents(content_buffer_filename)
+    elif content_buffer_filename != None:
+        map_message_contents(content_buffer_filename)
 
 
 
            
+# print the stage measurements as json if debugging, or write them to setup.stage_report if it is set
+def write_stage_report():
+    filename = getattr(setup, "stage_report", None)
+    if filename != None or setup.debug:
+        instrumentation.write_report(filename)
+
 def main(messages_directory):
+    # measure every stage, see instrumentation.py
+    instrumentation.reset()
+    instrumentation.trace_memory = getattr(setup, "trace_memory", False)
+
+    # with setup.out_of_core, the threads are analyzed in batches instead of all at once
+    if getattr(setup, "out_of_core", False):
+        main_out_of_core(messages_directory)
+        return
 
     # read the json files and put them in the threads list
-    load_data(messages_directory)
+    with instrumentation.stage("load_data"):
+        load_data(messages_directory, getattr(setup, "database", None))
+        instrumentation.message_count = sum(len(thread["messages"]) for thread in threads)
 
     # group threads that are split due to too many messages
     #group_threads()
 
     # sort the messages
-    sort_messages()
+    with instrumentation.stage("sort_messages"):
+        sort_messages()
+
+    # keep the message contents in a memory-mapped file instead of in memory
+    if getattr(setup, "content_buffer", None) is not None:
+        with instrumentation.stage("map_message_contents"):
+            map_message_contents(setup.content_buffer)
 
     # create conversations
-    create_conversations()
+    with instrumentation.stage("create_conversations"):
+        create_conversations()
 
     # meta data rules
-    calculate_meta_data()
+    with instrumentation.stage("calculate_meta_data"):
+        calculate_meta_data()
 
     # time interval data for neat graphs
-    generate_time_interval_data()
+    with instrumentation.stage("generate_time_interval_data"):
+        generate_time_interval_data()
+
+    with instrumentation.stage("generate_global_time_data"):
+        generate_global_time_data()
 
-    generate_global_time_data()
+    with instrumentation.stage("generate_global_member_statistics"):
+        generate_global_member_statistics()
+
+    write_stage_report()
 
 
     # temporary
-    show_arvid_per_thread("words",threshold=2000,movingaverage=80,stackplot=False)
+    show_arvid_per_thread("words",threshold=2000,movingaverage=80,stackplot=False,filename=getattr(setup, "plot_file", None))
     #show_arvid_per_thread("messages",threshold=100)
 
 
+# main, for exports whose messages do not fit in memory at once (see out_of_core_analysis)
+def main_out_of_core(messages_directory):
+    with instrumentation.stage("out_of_core_analysis"):
+        out_of_core_analysis(messages_directory)
+        instrumentation.message_count = sum(thread["message_count"] for thread in threads)
+
+    with instrumentation.stage("generate_global_member_statistics"):
+        generate_global_member_statistics()
+
+    write_stage_report()
+
+    show_arvid_per_thread("words",threshold=2000,movingaverage=80,stackplot=False,filename=getattr(setup, "plot_file", None))
+
+
 
 # sort all messages, so that the oldest are first
 def sort_messages():
     global threads
     for thread in threads:
         thread["messages"].sort(key = lambda message: message["date"])
+        thread.invalidate_date_index()
 
 
 
@@ -131,228 +533,355 @@ def group_threads():
 
 
 
+# inverted index from words to the messages containing them (see word_index.py)
+# with setup.word_index it is built by calculate_meta_data, in the same pass, and otherwise by the first search_messages
+word_index = None
+
 def calculate_meta_data():
     # calculating extra data, such as number of messages per person, number of words per person, and so forth
     global threads
+    global word_index
+    global member_word_counts
+    index = None
+    if getattr(setup, "word_index", False):
+        word_index = index = WordIndex()
+    member_word_counts = {}
     for thread in threads:
+        # finally, add the meta data to the thread dictionary
+        thread["meta_data"] = thread_meta_data(thread, index, member_word_counts)
 
-        # relevant data lists
-        members = thread["members"]
-        messages = thread["messages"]
-        conversations = thread["conversations"]
 
-        meta = {}
-        meta["number_of_messages"] = len(messages)
+# the word counts of every member over all threads, keyed by the interned member id (see member_id)
+# a dictionary from word to count, or a WordSketch with setup.approximate_word_counts
+# calculate_meta_data adds up the counts of the threads as it goes, so the counts of each thread are not kept
+member_word_counts = {}
 
-        messages_per_member = {}
-        words_per_member = {}
-        conversations_started_per_member = {}
-        conversations_ended_per_member = {}
-        mobbade_conversations_per_member = {}
-        top_words_per_member = {}
-        all_words_per_member_count = {}
+# add the word counts of member in one thread to totals, a dictionary like member_word_counts
+def add_word_counts(totals, member, word_counts):
+    mid = member_id(member)
+    if isinstance(word_counts, sketches.WordSketch):
+        if mid not in totals:
+            totals[mid] = sketches.WordSketch()
+        totals[mid].merge(word_counts)
+        return
+    total = totals.setdefault(mid, {})
+    for word, count in word_counts.items():
+        total[word] = total.get(word, 0) + count
 
-        # initialize all to zero
-        for member in members:
-            messages_per_member[member] = 0
-            words_per_member[member] = 0
-            conversations_started_per_member[member] = 0
-            conversations_ended_per_member[member] = 0
-            mobbade_conversations_per_member[member] = 0
-            top_words_per_member[member] = []
-            all_words_per_member_count[member] = {}
 
-        skip_words = {"det", "är", "jag", "att", "inte", "på", "vi", "du", "har", "man", "och", "eller", "så", "i"}
+# build the word index over the messages of all threads, without calculating the meta data
+def build_word_index():
+    global word_index
+    word_index = WordIndex()
+    for thread in threads:
+        first_document = word_index.add_thread(len(thread["messages"]))
+        for i, message in enumerate(thread["messages"]):
+            word_index.add(first_document + i, word_terms(message["content"]))
+    return word_index
+
+
+# the meta data of one thread
+# if index is a WordIndex, the messages of the thread are also added to it
+# if word_counts is a dictionary like member_word_counts, the word counts of the members are added to it
+def thread_meta_data(thread, index = None, word_counts = None):
+    # relevant data lists
+    members = thread["members"]
+    messages = thread["messages"]
+    conversations = thread["conversations"]
+
+    # the messages of this thread get consecutive document numbers in the word index
+    if index != None:
+        first_document = index.add_thread(len(messages))
+
+    meta = {}
+    meta["number_of_messages"] = len(messages)
+
+    messages_per_member = {}
+    words_per_member = {}
+    conversations_started_per_member = {}
+    conversations_ended_per_member = {}
+    mobbade_conversations_per_member = {}
+    top_words_per_member = {}
+    all_words_per_member_count = {}
+
+    # with setup.approximate_word_counts, the words of each member are counted in fixed memory (see sketches.py)
+    approximate = getattr(setup, "approximate_word_counts", False)
+
+    # initialize all to zero
+    for member in members:
+        messages_per_member[member] = 0
+        words_per_member[member] = 0
+        conversations_started_per_member[member] = 0
+        conversations_ended_per_member[member] = 0
+        mobbade_conversations_per_member[member] = 0
+        top_words_per_member[member] = []
+        all_words_per_member_count[member] = sketches.WordSketch() if approximate else {}
+
+    skip_words = {"det", "är", "jag", "att", "inte", "på", "vi", "du", "har", "man", "och", "eller", "så", "i"}
+
+    # iterate over each message, and update the relevant metrics
+    for i, message in enumerate(messages):
+        words = word_terms(message["content"])
+        if index != None:
+            index.add(first_document + i, words)
+        if message["sender"] in members:
+            messages_per_member[message["sender"]] += 1
+            words_per_member[message["sender"]] += len(words)
+            if approximate:
+                for word in words:
+                    all_words_per_member_count[message["sender"]].add(word)
+                continue
+            for word in words:
+                #if word in skip_words:
+                #    continue
+                if word in all_words_per_member_count[message["sender"]]:
+                    all_words_per_member_count[message["sender"]][word] += 1
+                else:
+                    all_words_per_member_count[message["sender"]][word] = 1
+
+    # the most used words, with the first used word first among equally common ones
+    for member in members:
+        if approximate:
+            top_words_per_member[member] = all_words_per_member_count[member].top(100)
+        else:
+            top_words_per_member[member] = top_words(all_words_per_member_count[member])
+    
+            
 
-        # iterate over each message, and update the relevant metrics
-        for message in messages:
-            if message["sender"] in members:
-                messages_per_member[message["sender"]] += 1
-                words_per_member[message["sender"]] += len(message["content"].split())
-                for word in message["content"].split():
-                    word = word.lower().strip()
-                    #if word in skip_words:
-                    #    continue
-                    if word in all_words_per_member_count[message["sender"]]:
-                        all_words_per_member_count[message["sender"]][word] += 1
-                    else:
-                        all_words_per_member_count[message["sender"]][word] = 1
+    # iterate over each conversation
+    for conversation in conversations:
+        start_message = conversation["messages"][0]
+        start_user = start_message["sender"]
+        end_user = conversation["messages"][len(conversation["messages"])-1]["sender"]
+        if start_user in members:
+            conversations_started_per_member[start_user] += 1
+            if len(conversation["members"]) == 1:
+                # mobbad!
+                mobbade_conversations_per_member[start_user] += 1
+        if end_user in members:
+            conversations_ended_per_member[end_user] += 1
+
+    # add the data to the meta dictionary
+    meta["messages_per_member"] = messages_per_member
+    meta["words_per_member"] = words_per_member
+    meta["conversations_started_per_member"] = conversations_started_per_member
+    meta["conversations_ended_per_member"] = conversations_ended_per_member
+    meta["mobbade_conversations_per_member"] = mobbade_conversations_per_member
+    meta["top_words_per_member"] = top_words_per_member
+    meta["distinct_words_per_member"] = {member: distinct_words(all_words_per_member_count[member]) for member in members}
+
+    # only the totals over all threads are kept, since the counts of every thread would take a lot of memory
+    if word_counts is not None:
+        for member in dict.fromkeys(members):
+            add_word_counts(word_counts, member, all_words_per_member_count[member])
+
+    return meta
+
+
+# the count most common words in a dictionary from word to count (or a WordSketch), as (word, count) tuples
+def top_words(word_counts, count = 100):
+    if isinstance(word_counts, sketches.WordSketch):
+        return word_counts.top(count)
+    return heapq.nlargest(count, word_counts.items(), key = lambda word_tuple: word_tuple[1])
+
+
+# the number of distinct words in a dictionary from word to count, or the estimated number in a WordSketch
+def distinct_words(word_counts):
+    if isinstance(word_counts, sketches.WordSketch):
+        return word_counts.distinct_count()
+    return len(word_counts)
 
-        for member in members:
-            top_ten = []
-            i = 0
-            while i < 100 and len(all_words_per_member_count[member]) > 0:
-                i += 1
-                greatest_val = 0
-                word_tuple = ("hej", 0)
-                for word in all_words_per_member_count[member]:
-                    if all_words_per_member_count[member][word] > greatest_val:
-                        greatest_val = all_words_per_member_count[member][word]
-                        word_tuple = (word, all_words_per_member_count[member][word])
-                top_ten.append(word_tuple)
-                del all_words_per_member_count[member][word_tuple[0]]
-            top_words_per_member[member] = top_ten
-        
-                
-
-        # iterate over each conversation
-        for conversation in conversations:
-            start_message = conversation["messages"][0]
-            start_user = start_message["sender"]
-            end_user = conversation["messages"][len(conversation["messages"])-1]["sender"]
-            if start_user in members:
-                conversations_started_per_member[start_user] += 1
-                if len(conversation["members"]) == 1:
-                    # mobbad!
-                    mobbade_conversations_per_member[start_user] += 1
-            if end_user in members:
-                conversations_ended_per_member[end_user] += 1
-
-        # add the data to the meta dictionary
-        meta["messages_per_member"] = messages_per_member
-        meta["words_per_member"] = words_per_member
-        meta["conversations_started_per_member"] = conversations_started_per_member
-        meta["conversations_ended_per_member"] = conversations_ended_per_member
-        meta["mobbade_conversations_per_member"] = mobbade_conversations_per_member
-        meta["top_words_per_member"] = top_words_per_member
         
 
-        # finally, add the meta data to the thread dictionary
-        thread["meta_data"] = meta
+# find messages containing a word, or a phrase of several words, using the word index
+# sender, start and end (dates or datetimes) optionally restrict the messages that are returned,
+# and are checked on message_columns, whose positions are the document numbers of the word index
+# returns a list of (thread index, message index) tuples, in the order of the threads
+def search_messages(phrase, sender = None, start = None, end = None):
+    import numpy as np
+    global word_index
+    if word_index == None:
+        build_word_index()
+    if message_columns is None:
+        build_message_columns()
+    if word_index.document_count != len(message_columns["sender"]):
+        raise ValueError("the word index was not built for the loaded threads")
+    if start != None and not isinstance(start, datetime):
+        start = datetime.combine(start, datetime.min.time())
+    if end != None and not isinstance(end, datetime):
+        end = datetime.combine(end, datetime.max.time())
+
+    documents = word_index.documents_with_phrase(word_terms(phrase))
+    keep = np.ones(len(documents), dtype=bool)
+    if sender != None:
+        keep &= message_columns["sender"][documents] == member_ids.get(sender, -1)
+    local_time = message_columns["local_time"][documents]
+    if start != None:
+        keep &= local_time >= (start - epoch) / timedelta(seconds = 1)
+    if end != None:
+        keep &= local_time <= (end - epoch) / timedelta(seconds = 1)
+    thread_indices, message_indices = word_index.locations(documents[keep])
+    return list(zip(thread_indices.tolist(), message_indices.tolist()))
+
+
+# write the word index to a file, and read it back
+# the index refers to threads by their position in the threads list, so it must be loaded for the same threads
+def save_word_index(filename):
+    word_index.save(filename)
+
+def load_word_index(filename):
+    global word_index
+    word_index = WordIndex.load(filename)
 
-        
 
 def generate_time_interval_data():
     # generate daily, weekly, monthly and yearly data
 
     global threads
     for thread in threads:
-
-        # relevant data lists
-        members = thread["members"]
-        messages = thread["messages"]
-        conversations = thread["conversations"]
-
-        time_data = {}
-
-        if len(messages) == 0:
-            continue
-        
-        start_date = messages[0]["date"].date()
-        end_date = messages[len(thread["messages"])-1]["date"].date()
-
-        # days
-        time_data["daily"] = {}
-        date_count = (end_date - start_date).days + 1
-        for n in range(date_count):
-            this_date = start_date + timedelta(days = n)
-            time_data["daily"][this_date] = {}
-
-            # init teodor theodore
-            time_data["daily"][this_date]["teodortheodore"] = {}
-            time_data["daily"][this_date]["teodortheodore"]["teodor"] = 0
-            time_data["daily"][this_date]["teodortheodore"]["theodore"] = 0
-
-            # init messages per member
-            time_data["daily"][this_date]["messages_per_member"] = {}
-            time_data["daily"][this_date]["words_per_member"] = {}
-            for member in members:
-                time_data["daily"][this_date]["messages_per_member"][member] = 0
-                time_data["daily"][this_date]["words_per_member"][member] = 0
+        time_data = thread_time_data(thread)
+        if time_data != None:
+            thread["time_data"] = time_data
 
 
-        # create daily
-        for message in messages:
-            this_date = message["date"].date()
+# the daily and monthly data of members from start_date to end_date, with every count zero
+def empty_time_data(members, start_date, end_date):
+    time_data = {}
 
-            # teodor theodore
-            if "teodor" in message["content"].lower():
-                time_data["daily"][this_date]["teodortheodore"]["teodor"] += 1
-            if "théodòre" in message["content"].lower():
-                time_data["daily"][this_date]["teodortheodore"]["theodore"] += 1
-            
-            # per member
-            if message["sender"] in members:
-                time_data["daily"][this_date]["messages_per_member"][message["sender"]] += 1
-                time_data["daily"][this_date]["words_per_member"][message["sender"]] += len(message["content"].split())
+    # days
+    time_data["daily"] = {}
+    date_count = (end_date - start_date).days + 1
+    for n in range(date_count):
+        this_date = start_date + timedelta(days = n)
+        time_data["daily"][this_date] = {}
+
+        # init teodor theodore
+        time_data["daily"][this_date]["teodortheodore"] = {}
+        time_data["daily"][this_date]["teodortheodore"]["teodor"] = 0
+        time_data["daily"][this_date]["teodortheodore"]["theodore"] = 0
+
+        # init messages per member
+        time_data["daily"][this_date]["messages_per_member"] = {}
+        time_data["daily"][this_date]["words_per_member"] = {}
+        for member in members:
+            time_data["daily"][this_date]["messages_per_member"][member] = 0
+            time_data["daily"][this_date]["words_per_member"][member] = 0
+
+    # months
+    time_data["monthly"] = {}
+    month_count = diff_month(end_date, start_date) + 1
+    month_start = start_date.replace(day = 1)
+    for n in range(month_count):
+        this_month = add_months(month_start, n)
+        time_data["monthly"][this_month] = {}
+
+        # init teodor theodore
+        time_data["monthly"][this_month]["teodortheodore"] = {}
+        time_data["monthly"][this_month]["teodortheodore"]["teodor"] = 0
+        time_data["monthly"][this_month]["teodortheodore"]["theodore"] = 0
+
+        time_data["monthly"][this_month]["emoji_per_member"] = {}
+        time_data["monthly"][this_month]["adjusted_emoji_per_member"] = {}
+
+        # init messages per member
+        time_data["monthly"][this_month]["messages_per_member"] = {}
+        time_data["monthly"][this_month]["words_per_member"] = {}
+        for member in members:
+            time_data["monthly"][this_month]["messages_per_member"][member] = 0
+            time_data["monthly"][this_month]["words_per_member"][member] = 0
+            time_data["monthly"][this_month]["emoji_per_member"][member] = 0
+            time_data["monthly"][this_month]["adjusted_emoji_per_member"][member] = 0
 
+    return time_data
 
-        # months
-        time_data["monthly"] = {}
-        month_count = diff_month(end_date, start_date) + 1
-        month_start = start_date.replace(day = 1)
-        for n in range(month_count):
-            this_month = add_months(month_start, n)
-            time_data["monthly"][this_month] = {}
 
-            # init teodor theodore
-            time_data["monthly"][this_month]["teodortheodore"] = {}
-            time_data["monthly"][this_month]["teodortheodore"]["teodor"] = 0
-            time_data["monthly"][this_month]["teodortheodore"]["theodore"] = 0
+# the daily and monthly data of one thread, or None if it has no messages
+def thread_time_data(thread):
+    # relevant data lists
+    members = thread["members"]
+    messages = thread["messages"]
 
-            time_data["monthly"][this_month]["emoji_per_member"] = {}
-            time_data["monthly"][this_month]["adjusted_emoji_per_member"] = {}
+    if len(messages) == 0:
+        return None
+    
+    start_date = messages[0]["date"].date()
+    end_date = messages[len(thread["messages"])-1]["date"].date()
+    time_data = empty_time_data(members, start_date, end_date)
+    month_count = diff_month(end_date, start_date) + 1
+    month_start = start_date.replace(day = 1)
+
+    # create daily and monthly, looking at the content of each message once
+    global emoji
+    for message in messages:
+        daily = time_data["daily"][message["date"].date()]
+        monthly = time_data["monthly"][message["date"].date().replace(day = 1)]
+
+        # teodor theodore
+        if content_contains_lower(message, "teodor"):
+            daily["teodortheodore"]["teodor"] += 1
+            monthly["teodortheodore"]["teodor"] += 1
+        if content_contains_lower(message, "théodòre"):
+            daily["teodortheodore"]["theodore"] += 1
+            monthly["teodortheodore"]["theodore"] += 1
+
+        # per member
+        if message["sender"] in members:
+            words = message_words(message)
+            daily["messages_per_member"][message["sender"]] += 1
+            daily["words_per_member"][message["sender"]] += words
+            monthly["messages_per_member"][message["sender"]] += 1
+            monthly["words_per_member"][message["sender"]] += words
+
+            for e in emoji:
+                if content_contains(message, e):
+                    monthly["emoji_per_member"][message["sender"]] += 1
+
+    for n in range(month_count):
+        this_month = add_months(month_start, n)
+        for member in members:
+            if time_data["monthly"][this_month]["words_per_member"][member] != 0:
+                time_data["monthly"][this_month]["adjusted_emoji_per_member"][member] = time_data["monthly"][this_month]["emoji_per_member"][member] / time_data["monthly"][this_month]["words_per_member"][member]
 
-            # init messages per member
-            time_data["monthly"][this_month]["messages_per_member"] = {}
-            time_data["monthly"][this_month]["words_per_member"] = {}
-            for member in members:
-                time_data["monthly"][this_month]["messages_per_member"][member] = 0
-                time_data["monthly"][this_month]["words_per_member"][member] = 0
-                time_data["monthly"][this_month]["emoji_per_member"][member] = 0
-                time_data["monthly"][this_month]["adjusted_emoji_per_member"][member] = 0
+    return time_data
 
-        # create monthly
-        for message in messages:
-            this_date = message["date"].date()
-            this_date = this_date.replace(day = 1)
+# the dates of the first and the last message of every thread with messages, for finding the threads active at a time
+thread_spans = None
 
-            # teodor theodore
-            if "teodor" in message["content"].lower():
-                time_data["monthly"][this_date]["teodortheodore"]["teodor"] += 1
-            if "théodòre" in message["content"].lower():
-                time_data["monthly"][this_date]["teodortheodore"]["theodore"] += 1
+def build_thread_spans():
+    global thread_spans
+    intervals = []
+    for thread in threads:
+        span = thread.span()
+        if span != None:
+            intervals.append((span[0], span[1], thread["index"]))
+    thread_spans = interval_tree.IntervalTree(intervals)
 
-            # per member
-            if message["sender"] in members:
-                time_data["monthly"][this_date]["messages_per_member"][message["sender"]] += 1
-                time_data["monthly"][this_date]["words_per_member"][message["sender"]] += len(message["content"].split())
-                
-                global emoji
-                for e in emoji:
-                    if e in message["content"]:
-                        time_data["monthly"][this_date]["emoji_per_member"][message["sender"]] += 1
-
-        for n in range(month_count):
-            this_month = add_months(month_start, n)
-            for member in members:
-                if time_data["monthly"][this_month]["words_per_member"][member] != 0:
-                    time_data["monthly"][this_month]["adjusted_emoji_per_member"][member] = time_data["monthly"][this_month]["emoji_per_member"][member] / time_data["monthly"][this_month]["words_per_member"][member]
 
+# the threads with messages both on or before end and on or after start (dates)
+def active_threads(start, end):
+    if thread_spans == None:
+        build_thread_spans()
+    return [threads[index] for index in thread_spans.overlapping(start, end)]
 
-        thread["time_data"] = time_data
 
 def generate_global_time_data():
     # generate daily data globally, i.e. for all threads at once. used to compare threads.
     global global_time_data
 
+    # the cached plot series were made from the old data
+    plot_series_cache.clear()
+
     global threads
 
-    start_date = None
-    end_date = None
-    for thread in threads:
-        tstart = thread["messages"][0]["date"].date()
-        tend = thread["messages"][len(thread["messages"])-1]["date"].date()
-        if start_date == None and end_date == None:
-            start_date = tstart
-            end_date = tend
-        if tstart < start_date:
-            start_date = tstart
-        if tend > end_date:
-            end_date = tend
+    # the first and the last day of all threads
+    build_thread_spans()
+    start_date = thread_spans.start
+    end_date = thread_spans.end
 
     global_time_data = {}
     global_time_data["daily"] = {}
+    if start_date == None:
+        return
     date_count = (end_date - start_date).days + 1
 
     
@@ -387,7 +916,318 @@ def generate_global_time_data():
             # per member
             if message["sender"] in members:
                 global_time_data["daily"][ti][this_date]["messages_per_member"][message["sender"]] += 1
-                global_time_data["daily"][ti][this_date]["words_per_member"][message["sender"]] += len(message["content"].split())
+                global_time_data["daily"][ti][this_date]["words_per_member"][message["sender"]] += message_words(message)
+
+
+
+# statistics per member over all threads, keyed by the interned member id (see member_id)
+global_member_statistics = {}
+
+def generate_global_member_statistics():
+    # add up the meta data and time data of every thread, instead of going through the messages again
+    # the word counts were already added up by calculate_meta_data
+    global global_member_statistics
+    global threads
+
+    global_member_statistics = {}
+    for thread in threads:
+        merge_member_statistics(global_member_statistics, thread)
+
+    for mid, statistics in global_member_statistics.items():
+        statistics["word_counts"] = member_word_counts.get(mid, {})
+        statistics["top_words"] = top_words(statistics["word_counts"])
+        statistics["distinct_words"] = distinct_words(statistics["word_counts"])
+        statistics["emoji_per_word"] = statistics["emoji"] / statistics["words"] if statistics["words"] != 0 else 0
+
+
+# add the per member data of a thread to statistics
+def merge_member_statistics(statistics, thread):
+    meta = thread["meta_data"]
+    # threads without messages have no time data
+    time_data = thread["time_data"] if thread["message_count"] > 0 else None
+    # a member that the thread lists twice is only counted once
+    for member in dict.fromkeys(thread["members"]):
+        mid = member_id(member)
+        if mid not in statistics:
+            statistics[mid] = {"name": member, "threads": 0, "messages": 0, "words": 0,
+                               "conversations_started": 0, "conversations_ended": 0, "mobbade_conversations": 0,
+                               "emoji": 0}
+        s = statistics[mid]
+        s["threads"] += 1
+        s["messages"] += meta["messages_per_member"][member]
+        s["words"] += meta["words_per_member"][member]
+        s["conversations_started"] += meta["conversations_started_per_member"][member]
+        s["conversations_ended"] += meta["conversations_ended_per_member"][member]
+        s["mobbade_conversations"] += meta["mobbade_conversations_per_member"][member]
+        if time_data != None:
+            for bucket in time_data["monthly"].values():
+                s["emoji"] += bucket["emoji_per_member"][member]
+
+
+# Out-of-core mode, for exports whose messages do not fit in memory at once
+# The files are read in batches that fit in the memory budget. The meta data and time data of every thread in a batch
+# are counted as usual, spilled to disk as columnar partitions (see spill.py), and the messages of the batch are dropped
+# before the next one is read, leaving a lazy thread with the metadata. Each file is only parsed once, also when the
+# thread is stored in the database. At the end, the partitions are merged into the "meta_data" of every thread and into
+# spilled_time_data, a few numpy columns from which the "time_data" of a thread and its daily data in global_time_data
+# are made when they are used, so the merge does not need the memory of the time data of every thread at once.
+# Both are the same as in main. The word counts are added up into member_word_counts as the batches are counted,
+# like in calculate_meta_data. The messages are never all in memory, so the word index is not built in this mode.
+
+# a parsed thread, with its conversations, meta data and time data, takes about this many bytes per byte of its message.json
+# measured with tracemalloc on synthetic exports (generate_synthetic_export.py), where it was 11 to 21 times the file size,
+# more for small threads, whose daily time data is big compared to their messages. setup.memory_per_file_byte overrides it.
+memory_per_file_byte = 16
+
+# the positions of filenames in batches whose threads are estimated to take at most memory_budget bytes together
+# a thread that is bigger than the budget on its own is a batch of its own
+def memory_batches(filenames, memory_budget, bytes_per_file_byte = memory_per_file_byte):
+    batch = []
+    size = 0
+    for i, filename in enumerate(filenames):
+        thread_size = os.path.getsize(filename) * bytes_per_file_byte
+        if len(batch) > 0 and size + thread_size > memory_budget:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(i)
+        size += thread_size
+    if len(batch) > 0:
+        yield batch
+
+
+# the spilled tables, with their columns. the members are member ids and the dates days since epoch,
+# and only the counts that are not zero are spilled
+spill_tables = {
+    "member_meta": [("thread", "i"), ("member", "i"), ("messages", "q"), ("words", "q"),
+                    ("conversations_started", "q"), ("conversations_ended", "q"), ("mobbade_conversations", "q")],
+    "daily": [("thread", "i"), ("date", "i"), ("member", "i"), ("messages", "q"), ("words", "q")],
+    "monthly": [("thread", "i"), ("date", "i"), ("member", "i"), ("messages", "q"), ("words", "q"), ("emoji", "q")],
+    "daily_teodortheodore": [("thread", "i"), ("date", "i"), ("teodor", "q"), ("theodore", "q")],
+    "monthly_teodortheodore": [("thread", "i"), ("date", "i"), ("teodor", "q"), ("theodore", "q")],
+}
+
+
+# spill the meta data and time data of the thread with index t
+def spill_thread(writers, t, members, meta, time_data):
+    for member in dict.fromkeys(members):
+        m = member_id(member)
+        writers["member_meta"].append(t, m, meta["messages_per_member"][member], meta["words_per_member"][member],
+                                      meta["conversations_started_per_member"][member], meta["conversations_ended_per_member"][member],
+                                      meta["mobbade_conversations_per_member"][member])
+    if time_data == None:
+        return
+    for interval in ("daily", "monthly"):
+        for d, bucket in time_data[interval].items():
+            day = days_since_epoch(d)
+            if bucket["teodortheodore"]["teodor"] != 0 or bucket["teodortheodore"]["theodore"] != 0:
+                writers[interval + "_teodortheodore"].append(t, day, bucket["teodortheodore"]["teodor"], bucket["teodortheodore"]["theodore"])
+            for member in dict.fromkeys(members):
+                if bucket["messages_per_member"][member] == 0:
+                    continue
+                row = [t, day, member_id(member), bucket["messages_per_member"][member], bucket["words_per_member"][member]]
+                if interval == "monthly":
+                    row.append(bucket["emoji_per_member"][member])
+                writers[interval].append(*row)
+
+
+# the meta data of a thread with every count zero, like thread_meta_data makes it
+def empty_meta_data(thread):
+    members = thread["members"]
+    return {"number_of_messages": thread["message_count"],
+            "messages_per_member": {member: 0 for member in members},
+            "words_per_member": {member: 0 for member in members},
+            "conversations_started_per_member": {member: 0 for member in members},
+            "conversations_ended_per_member": {member: 0 for member in members},
+            "mobbade_conversations_per_member": {member: 0 for member in members},
+            "top_words_per_member": {member: [] for member in members},
+            "distinct_words_per_member": {member: 0 for member in members}}
+
+
+# read the spilled partitions back into the "meta_data" of the threads, and the time data into spilled_time_data
+# word_meta has the "top_words_per_member" and "distinct_words_per_member" of the threads that were counted, by thread index
+def merge_spilled(directory, word_meta):
+    global threads
+    global spilled_time_data
+    for thread in threads:
+        thread["meta_data"] = empty_meta_data(thread)
+        thread["meta_data"].update(word_meta.get(thread["index"], {}))
+
+    for columns in spill.read_partitions(directory, "member_meta"):
+        for row in zip(*[columns[name].tolist() for name, typecode in spill_tables["member_meta"]]):
+            meta = threads[row[0]]["meta_data"]
+            member = member_names[row[1]]
+            for key, value in zip(["messages", "words", "conversations_started", "conversations_ended", "mobbade_conversations"], row[2:]):
+                meta[key + "_per_member"][member] = value
+
+    spilled_time_data = SpilledTimeData(directory, threads)
+
+
+# the time data of the out-of-core mode, read back from the spilled partitions (see merge_spilled)
+spilled_time_data = None
+
+# The spilled time data of all threads, as one set of numpy columns per table, sorted by thread and date
+# Only the counts that are not zero are there, so it takes a few bytes per count. The "time_data" of a thread, which has
+# a bucket for every day, is made from its rows when it is used (see LazyThread), and the daily data of a thread
+# in global_time_data, which has a bucket for every day of all threads, likewise (see SpilledGlobalDaily).
+class SpilledTimeData:
+
+    tables = ["daily", "monthly", "daily_teodortheodore", "monthly_teodortheodore"]
+
+    def __init__(self, directory, threads):
+        import numpy as np
+        self.threads = threads
+        self.columns = {}
+        self.bounds = {}
+        for table in self.tables:
+            columns = spill.read_table(directory, table, spill_tables[table])
+            order = np.lexsort((columns["date"], columns["thread"]))
+            self.columns[table] = {name: column[order] for name, column in columns.items()}
+            # the rows of thread t are from bounds[t] to bounds[t + 1]
+            self.bounds[table] = np.searchsorted(self.columns[table]["thread"], np.arange(len(threads) + 1))
+
+    def has(self, thread):
+        return thread["index"] < len(self.threads) and self.threads[thread["index"]] is thread
+
+    # the rows of the thread with index t in table, as tuples
+    def rows(self, table, t):
+        first, last = self.bounds[table][t], self.bounds[table][t + 1]
+        return zip(*[self.columns[table][name][first:last].tolist() for name, typecode in spill_tables[table]])
+
+    # the time data of a thread, the same as thread_time_data makes it from the messages
+    def time_data(self, thread):
+        t = thread["index"]
+        span = thread.span()
+        time_data = empty_time_data(thread["members"], span[0], span[1])
+        for interval in ("daily", "monthly"):
+            keys = ["messages_per_member", "words_per_member"] + (["emoji_per_member"] if interval == "monthly" else [])
+            buckets = time_data[interval]
+            for row in self.rows(interval, t):
+                bucket = buckets[epoch.date() + timedelta(days = row[1])]
+                for key, value in zip(keys, row[3:]):
+                    bucket[key][member_names[row[2]]] = value
+            for row in self.rows(interval + "_teodortheodore", t):
+                buckets[epoch.date() + timedelta(days = row[1])]["teodortheodore"] = {"teodor": row[2], "theodore": row[3]}
+        for bucket in time_data["monthly"].values():
+            for member in thread["members"]:
+                if bucket["words_per_member"][member] != 0:
+                    bucket["adjusted_emoji_per_member"][member] = bucket["emoji_per_member"][member] / bucket["words_per_member"][member]
+        return time_data
+
+    # the daily messages and words per member of a thread on each of days, like in global_time_data
+    def global_daily(self, thread, days):
+        members = thread["members"]
+        daily = {day: {"messages_per_member": {member: 0 for member in members},
+                       "words_per_member": {member: 0 for member in members}} for day in days}
+        for row in self.rows("daily", thread["index"]):
+            bucket = daily[epoch.date() + timedelta(days = row[1])]
+            bucket["messages_per_member"][member_names[row[2]]] = row[3]
+            bucket["words_per_member"][member_names[row[2]]] = row[4]
+        return daily
+
+
+# global_time_data["daily"] in the out-of-core mode: a mapping from thread index to the daily data of the thread
+# on every day of all threads, which is made from the spilled time data when it is used, one thread at a time
+class SpilledGlobalDaily(Mapping):
+
+    def __init__(self, spilled, start_date, end_date):
+        self.spilled = spilled
+        self.days = [start_date + timedelta(days = n) for n in range((end_date - start_date).days + 1)]
+        self.indices = [thread["index"] for thread in spilled.threads if thread["message_count"] > 0]
+        self.index_set = set(self.indices)
+
+    def __getitem__(self, t):
+        if t not in self.index_set:
+            raise KeyError(t)
+        return self.spilled.global_daily(self.spilled.threads[t], self.days)
+
+    def __contains__(self, t):
+        return t in self.index_set
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+# global_time_data from the spilled time data, for when the messages of the threads are not in memory
+def generate_global_time_data_from_spilled():
+    global global_time_data
+    plot_series_cache.clear()
+    build_thread_spans()
+    global_time_data = {"daily": {}}
+    if thread_spans.start == None:
+        return
+    global_time_data["daily"] = SpilledGlobalDaily(spilled_time_data, thread_spans.start, thread_spans.end)
+
+
+# load and analyze an export directory in batches of at most memory_budget bytes (see memory_batches),
+# spilling partitions of partition_rows rows to a temporary directory in spill_directory (or the system's),
+# which is removed afterwards. the defaults are setup.memory_budget, setup.spill_directory and setup.spill_partition_rows.
+# with setup.database, the threads that are not stored there yet are stored as their batches are read
+def out_of_core_analysis(messages_directory, memory_budget = None, spill_directory = None, partition_rows = None):
+    import shutil
+    import tempfile
+    global threads
+    global member_word_counts
+    if export_archive.is_archive(messages_directory):
+        raise ValueError("the out-of-core mode reads an extracted export directory, not zip archives")
+    if memory_budget == None:
+        memory_budget = getattr(setup, "memory_budget", 1024 * 1024 * 1024)
+    if spill_directory == None:
+        spill_directory = getattr(setup, "spill_directory", None)
+    if partition_rows == None:
+        partition_rows = getattr(setup, "spill_partition_rows", spill.default_partition_rows)
+
+    bytes_per_file_byte = getattr(setup, "memory_per_file_byte", memory_per_file_byte)
+
+    conn = None
+    if getattr(setup, "database", None) != None:
+        conn = message_database.connect(setup.database)
+    # the threads are added as their batches are read
+    invalidate_derived_data()
+    threadnames, filenames = thread_files(messages_directory)
+    progress = ingestion_progress(filenames)
+
+    directory = tempfile.mkdtemp(prefix = "messenger-spill-", dir = spill_directory)
+    try:
+        writers = {table: spill.PartitionWriter(directory, table, columns, partition_rows) for table, columns in spill_tables.items()}
+        member_word_counts = {}
+        word_meta = {}
+        for batch in memory_batches(filenames, memory_budget, bytes_per_file_byte):
+            # the threads of the batch are parsed into dictionaries of their own, so the lazy threads stay unloaded
+            contents = read_ahead.read_files([filenames[i] for i in batch],
+                                             getattr(setup, "read_ahead", read_ahead.default_depth),
+                                             getattr(setup, "io_threads", read_ahead.default_threads))
+            for i, (filename, data) in zip(batch, contents):
+                threaddict = read_thread(filename, data)
+                if conn != None:
+                    stat = os.stat(filename)
+                    if not message_database.is_stored(conn, threadnames[i], stat.st_size, stat.st_mtime):
+                        debug_log("storing " + threadnames[i] + " in the database")
+                        message_database.store_thread(conn, threadnames[i], threaddict, stat.st_size, stat.st_mtime)
+                thread = LazyThread(filename, thread_metadata(threaddict))
+                thread['path'] = threadnames[i]
+                thread['index'] = len(threads)
+                threads.append(thread)
+                progress.update(messages = thread['message_count'], bytes_read = len(data))
+                threaddict["messages"].sort(key = lambda message: message["date"])
+                threaddict["conversations"] = thread_conversations(threaddict["messages"])
+                meta = thread_meta_data(threaddict, word_counts = member_word_counts)
+                spill_thread(writers, thread["index"], thread["members"], meta, thread_time_data(threaddict))
+                # the top words are short lists, so they are kept instead of spilled
+                word_meta[thread["index"]] = {key: meta[key] for key in ("top_words_per_member", "distinct_words_per_member")}
+                del threaddict
+        progress.finish()
+        for writer in writers.values():
+            writer.flush()
+        merge_spilled(directory, word_meta)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+        if conn != None:
+            conn.close()
+    generate_global_time_data_from_spilled()
 
 
 
@@ -405,29 +1245,117 @@ def add_months(sourcedate,months):
 
 
 # plot using pyplot
-from matplotlib import pyplot as plt
-from matplotlib import dates as pltdates
+# matplotlib takes most of a second to import, so it is only imported when something is plotted
+
+# size of the plots, in inches and dots per inch
+plot_size = (12, 6)
+plot_dpi = 100
+
 # times is list of datetimes. series is list of dicts containing "label" string and "datapoints" list.
-def plot_time_data(times, series, stackplot=True):
-    #dates = pltdates.date2num(times)
+# the series are decimated to the pixel width of the plot before they are handed to matplotlib
+# if filename is given, the plot is rendered to that file with the Agg backend, without opening a window
+def plot_time_data(times, series, stackplot=True, filename=None):
+    fig = new_figure(filename)
+    ax = fig.add_subplot()
+    width = int(plot_size[0] * plot_dpi)
     if not stackplot:
         for sery in series:
-            plt.plot(times,sery["datapoints"],label=sery["label"],linestyle="-",marker="")
+            stimes, datapoints = decimate_min_max(times, sery["datapoints"], width)
+            ax.plot(stimes,datapoints,label=sery["label"],linestyle="-",marker="")
     else:
         labels = []
         ys = []
         for sery in series:
             labels.append(sery["label"])
-            ys.append(sery["datapoints"])
-        plt.stackplot(times,ys,labels=labels)
-    plt.legend(loc="upper left")
-    plt.show()
-
+            stimes, datapoints = decimate_mean(times, sery["datapoints"], width)
+            ys.append(datapoints)
+        if len(ys) > 0:
+            ax.stackplot(stimes,ys,labels=labels)
+    ax.legend(loc="upper left")
+    show_figure(fig, filename)
+
+
+# a figure that is shown in a window, or rendered to filename with the Agg backend if it is given
+def new_figure(filename):
+    if filename == None:
+        from matplotlib import pyplot as plt
+        return plt.figure(figsize=plot_size, dpi=plot_dpi)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=plot_size, dpi=plot_dpi)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def show_figure(fig, filename):
+    if filename == None:
+        from matplotlib import pyplot as plt
+        plt.show()
+    else:
+        fig.savefig(filename)
+
+
+weekday_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# plot an activity heatmap from activity_heatmaps, a 7 x (24 * slots per hour) matrix, with monday on top
+def plot_heatmap(heatmap, title=None, filename=None):
+    fig = new_figure(filename)
+    ax = fig.add_subplot()
+    slots_per_hour = heatmap.shape[1] // 24
+    image = ax.imshow(heatmap, aspect="auto", interpolation="nearest", cmap="viridis")
+    ax.set_yticks(range(7))
+    ax.set_yticklabels(weekday_names)
+    ax.set_xticks([hour * slots_per_hour for hour in range(0, 24, 2)])
+    ax.set_xticklabels([str(hour) for hour in range(0, 24, 2)])
+    ax.set_xlabel("hour")
+    if title != None:
+        ax.set_title(title)
+    fig.colorbar(image, ax=ax)
+    show_figure(fig, filename)
+
+
+# bucket boundaries for reducing n points to at most buckets points
+def decimation_buckets(n, buckets):
+    import numpy as np
+    return np.linspace(0, n, buckets + 1).astype(np.int64)
+
+# downsample a series to the mean of each of buckets equally long pieces
+# the means keep the stacked totals of a stackplot correct, which minimum and maximum would not
+def decimate_mean(times, datapoints, buckets):
+    import numpy as np
+    if len(datapoints) <= buckets:
+        return times, datapoints
+    edges = decimation_buckets(len(datapoints), buckets)
+    sums = np.add.reduceat(np.asarray(datapoints, dtype=np.float64), edges[:-1])
+    return [times[i] for i in edges[:-1]], sums / np.diff(edges)
+
+# downsample a series to the minimum and the maximum of each of buckets equally long pieces
+# a line through those looks the same as the full series at that resolution
+def decimate_min_max(times, datapoints, buckets):
+    import numpy as np
+    if len(datapoints) <= 2 * buckets:
+        return times, datapoints
+    edges = decimation_buckets(len(datapoints), buckets)
+    values = np.asarray(datapoints, dtype=np.float64)
+    decimated = np.empty(2 * buckets)
+    decimated[0::2] = np.minimum.reduceat(values, edges[:-1])
+    decimated[1::2] = np.maximum.reduceat(values, edges[:-1])
+    decimated_times = []
+    for i in range(buckets):
+        decimated_times.append(times[edges[i]])
+        decimated_times.append(times[edges[i + 1] - 1])
+    return decimated_times, decimated
+
+
+# the aggregated series of show_arvid_per_thread, so that they are only computed once
+# maps (worm, threshold, movingaverage) to (times, series). it is cleared by generate_global_time_data.
+plot_series_cache = {}
 
 # plot number of words or messages per thread
 # threshold is number of words/messages user must have sent to show the thread in the graph
 # movingaverage creates a movingaverage for smoother plots
-def show_arvid_per_thread(worm, threshold=1000, movingaverage=50, stackplot=True):
+# filename renders the plot to a file instead of showing it
+def show_arvid_per_thread(worm, threshold=1000, movingaverage=50, stackplot=True, filename=None):
     k = None
     if worm == "words":
         k = "words_per_member"
@@ -436,7 +1364,21 @@ def show_arvid_per_thread(worm, threshold=1000, movingaverage=50, stackplot=True
     else:
         print("ERROR. Argument must be 'words' or 'messages'.")
         return
-    
+
+    key = (worm, threshold, movingaverage)
+    if key not in plot_series_cache:
+        plot_series_cache[key] = arvid_per_thread_series(k, threshold, movingaverage)
+    times, series = plot_series_cache[key]
+
+    # random shuffle series
+    series = list(series)
+    random.shuffle(series)
+
+    plot_time_data(times, series,stackplot=stackplot,filename=filename)
+
+
+# the times and the series for show_arvid_per_thread, for the data key k
+def arvid_per_thread_series(k, threshold, movingaverage):
     global global_time_data
     global threads
 
@@ -446,6 +1388,8 @@ def show_arvid_per_thread(worm, threshold=1000, movingaverage=50, stackplot=True
     series = []
     for thread in threads:
         ti = thread["index"]
+        if ti not in global_time_data["daily"]:
+            continue
         sery = {}
         sery["label"] = thread["title"]
         sery["datepoints"] = []
@@ -461,6 +1405,8 @@ def show_arvid_per_thread(worm, threshold=1000, movingaverage=50, stackplot=True
             sery["datapoints"].append(dd["data"])
             if addlengths:
                 times.append(dd["date"])
+        # the daily datepoints are not needed anymore, and would only take up memory in the cache
+        del sery["datepoints"]
         if totalcount >= threshold:
             series.append(sery)
 
@@ -482,97 +1428,608 @@ def show_arvid_per_thread(worm, threshold=1000, movingaverage=50, stackplot=True
         seryy["datapoints"] = avsery
         #averageseries.append(avsery)
 
-    # random shuffle series
-    random.shuffle(series)
-
-    plot_time_data(times, series,stackplot=stackplot)
+    return times, series
 
 
 
 # interval parameter can be "daily", "weekly" or "monthly" or "yearly"
 # thread is indexed
+# the rows are streamed to f (or stdout) one at a time, see csv_export.py
 def csv_export_interval_data(thread, interval, data, f = None):
-    # export dict
-    export_dict = threads[thread]["time_data"][interval]
+    csv_export.export_interval_data(threads[thread], interval, data, f)
 
-    start_date = threads[thread]["messages"][0]["date"].date()
-    end_date = threads[thread]["messages"][len(threads[thread]["messages"])-1]["date"].date()
 
-    if interval == "daily":
-        s = "Date"
-        for data_point in export_dict[start_date][data]:
-            s += "," + str(data_point)
-        s += "\n"
+# export every data key of every thread, for all intervals, as one csv file per interval in directory
+def csv_export_all_interval_data(directory, intervals = csv_export.intervals):
+    return csv_export.export_all_interval_data(threads, directory, intervals)
 
-        date_count = (end_date - start_date).days + 1
-        for n in range(date_count):
-            d = start_date + timedelta(days = n)
-            s += str(d)
-            for data_point in export_dict[d][data]:
-                s += "," + str(export_dict[d][data][data_point])
-            s += "\n"
-
-        if f == None:
-            print(s)
-        else:
-            # print to file
-            with open(f, "w") as fi:
-                fi.write(s)
-    elif interval == "monthly":
-        month_start = start_date.replace(day = 1)
-        s = "Date"
-        for data_point in export_dict[month_start][data]:
-            s += "," + str(data_point)
-        s += "\n"
-
-        month_count = diff_month(end_date, start_date) + 1
-        for n in range(month_count):
-            d = add_months(month_start, n)
-            s += str(d)
-            for data_point in export_dict[d][data]:
-                s += "," + str(export_dict[d][data][data_point])
-            s += "\n"
-
-        if f == None:
-            print(s)
-        else:
-            # print to file
-            with open(f, "w") as fi:
-                fi.write(s)
 
 
+# the members of a thread, with every member once, in order
+# the user is added to the members of every thread, so they are listed twice if the export also has them as a participant
+def unique_members(thread):
+    return list(dict.fromkeys(thread["members"]))
 
 
+# interned member identities, shared by all threads
+# member_ids maps a name to its id, and member_names maps an id back to the name
+member_ids = {}
+member_names = []
 
+def member_id(name):
+    if name not in member_ids:
+        member_ids[name] = len(member_names)
+        member_names.append(name)
+    return member_ids[name]
 
 
+# the messages of all threads stored as columns (numpy arrays), one entry per message
+# the messages of a thread are the entries from thread["first_message"] to thread["first_message"] + len(thread["messages"])
+# "thread" is the thread index, "timestamp" is seconds since epoch (UTC) and "local_time" is the same in local time,
+# "sender" is the interned member id of the sender and "words" is the number of words in the message
+message_columns = None
 
+epoch = datetime(1970, 1, 1)
 
+def build_message_columns():
+    import numpy as np
+    global message_columns
+    global reaction_columns
+    global threads
 
+    message_count = sum(len(thread["messages"]) for thread in threads)
+    columns = {}
+    columns["thread"] = np.empty(message_count, dtype=np.int32)
+    columns["timestamp"] = np.empty(message_count, dtype=np.int64)
+    columns["local_time"] = np.empty(message_count, dtype=np.int64)
+    columns["sender"] = np.empty(message_count, dtype=np.int32)
+    columns["words"] = np.empty(message_count, dtype=np.int32)
 
-# Create conversations
-def create_conversations():
+    # the reactions are collected in the same loop as the message columns, so there is no separate pass over the messages for them
+    reaction_message = array("q")
+    reaction_actor = array("i")
+    reaction_type = array("i")
+
+    i = 0
+    for thread in threads:
+        thread["first_message"] = i
+        for member in thread["members"]:
+            member_id(member)
+        for message in thread["messages"]:
+            columns["thread"][i] = thread["index"]
+            columns["timestamp"][i] = message["timestamp"]
+            columns["local_time"][i] = (message["date"] - epoch) // timedelta(seconds = 1)
+            columns["sender"][i] = member_id(message["sender"])
+            columns["words"][i] = message_words(message)
+            # messages loaded from the database have no reactions
+            for reaction in message.get("reactions", ()):
+                reaction_message.append(i)
+                reaction_actor.append(member_id(reaction["actor"]))
+                reaction_type.append(reaction_id(reaction["reaction"]))
+            i += 1
+
+    message_columns = columns
+    reaction_columns = {"message": np.frombuffer(reaction_message, dtype=np.int64),
+                        "actor": np.frombuffer(reaction_actor, dtype=np.int32),
+                        "reaction": np.frombuffer(reaction_type, dtype=np.int32)}
+
+
+# interned reactions (the emoji), like the members
+reaction_ids = {}
+reaction_names = []
+
+def reaction_id(reaction):
+    if reaction not in reaction_ids:
+        reaction_ids[reaction] = len(reaction_names)
+        reaction_names.append(reaction)
+    return reaction_ids[reaction]
+
+
+# one entry per reaction, built together with message_columns
+# "message" is the number of the message that was reacted to (its position in message_columns),
+# "actor" is the member id of who reacted, and "reaction" the id of the reaction (see reaction_id)
+reaction_columns = None
+
+
+# reactions given and received, per member, per thread and member, per month and member and per reaction
+# returns a dictionary of numpy arrays. the member axis is indexed by member id, the thread axis by thread index,
+# and the month axis by the months from "first_month" (a numpy month) on.
+def reaction_statistics():
+    import numpy as np
+    if message_columns is None:
+        build_message_columns()
+    member_count = len(member_names)
+    thread_count = len(threads)
+
+    message = reaction_columns["message"]
+    actor = reaction_columns["actor"].astype(np.int64)
+    # who sent the message that was reacted to, and where and when it was sent
+    receiver = message_columns["sender"][message].astype(np.int64)
+    thread = message_columns["thread"][message].astype(np.int64)
+    months = (message_columns["local_time"][message] // (24 * 60 * 60)).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    first_month = months.min() if len(months) > 0 else 0
+    month_count = int(months.max() - first_month) + 1 if len(months) > 0 else 0
+    month_rows = months - first_month
+
+    statistics = {}
+    statistics["given"] = np.bincount(actor, minlength=member_count)
+    statistics["received"] = np.bincount(receiver, minlength=member_count)
+    statistics["given_per_thread"] = np.bincount(thread * member_count + actor, minlength=thread_count * member_count).reshape(thread_count, member_count)
+    statistics["received_per_thread"] = np.bincount(thread * member_count + receiver, minlength=thread_count * member_count).reshape(thread_count, member_count)
+    statistics["given_per_month"] = np.bincount(month_rows * member_count + actor, minlength=month_count * member_count).reshape(month_count, member_count)
+    statistics["received_per_month"] = np.bincount(month_rows * member_count + receiver, minlength=month_count * member_count).reshape(month_count, member_count)
+    statistics["per_reaction"] = np.bincount(reaction_columns["reaction"], minlength=len(reaction_names))
+    statistics["first_month"] = np.datetime64(int(first_month), "M")
+    return statistics
+
+
+# whether each message in message_columns starts a conversation, from the conversations of create_conversations
+def conversation_start_column():
+    import numpy as np
+    if message_columns is None:
+        build_message_columns()
+    starts = np.zeros(len(message_columns["thread"]), dtype=bool)
+    for thread in threads:
+        position = thread["first_message"]
+        for conversation in thread["conversations"]:
+            starts[position] = True
+            position += len(conversation["messages"])
+    return starts
+
+
+# the replies of all threads: every message whose sender is not the sender of the message before it,
+# in the same conversation. returns columns with the "message" number of the reply, its "thread",
+# the "sender" who replied (a member id), and the "latency" in seconds since the message before it.
+def reply_latencies():
+    import numpy as np
+    if message_columns is None:
+        build_message_columns()
+    thread = message_columns["thread"]
+    sender = message_columns["sender"]
+    timestamp = message_columns["timestamp"]
+    starts = conversation_start_column()
+
+    # compare every message with the one before it, all at once
+    is_reply = np.zeros(len(thread), dtype=bool)
+    is_reply[1:] = (thread[1:] == thread[:-1]) & (sender[1:] != sender[:-1]) & ~starts[1:]
+    replies = np.flatnonzero(is_reply)
+    return {"message": replies,
+            "thread": thread[replies],
+            "sender": sender[replies],
+            "latency": timestamp[replies] - timestamp[replies - 1]}
+
+
+# reply times per member, as quantile sketches (see sketches.QuantileSketch), so the memory does not grow with the
+# number of replies. the sketches are filled from the reply_latencies columns with one np.unique per grouping.
+# returns {"per_member": {member: sketch}, "per_thread": {thread index: {member: sketch}}, "monthly": {date: {member: sketch}}}
+def response_time_statistics(relative_accuracy = 0.01):
+    import numpy as np
+    replies = reply_latencies()
+    prototype = sketches.QuantileSketch(relative_accuracy)
+    latency = replies["latency"].astype(np.float64)
+    keys = np.full(len(latency), prototype.zero_key, dtype=np.int64)
+    counted = latency >= prototype.min_value
+    keys[counted] = np.ceil(np.log(latency[counted]) / prototype.log_gamma).astype(np.int64)
+    sender = replies["sender"].astype(np.int64)
+    months = (message_columns["local_time"][replies["message"]] // (24 * 60 * 60)).astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+    def sketches_by(groups):
+        # the distinct (group, member, bucket) triples and how many replies each has
+        triples, counts = np.unique(np.stack([groups, sender, keys]), axis=1, return_counts=True)
+        result = {}
+        for (group, member, key), count in zip(triples.T.tolist(), counts.tolist()):
+            by_member = result.setdefault(group, {})
+            name = member_names[member]
+            if name not in by_member:
+                by_member[name] = sketches.QuantileSketch(relative_accuracy)
+            by_member[name].add_keys([key], [count])
+        return result
+
+    statistics = {}
+    statistics["per_member"] = sketches_by(np.zeros(len(sender), dtype=np.int64)).get(0, {})
+    statistics["per_thread"] = sketches_by(replies["thread"].astype(np.int64))
+    statistics["monthly"] = {add_months(epoch.date(), month): by_member for month, by_member in sketches_by(months).items()}
+    return statistics
+
+
+# the number of replies, and the median and 90th percentile reply time in seconds, of a reply time sketch
+def response_time_summary(sketch):
+    return {"replies": sketch.count, "median": sketch.quantile(0.5), "p90": sketch.quantile(0.9)}
+
+
+# when in the week the messages are sent: the number of messages (or words, with metric="words") per weekday
+# and hour of the day in local time, or per quarter hour with slots_per_hour=4
+# returns {"global": 7 x slots, "per_member": members x 7 x slots, "per_thread": threads x 7 x slots} numpy arrays,
+# where slots is 24 * slots_per_hour, indexed by member id and thread index, and monday is day 0
+# everything is counted with one np.bincount, over the thread and member pairs that have messages
+def activity_heatmaps(slots_per_hour = 1, metric = "messages"):
+    import numpy as np
+    if message_columns is None:
+        build_message_columns()
+    seconds_per_day = 24 * 60 * 60
+    slots_per_day = 24 * slots_per_hour
+    slots = 7 * slots_per_day
+
+    local_time = message_columns["local_time"]
+    days = local_time // seconds_per_day
+    # 1970-01-01, day 0, was a thursday
+    weekday = (days + 3) % 7
+    slot = weekday * slots_per_day + (local_time - days * seconds_per_day) // (seconds_per_day // slots_per_day)
+
+    member_count = len(member_names)
+    pairs, pair = np.unique(message_columns["thread"].astype(np.int64) * member_count + message_columns["sender"], return_inverse=True)
+    weights = message_columns["words"] if metric == "words" else None
+    counts = np.bincount(pair * slots + slot, weights=weights, minlength=len(pairs) * slots).astype(np.int64).reshape(len(pairs), slots)
+
+    per_member = np.zeros((member_count, slots), dtype=np.int64)
+    per_thread = np.zeros((len(threads), slots), dtype=np.int64)
+    np.add.at(per_member, pairs % member_count, counts)
+    np.add.at(per_thread, pairs // member_count, counts)
+    return {"global": counts.sum(axis=0).reshape(7, slots_per_day),
+            "per_member": per_member.reshape(member_count, 7, slots_per_day),
+            "per_thread": per_thread.reshape(len(threads), 7, slots_per_day)}
+
+
+# save the heatmaps of activity_heatmaps as arrays in a .npz file, together with the member names and thread titles
+def export_heatmaps(filename, slots_per_hour = 1, metric = "messages"):
+    import numpy as np
+    heatmaps = activity_heatmaps(slots_per_hour, metric)
+    np.savez_compressed(filename, members=np.array(member_names), titles=np.array([thread["title"] for thread in threads]), **heatmaps)
+
+
+# who replies to whom: every reply (see reply_latencies) is an edge from the member who replied
+# to the sender of the message before it, in the same conversation
+# returns the edges as columns "thread", "source" and "target" (member ids) and "count", the number of replies,
+# with one row per distinct edge in a thread, sorted by thread, source and target
+def reply_edges():
+    import numpy as np
+    replies = reply_latencies()
+    member_count = len(member_names)
+    source = replies["sender"].astype(np.int64)
+    target = message_columns["sender"][replies["message"] - 1].astype(np.int64)
+    keys, counts = np.unique((replies["thread"].astype(np.int64) * member_count + source) * member_count + target, return_counts=True)
+    return {"thread": (keys // (member_count * member_count)).astype(np.int32),
+            "source": (keys // member_count % member_count).astype(np.int32),
+            "target": (keys % member_count).astype(np.int32),
+            "count": counts.astype(np.int64)}
+
+
+# the edges of all threads merged into one social graph, with columns "source", "target" and "count"
+def global_reply_edges(edges):
+    import numpy as np
+    member_count = len(member_names)
+    keys, edge = np.unique(edges["source"].astype(np.int64) * member_count + edges["target"], return_inverse=True)
+    return {"source": (keys // member_count).astype(np.int32),
+            "target": (keys % member_count).astype(np.int32),
+            "count": np.bincount(edge, weights=edges["count"], minlength=len(keys)).astype(np.int64)}
+
+
+# groups with more members than this get a sparse reply matrix, if scipy is installed
+dense_reply_matrix_limit = 256
+
+def has_scipy():
+    try:
+        import scipy.sparse
+    except ImportError:
+        return False
+    return True
+
+
+# the reply counts of edges as a members x members matrix, where row i and column j count the replies of
+# members[i] to members[j]. members is a list of member ids, and defaults to every member in the edges.
+# returns (members, matrix). the matrix is a scipy.sparse csr matrix for big groups, and a numpy array otherwise.
+def reply_matrix(edges, members = None):
+    import numpy as np
+    if members is None:
+        members = np.union1d(edges["source"], edges["target"]).tolist()
+    row_of = np.full(len(member_names), -1, dtype=np.int64)
+    row_of[members] = np.arange(len(members))
+    rows = row_of[edges["source"]]
+    columns = row_of[edges["target"]]
+    # edges of members that are not in members are left out
+    kept = (rows >= 0) & (columns >= 0)
+    if len(members) > dense_reply_matrix_limit and has_scipy():
+        import scipy.sparse
+        matrix = scipy.sparse.coo_matrix((edges["count"][kept], (rows[kept], columns[kept])), shape=(len(members), len(members)))
+        return members, matrix.tocsr()
+    matrix = np.zeros((len(members), len(members)), dtype=np.int64)
+    np.add.at(matrix, (rows[kept], columns[kept]), edges["count"][kept])
+    return members, matrix
+
+
+# the reply matrix of every thread, over the members of the thread and everyone else who replied in it
+# returns a dictionary from thread index to (member names, matrix), see reply_matrix
+def thread_reply_matrices(edges = None):
+    if edges is None:
+        edges = reply_edges()
+    bounds = edges["thread"].searchsorted(range(len(threads) + 1))
+    result = {}
+    for thread in threads:
+        first, last = bounds[thread["index"]], bounds[thread["index"] + 1]
+        thread_edges = {name: column[first:last] for name, column in edges.items()}
+        members = [member_ids[member] for member in unique_members(thread)]
+        members += sorted(set(thread_edges["source"].tolist() + thread_edges["target"].tolist()) - set(members))
+        members, matrix = reply_matrix(thread_edges, members)
+        result[thread["index"]] = ([member_names[member] for member in members], matrix)
+    return result
+
+
+# write the reply graph as edge lists to directory: reply_edges.csv with the edges of every thread,
+# and reply_graph.csv with the global graph. the members are written by name.
+def export_reply_graph(directory):
+    import csv
+    edges = reply_edges()
+    graph = global_reply_edges(edges)
+    os.makedirs(directory, exist_ok = True)
+    with open(os.path.join(directory, "reply_edges.csv"), "w", newline = "", encoding = "utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["thread", "title", "source", "target", "count"])
+        for thread, source, target, count in zip(edges["thread"].tolist(), edges["source"].tolist(), edges["target"].tolist(), edges["count"].tolist()):
+            writer.writerow([thread, threads[thread]["title"], member_names[source], member_names[target], count])
+    with open(os.path.join(directory, "reply_graph.csv"), "w", newline = "", encoding = "utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "target", "count"])
+        for source, target, count in zip(graph["source"].tolist(), graph["target"].tolist(), graph["count"].tolist()):
+            writer.writerow([member_names[source], member_names[target], count])
+
+
+# the contents of all messages in a memory-mapped file, see content_buffer.py
+message_contents = None
+
+# A message whose content is decoded from message_contents every time it is used, instead of being kept as a string
+# The scanners below look at the bytes in the buffer instead, so that they do not decode it at all
+class MappedMessage(dict):
+
+    def __missing__(self, key):
+        if key == "content":
+            return message_contents.content(self["content_number"])
+        raise KeyError(key)
+
+
+# the number of words in a message, len(message["content"].split())
+def message_words(message):
+    if isinstance(message, MappedMessage):
+        return message_contents.words(message["content_number"])
+    return len(message["content"].split())
+
+# needle in message["content"]
+def content_contains(message, needle):
+    if isinstance(message, MappedMessage):
+        return message_contents.contains(message["content_number"], needle.encode("utf-8"))
+    return needle in message["content"]
+
+# needle in message["content"].lower(), where needle is in lowercase
+def content_contains_lower(message, needle):
+    if isinstance(message, MappedMessage):
+        return message_contents.contains_lower(message["content_number"], needle)
+    return needle in message["content"].lower()
+
+
+# write the contents of all messages to the memory-mapped file filename, and let the messages read them from there
+# the messages are numbered in order, so sort them before this
+def map_message_contents(filename):
+    content_buffer.write(filename, threads)
+    open_message_contents(filename)
+
+
+# let the messages read their contents from an already written content buffer, for the same threads
+# the messages of lazy threads that are not loaded are mapped when they are loaded, so opening the buffer reads no messages
+def open_message_contents(filename):
+    global message_contents
     global threads
+    message_contents = content_buffer.ContentBuffer(filename)
+    if message_contents.thread_count() != len(threads) or \
+            any(message_contents.thread_message_count(thread["index"]) != thread["message_count"] for thread in threads):
+        raise ValueError(filename + " was written for other threads")
     for thread in threads:
+        if isinstance(thread, LazyThread) and not thread.is_loaded():
+            continue
+        map_messages(thread["index"], thread["messages"])
+        # the conversations refer to the old messages, which would keep their contents in memory
+        if dict.__contains__(thread, "conversations"):
+            thread["conversations"] = thread_conversations(thread["messages"])
+
+
+# replace the messages of the thread with index t by mapped messages, without their contents
+def map_messages(t, messages):
+    first = message_contents.message_number(t, 0)
+    for i, message in enumerate(messages):
+        mapped = MappedMessage(message)
+        mapped.pop("content", None)
+        mapped["content_number"] = first + i
+        messages[i] = mapped
+
+
+def days_since_epoch(d):
+    return (d - epoch.date()).days
+
+
+# cumulative sums of the messages and words per thread and member on the global day axis (see range_index.py)
+range_index = None
+
+def build_range_index():
+    import range_index as range_index_module
+    global range_index
+    if message_columns is None:
+        build_message_columns()
+    range_index = range_index_module.RangeIndex(message_columns["thread"], message_columns["sender"], message_columns["local_time"],
+                                                message_columns["words"], len(threads), len(member_names))
+    return range_index
+
+
+# the messages or words from start to end (dates, end not included, None for no limit),
+# in a thread (index) and of a member (name), or of all of them if they are None
+# e.g. range_sum("words", date(2016, 1, 1), date(2017, 1, 1), thread = 3, member = setup.user)
+def range_sum(metric, start = None, end = None, thread = None, member = None):
+    if range_index is None:
+        build_range_index()
+    return range_index.sum(metric, None if start is None else days_since_epoch(start), None if end is None else days_since_epoch(end),
+                           thread, None if member is None else member_ids.get(member, -1))
+
+
+# the n threads with the most messages or words from start to end, of member if it is given,
+# as (thread, sum) pairs with the most first
+def top_threads_between(metric, start = None, end = None, n = 10, member = None):
+    if range_index is None:
+        build_range_index()
+    top = range_index.top_threads(metric, None if start is None else days_since_epoch(start), None if end is None else days_since_epoch(end),
+                                  n, None if member is None else member_ids.get(member, -1))
+    return [(threads[thread], total) for thread, total in top]
+
+
+# the messages and words per member and thread in quarter hours (or minutes, with resolution = 60) of UTC time,
+# which the counts for any timezone and day start are derived from (see time_histogram.py)
+time_histogram = None
+
+def build_time_histogram(resolution = 15 * 60):
+    import time_histogram as time_histogram_module
+    global time_histogram
+    if message_columns is None:
+        build_message_columns()
+    time_histogram = time_histogram_module.build(message_columns["thread"], message_columns["sender"], message_columns["timestamp"],
+                                                 message_columns["words"], len(member_names), resolution)
+    return time_histogram
+
+
+# the messages and words per member of every thread per day, week, month or year, in timezone (None for the timezone
+# of this machine, hours east of UTC, or a name like "Europe/Stockholm") with the days starting day_start hours after midnight
+# returns a dictionary from thread index to {date: bucket}, with a bucket for every period from the first to the last
+# message of the thread, where each bucket has "messages_per_member" and "words_per_member", like in time_data
+def rebinned_time_data(interval = "daily", timezone = None, day_start = 0):
+    import numpy as np
+    from time_histogram import period_numbers
+    from time_histogram import period_dates
+    if time_histogram is None:
+        build_time_histogram()
+    rows = time_histogram.rebin(interval, timezone, day_start)
+    bounds = rows["thread"].searchsorted(range(len(threads) + 1))
+    # the dates are the first days of their periods, so they are numbered by the period they start
+    periods = period_numbers(rows["date"].astype(np.int64), interval)
+
+    result = {}
+    for thread in threads:
+        first, last = bounds[thread["index"]], bounds[thread["index"] + 1]
+        if first == last:
+            continue
         members = thread["members"]
-        messages = thread["messages"]
-        # create conversations
-        # each conversation is a dictionary with a "members" list and a sorted "messages" list
-        conversations = []
-        for message in messages:
-            last_conversation = None
-            if len(conversations) > 0:
-                last_conversation = conversations[len(conversations)-1]
-            if starts_conversation(message, last_conversation):
-                new_conversation = {"members": [message["sender"]], "messages": [message]}
-                conversations.append(new_conversation)
-            else:
-                if message["sender"] not in conversations[len(conversations)-1]["members"]:
-                    conversations[len(conversations)-1]["members"].append(message["sender"])
-                conversations[len(conversations)-1]["messages"].append(message)
+        thread_periods = periods[first:last]
+        first_period = int(thread_periods.min())
+        dates = period_dates(np.arange(first_period, int(thread_periods.max()) + 1), interval).tolist()
+        thread_data = {d: {"messages_per_member": {member: 0 for member in members},
+                           "words_per_member": {member: 0 for member in members}} for d in dates}
+        for row, member, messages, words in zip((thread_periods - first_period).tolist(), rows["member"][first:last].tolist(),
+                                                rows["messages"][first:last].tolist(), rows["words"][first:last].tolist()):
+            bucket = thread_data[dates[row]]
+            # like in time_data, only the messages of the members of the thread are counted
+            if member_names[member] in bucket["messages_per_member"]:
+                bucket["messages_per_member"][member_names[member]] += messages
+                bucket["words_per_member"][member_names[member]] += words
+        result[thread["index"]] = thread_data
+    return result
+
+
+# the normalized tables that export_columnar writes
+# each table is a dictionary of columns, which are numpy arrays or lists of strings
+def columnar_tables():
+    import numpy as np
+    global threads
+
+    if message_columns is None:
+        build_message_columns()
+
+    tables = {}
+
+    tables["messages"] = dict(message_columns)
+    tables["messages"]["content"] = [message["content"] for thread in threads for message in thread["messages"]]
+
+    tables["threads"] = {
+        "thread": np.array([thread["index"] for thread in threads], dtype=np.int32),
+        "title": [thread["title"] for thread in threads],
+        "first_message": np.array([thread["first_message"] for thread in threads], dtype=np.int64),
+        "message_count": np.array([len(thread["messages"]) for thread in threads], dtype=np.int64),
+    }
+
+    tables["reactions"] = dict(reaction_columns)
+    tables["reaction_types"] = {
+        "reaction": np.arange(len(reaction_names), dtype=np.int32),
+        "name": list(reaction_names),
+    }
+
+    tables["members"] = {
+        "member": np.arange(len(member_names), dtype=np.int32),
+        "name": list(member_names),
+    }
+
+    # a member that the thread lists twice (like the user, when the export also lists them as a participant) gets one row
+    thread_members = [(thread["index"], member_ids[member]) for thread in threads for member in unique_members(thread)]
+    tables["thread_members"] = {
+        "thread": np.array([t for t, m in thread_members], dtype=np.int32),
+        "member": np.array([m for t, m in thread_members], dtype=np.int32),
+    }
+
+    # the daily and monthly aggregates, one row per thread, date and member
+    for interval, metrics in (("daily", ["messages_per_member", "words_per_member"]),
+                              ("monthly", ["messages_per_member", "words_per_member", "emoji_per_member"])):
+        rows = []
+        for thread in threads:
+            if "time_data" not in thread:
+                continue
+            members = unique_members(thread)
+            for d, bucket in thread["time_data"][interval].items():
+                for member in members:
+                    rows.append([thread["index"], days_since_epoch(d), member_ids[member]] + [bucket[metric][member] for metric in metrics])
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 3 + len(metrics))
+        tables[interval] = {
+            "thread": rows[:, 0].astype(np.int32),
+            "date": rows[:, 1].astype(np.int32),
+            "member": rows[:, 2].astype(np.int32),
+        }
+        for i, metric in enumerate(metrics):
+            tables[interval][metric[:-len("_per_member")]] = rows[:, 3 + i]
+
+    return tables
+
+
+# export the messages and the time interval data as compressed columnar files in directory
+# file_format is "parquet", "arrow" or "npz". parquet and arrow need pyarrow, npz only needs numpy.
+# by default, parquet is used if pyarrow is installed and npz otherwise
+def export_columnar(directory, file_format = None):
+    return columnar_export.write_tables(columnar_tables(), directory, file_format)
+
+
+
+
+
+
 
+
+
+
+
+# Create conversations
+def create_conversations():
+    global threads
+    for thread in threads:
         # finally, add the conversations to the thread
-        thread["conversations"] = conversations
+        thread["conversations"] = thread_conversations(thread["messages"])
+
+
+# create conversations
+# each conversation is a dictionary with a "members" list and a sorted "messages" list
+def thread_conversations(messages):
+    conversations = []
+    for message in messages:
+        last_conversation = None
+        if len(conversations) > 0:
+            last_conversation = conversations[len(conversations)-1]
+        if starts_conversation(message, last_conversation):
+            new_conversation = {"members": [message["sender"]], "messages": [message]}
+            conversations.append(new_conversation)
+        else:
+            if message["sender"] not in conversations[len(conversations)-1]["members"]:
+                conversations[len(conversations)-1]["members"].append(message["sender"])
+            conversations[len(conversations)-1]["messages"].append(message)
+    return conversations
 
 
 
@@ -634,6 +2091,112 @@ def print_threads():
         #break
 
 
+# the command line interface, with a subcommand for each thing to do:
+#   load    read an export, and store it in the database if one is given
+#   stats   print statistics per member
+#   export  write the time interval data as csv, the messages as columnar files, or the reply graph as edge lists
+#   plot    plot words or messages per thread
+# every subcommand reads the threads from the export if it is given, and otherwise from the database,
+# and only does the stages it needs. matplotlib is only imported by plot.
+# with just a directory, like before, everything is done by main
+commands = ["load", "stats", "export", "plot"]
+
+def argument_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description="Analyze a Facebook Messenger export (json format).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, help):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument("messages_directory", nargs="*", help="the messages/inbox directory of the export, or its zip archives")
+        subparser.add_argument("--database", default=getattr(setup, "database", None), help="sqlite database to store the threads in, or read them from")
+        return subparser
+
+    add_command("load", "read an export, and store it in the database")
+
+    stats = add_command("stats", "print statistics per member")
+    stats.add_argument("--top", type=int, default=10, help="number of top words to print per member")
+
+    export = add_command("export", "export the data")
+    export.add_argument("--csv", metavar="DIRECTORY", help="write the time interval data as csv files to this directory")
+    export.add_argument("--intervals", nargs="+", choices=csv_export.intervals, default=csv_export.intervals)
+    export.add_argument("--columnar", metavar="DIRECTORY", help="write the messages and time interval data as columnar files to this directory")
+    export.add_argument("--format", choices=columnar_export.formats, help="format of the columnar files")
+    export.add_argument("--reply-graph", metavar="DIRECTORY", help="write who replies to whom as edge lists to this directory")
+
+    plot = add_command("plot", "plot words or messages per thread")
+    plot.add_argument("--metric", choices=["words", "messages"], default="words")
+    plot.add_argument("--threshold", type=int, default=2000, help="only plot threads where the user has sent at least this many")
+    plot.add_argument("--moving-average", type=int, default=80)
+    plot.add_argument("--stackplot", action="store_true")
+    plot.add_argument("--output", default=getattr(setup, "plot_file", None), help="render the plot to this file instead of showing it")
+    return parser
+
+
+def load_for_command(args):
+    if len(args.messages_directory) > 1:
+        # the zip archives of a split export
+        load_data(args.messages_directory, args.database)
+    elif len(args.messages_directory) == 1:
+        load_data(args.messages_directory[0], args.database)
+    elif args.database != None:
+        load_data_from_database(args.database, getattr(setup, "content_buffer", None))
+    else:
+        raise SystemExit("give a messages directory or a database")
+    sort_messages()
+
+
+def print_member_statistics(top):
+    for statistics in sorted(global_member_statistics.values(), key = lambda statistics: -statistics["messages"]):
+        print(statistics["name"] + ": " + str(statistics["messages"]) + " messages, " + str(statistics["words"]) + " words, "
+              + str(statistics["threads"]) + " threads, " + str(statistics["conversations_started"]) + " conversations started, "
+              + str(statistics["distinct_words"]) + " distinct words, " + "%.4f" % statistics["emoji_per_word"] + " emoji per word")
+        if top > 0:
+            print("    " + ", ".join(word + " (" + str(count) + ")" for word, count in statistics["top_words"][:top]))
+
+
+def cli(argv):
+    args = argument_parser().parse_args(argv)
+
+    if args.command == "stats" and len(args.messages_directory) == 0 and args.database != None:
+        # the totals can be counted by the database itself, without loading any messages
+        conn = message_database.connect(args.database)
+        for name, thread_count, message_count, word_count in message_database.member_totals(conn):
+            print(name + ": " + str(message_count) + " messages, " + str(word_count) + " words, " + str(thread_count) + " threads")
+        conn.close()
+        return
+
+    load_for_command(args)
+    if args.command == "load":
+        print("loaded " + str(sum(len(thread["messages"]) for thread in threads)) + " messages in " + str(len(threads)) + " threads")
+        return
+
+    create_conversations()
+    if args.command == "stats":
+        calculate_meta_data()
+        generate_time_interval_data()
+        generate_global_member_statistics()
+        print_member_statistics(args.top)
+    elif args.command == "export":
+        generate_time_interval_data()
+        if args.csv != None:
+            csv_export_all_interval_data(args.csv, args.intervals)
+        if args.columnar != None:
+            export_columnar(args.columnar, args.format)
+        if args.reply_graph != None:
+            export_reply_graph(args.reply_graph)
+    elif args.command == "plot":
+        generate_global_time_data()
+        show_arvid_per_thread(args.metric, threshold=args.threshold, movingaverage=args.moving_average,
+                              stackplot=args.stackplot, filename=args.output)
+
+
 import sys
 if __name__ == "__main__":
-    main(sys.argv[1]) 
+    if len(sys.argv) > 1 and (sys.argv[1] in commands or sys.argv[1].startswith("-")):
+        cli(sys.argv[1:])
+    elif len(sys.argv) > 2:
+        # the zip archives of a split export
+        main(sys.argv[1:])
+    else:
+        main(sys.argv[1]) 
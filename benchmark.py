@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# Benchmarks every stage of the three analysis pipelines on synthetic exports of different sizes
+# The exports are made by generate_synthetic_export.py, and kept in the work directory between runs
+
+# Each pipeline runs in its own process, so that the peak memory use (peak RSS) of one does not hide another.
+# The peak RSS is recorded after every stage, so a jump shows which stage needed the memory.
+
+# Example: ./benchmark.py --sizes 10000 1000000 --versions v2 v3 --json bench.json
+# With --sketch-accuracy, the approximate word counts of sketches.py are compared with the exact ones instead,
+# on exports with a vocabulary of sketch_vocabulary zipf distributed words, and the benchmark fails if the error bounds
+# documented in sketches.py do not hold.
+# With --startup, the time of a stats query on the database (the cached data) is measured instead,
+# and the benchmark fails if it is slower than startup_target.
+
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+
+import generate_synthetic_export
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+# the name of the owner of the synthetic exports
+benchmark_user = "Benchmark User"
+
+# seconds that "analyze_messenger_v3_json.py stats --database" may take, from starting python until it is done
+startup_target = 0.5
+startup_runs = 5
+
+# number of distinct words in the exports that --sketch-accuracy uses, far more than a sketch keeps
+sketch_vocabulary = 50000
+# how many standard errors the estimated number of distinct words may be off
+distinct_standard_errors = 3
+
+modules = {"v1": "analyze_messenger", "v2": "analyze_messenger_v2", "v3": "analyze_messenger_v3_json"}
+
+
+# peak resident memory of this process so far, in bytes
+def peak_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    if sys.platform == "darwin":
+        return usage
+    return usage * 1024
+
+
+def parse_html_file(module, filename):
+    parser = module.MessengerParser()
+    parser.convert_charrefs = True
+    with open(filename, "r") as messages_file:
+        parser.feed(messages_file.read())
+
+
+def parse_html_directory(module, directory):
+    parser = module.MessengerParser()
+    parser.convert_charrefs = True
+    for filename in os.listdir(directory):
+        if not filename.endswith(".html"):
+            continue
+        with open(os.path.join(directory, filename), "r") as messages_file:
+            parser.feed(messages_file.read())
+
+
+# the stages of main() in each version, as (name, function) tuples
+def pipeline_stages(version, module, path):
+    if version == "v1":
+        return [("parse", lambda: parse_html_file(module, path)),
+                ("group_threads", module.group_threads),
+                ("sort_messages", module.sort_messages),
+                ("create_conversations", module.create_convos),
+                ("calculate_meta_data", module.calculate_meta_data),
+                ("generate_time_interval_data", module.generate_time_interval_data)]
+    if version == "v2":
+        parse = ("parse", lambda: parse_html_directory(module, path))
+    else:
+        parse = ("load_data", lambda: module.load_data(path))
+    return [parse,
+            ("sort_messages", module.sort_messages),
+            ("create_conversations", module.create_conversations),
+            ("calculate_meta_data", module.calculate_meta_data),
+            ("generate_time_interval_data", module.generate_time_interval_data),
+            ("generate_global_time_data", module.generate_global_time_data)]
+
+
+# runs one pipeline in this process and prints the results as json. setup_directory holds the setup.py to use.
+def run_pipeline(version, path, setup_directory):
+    sys.path.insert(0, setup_directory)
+    sys.path.insert(1, script_directory)
+    import importlib
+    module = importlib.import_module(modules[version])
+
+    import instrumentation
+    instrumentation.reset()
+    for name, stage in pipeline_stages(version, module, path):
+        with instrumentation.stage(name):
+            stage()
+            instrumentation.message_count = sum(len(thread["messages"]) for thread in module.threads)
+        instrumentation.stages[-1]["peak_rss"] = peak_rss()
+    print(json.dumps(instrumentation.report()))
+
+
+# compares the approximate word counts (setup.approximate_word_counts, see sketches.py) with the exact ones,
+# on a v3 export, and prints the errors and the bounds that do not hold as json. the bounds are, for every member:
+#   count-min     no count is too low, and at most e^-depth of the words are more than e/width * N too high
+#   hyperloglog   the number of distinct words is off by at most distinct_standard_errors standard errors
+#   space-saving  every word of the exact top 10 whose count is more than N/capacity above the 11th is in the approximate top 10
+def run_sketch_accuracy(path, setup_directory):
+    sys.path.insert(0, setup_directory)
+    sys.path.insert(1, script_directory)
+    import setup
+    module = __import__(modules["v3"])
+    module.load_data(path)
+    module.sort_messages()
+    module.create_conversations()
+
+    statistics = {}
+    for approximate in (False, True):
+        setup.approximate_word_counts = approximate
+        module.calculate_meta_data()
+        module.generate_time_interval_data()
+        module.generate_global_member_statistics()
+        statistics[approximate] = module.global_member_statistics
+
+    result = {"members": 0, "max_distinct": 0, "max_distinct_error": 0, "max_count_error": 0, "max_over_bound_fraction": 0,
+              "min_top_overlap": 1, "failures": []}
+    for member, exact in statistics[False].items():
+        if exact["words"] == 0:
+            continue
+        sketch = statistics[True][member]["word_counts"]
+        name = exact["name"]
+        words = sketch.total()
+        result["members"] += 1
+        result["max_distinct"] = max(result["max_distinct"], exact["distinct_words"])
+
+        # relative error of the number of distinct words
+        distinct_error = abs(sketch.distinct_count() - exact["distinct_words"]) / exact["distinct_words"]
+        result["max_distinct_error"] = max(result["max_distinct_error"], distinct_error)
+        distinct_bound = distinct_standard_errors * 1.04 / math.sqrt(len(sketch.distinct.registers))
+        if distinct_error > distinct_bound:
+            result["failures"].append("%s: %d distinct words estimated as %d" % (name, exact["distinct_words"], sketch.distinct_count()))
+
+        # how much too high the count-min counts are, as a fraction of the words of the member
+        errors = [sketch.count(word) - count for word, count in exact["word_counts"].items()]
+        result["max_count_error"] = max(result["max_count_error"], max(errors) / words)
+        if min(errors) < 0:
+            result["failures"].append("%s: a count-min count is too low" % name)
+        over_bound = sum(1 for error in errors if error > math.e / sketch.counts.width * words) / len(errors)
+        result["max_over_bound_fraction"] = max(result["max_over_bound_fraction"], over_bound)
+        if over_bound > math.exp(-sketch.counts.depth):
+            result["failures"].append("%s: %.2f%% of the count-min counts are too high" % (name, 100 * over_bound))
+
+        # the fraction of the exact top 10 words that are also in the approximate top 10
+        exact_top = set(word for word, count in exact["top_words"][:10])
+        approximate_top = set(word for word, count in sketch.top(10))
+        result["min_top_overlap"] = min(result["min_top_overlap"], len(exact_top & approximate_top) / len(exact_top))
+        eleventh = exact["top_words"][10][1] if len(exact["top_words"]) > 10 else 0
+        for word, count in exact["top_words"][:10]:
+            if count - eleventh > words / sketch.top_words.capacity and word not in approximate_top:
+                result["failures"].append("%s: %s is missing from the approximate top 10" % (name, word))
+    print(json.dumps(result))
+
+
+# generate the export for a size, unless it is already there
+# with vocabulary, the export has that many distinct words instead of the small default vocabulary
+def prepare_export(workdir, size, threads, versions, vocabulary = None):
+    directory = os.path.join(workdir, str(size) if vocabulary is None else str(size) + "-" + str(vocabulary) + "-words")
+    marker = os.path.join(directory, "complete")
+    if not os.path.exists(marker):
+        arguments = [directory, "--user", benchmark_user, "--threads", str(threads), "--messages", str(max(1, size // threads))]
+        if vocabulary is not None:
+            arguments += ["--vocabulary", str(vocabulary)]
+        args = generate_synthetic_export.argument_parser().parse_args(arguments + ["--formats"] + sorted(versions))
+        print("generating " + str(size) + " messages in " + directory, file=sys.stderr)
+        generate_synthetic_export.generate(args)
+        with open(marker, "w") as f:
+            f.write(" ".join(sorted(versions)))
+    with open(os.path.join(workdir, "setup.py"), "w") as f:
+        f.write("debug = False\nuser = " + repr(benchmark_user) + "\nnames_per_id = {}\n")
+    return directory
+
+
+def benchmark(version, path, workdir):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", version, path, workdir],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    # the scripts may print things of their own, the results are on the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def sketch_accuracy(path, workdir):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-sketch-accuracy", path, workdir],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# the median time of running the v3 command line with args, in a fresh python process
+def command_seconds(args, workdir, runs):
+    import time
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.path.abspath(workdir)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(script_directory, modules["v3"] + ".py")] + args,
+                       check=True, stdout=subprocess.DEVNULL, env=environment)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+# loads a v3 export into a database, and measures how long a stats query on that database takes to start and finish
+def startup(path, workdir):
+    database = os.path.join(workdir, "startup.sqlite")
+    command_seconds(["load", path, "--database", database], workdir, 1)
+    return {"stats_seconds": command_seconds(["stats", "--database", database], workdir, startup_runs),
+            "target": startup_target}
+
+
+def print_results(results):
+    print("%-4s %10s  %-28s %10s %10s %12s %10s" % ("", "messages", "stage", "seconds", "cpu", "messages/s", "peak MB"))
+    for result in results:
+        for stage in result["stages"]:
+            rate = result["messages"] / stage["seconds"] if stage["seconds"] > 0 else float("inf")
+            print("%-4s %10d  %-28s %10.3f %10.3f %12.0f %10.1f" % (result["version"], result["messages"], stage["stage"],
+                  stage["seconds"], stage["cpu_seconds"], rate, stage["peak_rss"] / 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipelines on synthetic exports.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000, 10000000], help="total number of messages")
+    parser.add_argument("--threads", type=int, default=20, help="number of threads in each export")
+    parser.add_argument("--versions", nargs="+", choices=sorted(modules), default=sorted(modules))
+    parser.add_argument("--workdir", default="benchmark_data", help="directory for the generated exports")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--sketch-accuracy", action="store_true", help="compare the approximate word counts with the exact ones on the v3 exports, instead of timing the pipelines")
+    parser.add_argument("--startup", action="store_true", help="measure the startup time of a stats query on the v3 database, instead of timing the pipelines")
+    parser.add_argument("--run-sketch-accuracy", nargs=2, metavar=("PATH", "SETUP_DIRECTORY"), help=argparse.SUPPRESS)
+    parser.add_argument("--run", nargs=3, metavar=("VERSION", "PATH", "SETUP_DIRECTORY"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_pipeline(*args.run)
+        return
+    if args.run_sketch_accuracy:
+        run_sketch_accuracy(*args.run_sketch_accuracy)
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = []
+    for size in args.sizes:
+        directory = prepare_export(args.workdir, size, args.threads, args.versions, sketch_vocabulary if args.sketch_accuracy else None)
+        if args.startup and "v3" in args.versions:
+            results.append(startup(generate_synthetic_export.input_path(directory, "v3"), args.workdir))
+            results[-1]["size"] = size
+            print("%d messages: stats on the database took %.3f s (target %.3f s)" % (size, results[-1]["stats_seconds"], startup_target))
+            continue
+        if args.sketch_accuracy and "v3" in args.versions:
+            results.append(sketch_accuracy(generate_synthetic_export.input_path(directory, "v3"), args.workdir))
+            results[-1]["size"] = size
+            print(json.dumps(results[-1]))
+            continue
+        for version in args.versions:
+            result = benchmark(version, generate_synthetic_export.input_path(directory, version), args.workdir)
+            result["version"] = version
+            result["size"] = size
+            results.append(result)
+            print_results([result])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.startup and any(result["stats_seconds"] > startup_target for result in results):
+        sys.exit("the stats query was slower than the target of " + str(startup_target) + " seconds")
+    if args.sketch_accuracy and any(len(result["failures"]) > 0 for result in results):
+        sys.exit("the approximate word counts were outside their error bounds:\n" +
+                 "\n".join(failure for result in results for failure in result["failures"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Columnar export of the analysed data, so that it can be loaded without rerunning the analysis
+# The tables are dictionaries of columns, see columnar_tables in analyze_messenger_v3_json.py
+
+# Three file formats are supported:
+#   "parquet" - one compressed .parquet file per table (needs pyarrow)
+#   "arrow"   - one compressed Arrow IPC (feather) file per table (needs pyarrow)
+#   "npz"     - one compressed numpy .npz file per table (only needs numpy)
+
+# In npz files, string columns are stored as their concatenated UTF-8 bytes in "<column>"
+# together with the start offsets of every string in "<column>_offsets". read_npz_table decodes them again.
+
+import os
+
+formats = ["parquet", "arrow", "npz"]
+
+# columns that hold days since epoch, and are stored as dates by pyarrow
+date_columns = {"date"}
+
+compression = "zstd"
+
+
+def has_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def default_format():
+    if has_pyarrow():
+        return "parquet"
+    return "npz"
+
+
+def is_string_column(column):
+    return isinstance(column, list)
+
+
+def arrow_table(columns):
+    import pyarrow as pa
+    arrays = {}
+    for name, column in columns.items():
+        if is_string_column(column):
+            arrays[name] = pa.array(column, type=pa.string())
+        elif name in date_columns:
+            arrays[name] = pa.array(column).cast(pa.date32())
+        else:
+            arrays[name] = pa.array(column)
+    return pa.table(arrays)
+
+
+def write_parquet(columns, filename):
+    import pyarrow.parquet as pq
+    pq.write_table(arrow_table(columns), filename, compression=compression)
+
+
+def write_arrow(columns, filename):
+    import pyarrow.feather as feather
+    feather.write_feather(arrow_table(columns), filename, compression=compression)
+
+
+def write_npz(columns, filename):
+    import numpy as np
+    arrays = {}
+    for name, column in columns.items():
+        if is_string_column(column):
+            encoded = [s.encode("utf-8") for s in column]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            np.cumsum([len(b) for b in encoded], out=offsets[1:])
+            arrays[name] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+            arrays[name + "_offsets"] = offsets
+        else:
+            arrays[name] = column
+    np.savez_compressed(filename, **arrays)
+
+
+writers = {"parquet": (write_parquet, ".parquet"),
+           "arrow": (write_arrow, ".arrow"),
+           "npz": (write_npz, ".npz")}
+
+
+# write every table to <directory>/<table name>.<extension>, and return the filenames
+def write_tables(tables, directory, file_format = None):
+    if file_format is None:
+        file_format = default_format()
+    if file_format not in writers:
+        raise ValueError("file format must be one of " + ", ".join(formats))
+    if file_format != "npz" and not has_pyarrow():
+        raise ImportError("pyarrow is needed for the " + file_format + " format, use npz instead")
+    writer, extension = writers[file_format]
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for name, columns in tables.items():
+        filename = os.path.join(directory, name + extension)
+        writer(columns, filename)
+        filenames.append(filename)
+    return filenames
+
+
+# read a table written in the npz format, decoding the string columns
+def read_npz_table(filename):
+    import numpy as np
+    columns = {}
+    with np.load(filename) as data:
+        for name in data.files:
+            if name.endswith("_offsets") and name[:-len("_offsets")] in data.files:
+                continue
+            if name + "_offsets" in data.files:
+                raw = data[name].tobytes()
+                offsets = data[name + "_offsets"]
+                columns[name] = [raw[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+            else:
+                columns[name] = data[name]
+    return columns
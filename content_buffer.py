@@ -0,0 +1,151 @@
+# The text of every message in one memory-mapped UTF-8 file, instead of one Python string per message
+# map_message_contents in analyze_messenger_v3_json.py writes it and makes the messages read their content from it.
+
+# A content buffer named <filename> is made of three files:
+#   <filename>          the UTF-8 encoded contents of all messages, one after the other
+#   <filename>.offsets  int64 start offset of every message in the contents, followed by the total length
+#   <filename>.threads  int64 number of the first message of every thread, followed by the total number of messages
+#   <filename>.words    int32 number of words of every message, as len(content.split()), so counting words needs no decoding
+# Messages are numbered like in the word index: thread by thread, in the order of the threads list.
+
+# Since the files are memory-mapped, opening even a huge buffer takes almost no memory,
+# and processes that open the same buffer share its pages in the page cache.
+# The contents are only decoded when a message is used, and scanners can search the raw bytes without decoding at all.
+# The buffer can be opened again by a later run, for the same threads, without reading the contents from the export.
+
+import mmap
+import os
+from array import array
+
+
+def write(filename, threads):
+    offsets = array("q")
+    thread_starts = array("q")
+    words = array("i")
+    position = 0
+    message_number = 0
+    with open(filename, "wb") as f:
+        for thread in threads:
+            thread_starts.append(message_number)
+            for message in thread["messages"]:
+                encoded = message["content"].encode("utf-8")
+                offsets.append(position)
+                words.append(len(message["content"].split()))
+                f.write(encoded)
+                position += len(encoded)
+                message_number += 1
+    offsets.append(position)
+    thread_starts.append(message_number)
+    with open(filename + ".offsets", "wb") as f:
+        offsets.tofile(f)
+    with open(filename + ".threads", "wb") as f:
+        thread_starts.tofile(f)
+    with open(filename + ".words", "wb") as f:
+        words.tofile(f)
+
+
+def exists(filename):
+    return all(os.path.exists(filename + suffix) for suffix in ("", ".offsets", ".threads", ".words"))
+
+
+# the runs of ASCII characters in a lowercase needle, except "i" and "k", as UTF-8 bytes
+# "i" and "k" are left out since İ and the Kelvin sign lowercase to them, and no other non-ASCII character lowercases to ASCII
+def ascii_runs(needle):
+    runs = []
+    run = ""
+    for c in needle:
+        if c.isascii() and c not in "ik":
+            run += c
+        elif run != "":
+            runs.append(run.encode("ascii"))
+            run = ""
+    if run != "":
+        runs.append(run.encode("ascii"))
+    return runs
+
+
+def map_file(filename):
+    with open(filename, "rb") as f:
+        # mmap can not map empty files
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ContentBuffer:
+
+    def __init__(self, filename):
+        self.data = map_file(filename)
+        self.offsets_map = map_file(filename + ".offsets")
+        self.threads_map = map_file(filename + ".threads")
+        self.words_map = map_file(filename + ".words")
+        self.offsets = memoryview(self.offsets_map).cast("q")
+        self.thread_starts = memoryview(self.threads_map).cast("q")
+        self.word_counts = memoryview(self.words_map).cast("i") if self.words_map is not None else memoryview(b"").cast("i")
+        self.view_of_data = memoryview(self.data) if self.data is not None else memoryview(b"")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def thread_count(self):
+        return len(self.thread_starts) - 1
+
+    # the number of a message, from the index of its thread and its index in the thread
+    def message_number(self, thread, message):
+        return self.thread_starts[thread] + message
+
+    def thread_message_count(self, thread):
+        return self.thread_starts[thread + 1] - self.thread_starts[thread]
+
+    # the raw UTF-8 bytes of message number i, without copying them
+    def view(self, i):
+        return self.view_of_data[self.offsets[i]:self.offsets[i + 1]]
+
+    def content(self, i):
+        return str(self.view(i), "utf-8")
+
+    # the number of words in message number i, like len(content.split())
+    def words(self, i):
+        return self.word_counts[i]
+
+    # True if the UTF-8 encoded needle is in message number i
+    # searching the bytes gives the same answer as searching the decoded text, since UTF-8 is self-synchronizing
+    def contains(self, i, needle):
+        if self.data is None:
+            return len(needle) == 0
+        return self.data.find(needle, self.offsets[i], self.offsets[i + 1]) != -1
+
+    # True if needle (in lowercase) is in the lowercased text of message number i, like needle in content.lower()
+    # the bytes are only lowercased as ASCII, so the text is decoded when an uppercase non-ASCII letter could be part of a match,
+    # which can only be when the lowercased bytes contain every ASCII run of the needle (see ascii_runs)
+    def contains_lower(self, i, needle):
+        if self.data is None:
+            return len(needle) == 0
+        lowered = self.data[self.offsets[i]:self.offsets[i + 1]].lower()
+        if needle.encode("utf-8") in lowered:
+            return True
+        if lowered.isascii() or not all(run in lowered for run in ascii_runs(needle)):
+            return False
+        return needle in self.content(i).lower()
+
+    # number of non-overlapping occurrences of the UTF-8 encoded needle in message number i
+    def count(self, i, needle):
+        if self.data is None or len(needle) == 0:
+            return 0
+        count = 0
+        start = self.offsets[i]
+        end = self.offsets[i + 1]
+        position = self.data.find(needle, start, end)
+        while position != -1:
+            count += 1
+            position = self.data.find(needle, position + len(needle), end)
+        return count
+
+    def close(self):
+        self.view_of_data.release()
+        self.offsets.release()
+        self.thread_starts.release()
+        self.word_counts.release()
+        for mapped in (self.data, self.offsets_map, self.threads_map, self.words_map):
+            if mapped is not None:
+                mapped.close()
@@ -0,0 +1,132 @@
+# Streaming CSV export of the time interval data created by generate_time_interval_data
+# It is shared by all versions of the analysis script, since they all produce the same "time_data" dictionaries
+
+# Rows are written one at a time through csv.writer, so nothing but the current row is ever kept as text
+# That means that exporting every thread and every metric at once works even for very large exports
+
+import csv
+import os
+import sys
+from datetime import date
+from datetime import timedelta
+
+# the intervals that can be exported
+# daily and monthly are stored in the time data, weekly and yearly are summed up from them while exporting
+intervals = ["daily", "weekly", "monthly", "yearly"]
+
+# size of the write buffer for export files
+buffer_size = 1 << 20
+
+
+# add every number in bucket to the corresponding number in total
+# buckets are the (nested) dictionaries stored per date in the time data
+def add_bucket(total, bucket):
+    for key, value in bucket.items():
+        if isinstance(value, dict):
+            if key not in total:
+                total[key] = {}
+            add_bucket(total[key], value)
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+# the adjusted emoji count is a ratio, and can not be summed up. recalculate it from the summed counts instead.
+def adjust_bucket(bucket):
+    if "adjusted_emoji_per_member" not in bucket:
+        return
+    for member in bucket["adjusted_emoji_per_member"]:
+        words = bucket["words_per_member"][member]
+        if words != 0:
+            bucket["adjusted_emoji_per_member"][member] = bucket["emoji_per_member"][member] / words
+        else:
+            bucket["adjusted_emoji_per_member"][member] = 0
+
+
+# returns the first date of the period that d belongs to
+def period_start(d, interval):
+    if interval == "weekly":
+        return d - timedelta(days = d.weekday())
+    if interval == "yearly":
+        return date(d.year, 1, 1)
+    return d
+
+
+# yields (date, bucket) tuples for every period in the thread, oldest first
+# thread is a thread dictionary with "time_data"
+def interval_buckets(thread, interval):
+    if interval not in intervals:
+        raise ValueError("interval must be one of " + ", ".join(intervals))
+    if "time_data" not in thread:
+        return
+    time_data = thread["time_data"]
+    if interval == "daily" or interval == "monthly":
+        for d in sorted(time_data[interval]):
+            yield d, time_data[interval][d]
+        return
+
+    # weekly is summed up from daily data, and yearly from monthly data
+    source = time_data["daily"] if interval == "weekly" else time_data["monthly"]
+    current = None
+    total = None
+    for d in sorted(source):
+        start = period_start(d, interval)
+        if start != current:
+            if current is not None:
+                adjust_bucket(total)
+                yield current, total
+            current = start
+            total = {}
+        add_bucket(total, source[d])
+    if current is not None:
+        adjust_bucket(total)
+        yield current, total
+
+
+# write the data key (e.g. "words_per_member") of one thread as csv to the file object out
+# the first column is the date, and the other columns are the entries of the data dictionary
+def write_interval_data(out, thread, interval, data):
+    writer = csv.writer(out, lineterminator="\n")
+    header = None
+    for d, bucket in interval_buckets(thread, interval):
+        if header is None:
+            header = list(bucket[data])
+            writer.writerow(["Date"] + header)
+        writer.writerow([str(d)] + [bucket[data][data_point] for data_point in header])
+
+
+# export one data key of one thread. prints to stdout if f is None, otherwise streams to the file f
+def export_interval_data(thread, interval, data, f = None):
+    if f is None:
+        write_interval_data(sys.stdout, thread, interval, data)
+        return
+    with open(f, "w", newline="", buffering=buffer_size) as fi:
+        write_interval_data(fi, thread, interval, data)
+
+
+# write every data key of every thread to the file object out, in long format:
+# Thread,Title,Date,Metric,Key,Value
+def write_all_interval_data(out, threads, interval):
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(["Thread", "Title", "Date", "Metric", "Key", "Value"])
+    for i, thread in enumerate(threads):
+        # the oldest version of the script has neither indices nor titles
+        index = thread.get("index", i)
+        title = thread.get("title", "")
+        for d, bucket in interval_buckets(thread, interval):
+            d = str(d)
+            for metric, values in bucket.items():
+                for key, value in values.items():
+                    writer.writerow([index, title, d, metric, key, value])
+
+
+# export every data key of every thread for each of the given intervals
+# writes one file per interval, <directory>/<interval>.csv, straight to disk
+def export_all_interval_data(threads, directory, export_intervals = intervals):
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for interval in export_intervals:
+        filename = os.path.join(directory, interval + ".csv")
+        with open(filename, "w", newline="", buffering=buffer_size) as fi:
+            write_all_interval_data(fi, threads, interval)
+        filenames.append(filename)
+    return filenames
@@ -0,0 +1,92 @@
+# Reading an export straight out of the ZIP archives that facebook delivers it in, without extracting it first
+# Used by load_archives in analyze_messenger_v3_json.py (json exports) and analyze_messenger_v2.py (html exports).
+
+# Big exports come as several archives, and the files of one thread can be spread over them
+# (messages/inbox/<thread>/message_1.json in one, message_2.json in another), so the members of all archives
+# are grouped by thread first. Only the members with messages are ever decompressed: photos, videos and the
+# rest of the export stay in the archives.
+# The members are decompressed and parsed in a pool of processes. Every process opens each archive once,
+# and the results come back in the order of the threads, so the thread indices do not depend on the pool.
+
+import os
+import time
+import zipfile
+from multiprocessing import Pool
+
+
+def is_archive(path):
+    return isinstance(path, (list, tuple)) or path.lower().endswith(".zip")
+
+
+def archive_paths(path):
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    return [path]
+
+
+# a member of an archive: the archive's filename, the member's name in it, and its sizes and modification time
+def member(archive, info):
+    return {"archive": archive, "name": info.filename, "size": info.file_size, "compressed_size": info.compress_size,
+            "mtime": time.mktime(info.date_time + (0, 0, -1))}
+
+
+# the message*.json members of every thread in the archives, as a dictionary from the thread's directory name
+# to a list of members, in the order of their names (message_1.json before message_2.json)
+def json_threads(paths):
+    threads = {}
+    for archive in paths:
+        with zipfile.ZipFile(archive) as z:
+            for info in z.infolist():
+                parts = info.filename.split("/")
+                # .../messages/inbox/<thread>/message_1.json
+                if len(parts) < 4 or parts[-4] != "messages" or parts[-3] != "inbox":
+                    continue
+                if parts[-1].startswith("message") and parts[-1].endswith(".json"):
+                    threads.setdefault(parts[-2], []).append(member(archive, info))
+    for members in threads.values():
+        members.sort(key = lambda m: message_file_number(m["name"]))
+    return dict(sorted(threads.items()))
+
+
+# message.json -> 0, message_1.json -> 1, message_12.json -> 12
+def message_file_number(name):
+    stem = os.path.splitext(os.path.basename(name))[0]
+    number = stem[len("message"):].lstrip("_")
+    return int(number) if number.isdigit() else 0
+
+
+# the .html members in a messages directory of the archives, one per thread, in the order of their names
+def html_members(paths):
+    members = []
+    for archive in paths:
+        with zipfile.ZipFile(archive) as z:
+            for info in z.infolist():
+                parts = info.filename.split("/")
+                if "messages" in parts[:-1] and parts[-1].endswith(".html"):
+                    members.append(member(archive, info))
+    members.sort(key = lambda m: m["name"])
+    return members
+
+
+# the archives opened by this process
+open_archives = {}
+
+
+def read_member(m):
+    if m["archive"] not in open_archives:
+        open_archives[m["archive"]] = zipfile.ZipFile(m["archive"])
+    return open_archives[m["archive"]].read(m["name"])
+
+
+# function(task) for every task, in a pool of processes (os.cpu_count() if processes is None),
+# yielding the results in the order of the tasks as they are done
+def parallel_map(function, tasks, processes = None):
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1:
+        for task in tasks:
+            yield function(task)
+        return
+    with Pool(processes) as pool:
+        for result in pool.imap(function, tasks):
+            yield result
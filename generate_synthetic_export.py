@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Generates a synthetic Facebook Messenger export, for testing and benchmarking the analysis scripts
+# The same threads and messages can be written in all three formats that the scripts read:
+#   v1 - a single messages.htm file with all threads (analyze_messenger.py)
+#   v2 - a directory with one .html file per thread (analyze_messenger_v2.py)
+#   v3 - an inbox directory with <thread>/message.json files (analyze_messenger_v3_json.py)
+
+# The output is deterministic: the same arguments and seed always give the same export.
+# Each thread is generated, written and forgotten before the next one, so huge exports do not need much memory.
+
+# Example: ./generate_synthetic_export.py out --threads 50 --messages 20000 --formats v2 v3
+
+import argparse
+import html
+import itertools
+import json
+import os
+import random
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+first_names = ["Anna", "Björn", "Cecilia", "David", "Elin", "Filip", "Görel", "Hugo", "Ida", "Jöns",
+               "Karin", "Lars", "Märta", "Nils", "Olle", "Petra", "Rut", "Sören", "Tove", "Åsa", "Teodor"]
+last_names = ["Andersson", "Björk", "Ek", "Lindqvist", "Nyström", "Öberg", "Sandström", "Åkesson", "Bucht"]
+
+# the vocabulary is used with zipf distributed frequencies, so the first words are by far the most common
+vocabulary = ["jag", "det", "är", "att", "inte", "på", "du", "och", "så", "vi", "har", "man", "eller", "i",
+              "hej", "ja", "nej", "ok", "kul", "bra", "haha", "vad", "när", "imorgon", "idag", "kanske",
+              "teodor", "théodòre", "middag", "skola", "träning", "film", "kaffe", "fika", "sjukt", "jobb",
+              "helg", "vecka", "resa", "tåg", "buss", "ringer", "snart", "hemma", "ute", "läsa", "tenta"]
+word_weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+
+
+# the vocabulary with made up words added until it has size words, with their zipf weights
+# a big vocabulary has many rare words, like a real export, which the small one above does not
+def zipf_vocabulary(size):
+    words = vocabulary + ["ord" + str(rank) for rank in range(len(vocabulary), size)]
+    return words, [1 / (rank + 1) for rank in range(len(words))]
+
+emoji = [":)", ";)", ":/", "😆", "😅", "😀", "😂", "😉", "❤️", "👍"]
+reactions = ["😆", "😍", "😮", "😢", "😠", "👍", "👎"]
+
+# the utc offset used in the html formats
+html_offset = timezone(timedelta(hours = 1))
+
+
+# facebook writes the utf-8 bytes of non-ascii text as separate latin-1 characters in the json export
+def mojibake(s):
+    return s.encode("utf-8").decode("latin-1")
+
+
+class ExportGenerator:
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        # mojibake has its own random generator, so that the threads are the same whichever formats are written
+        self.mojibake_random = random.Random(args.seed + 1)
+        self.people = self.make_people()
+        self.vocabulary, weights = zipf_vocabulary(args.vocabulary)
+        # the cumulative weights are summed up once, instead of for every message
+        self.cumulative_weights = list(itertools.accumulate(weights))
+
+    def make_people(self):
+        people = []
+        for first in first_names:
+            for last in last_names:
+                people.append(first + " " + last)
+        self.random.shuffle(people)
+        return [person for person in people if person != self.args.user]
+
+    def text(self):
+        # messages with only a photo or a sticker have no text
+        if self.random.random() < self.args.empty_density:
+            return ""
+        length = max(1, int(self.random.expovariate(1 / self.args.words)))
+        words = self.random.choices(self.vocabulary, cum_weights=self.cumulative_weights, k=length)
+        for i in range(length):
+            if self.random.random() < self.args.emoji_density:
+                words[i] = self.random.choice(emoji)
+        return " ".join(words)
+
+    # returns a thread dictionary with "title", "participants" (not including the user) and "messages"
+    # the messages are dictionaries with "sender", "timestamp", "content" and "reactions", oldest first
+    def thread(self, n):
+        r = self.random
+        participant_count = max(1, min(len(self.people), int(r.gauss(self.args.participants, self.args.participants / 2))))
+        participants = r.sample(self.people, participant_count)
+        if participant_count == 1:
+            title = participants[0]
+        else:
+            title = "Grupp " + str(n) + " " + r.choice(vocabulary)
+        senders = participants + [self.args.user]
+
+        start = datetime(self.args.start_year, 1, 1, tzinfo=timezone.utc).timestamp()
+        span = self.args.years * 365 * 24 * 60 * 60
+        message_count = max(1, int(r.gauss(self.args.messages, self.args.messages / 4)))
+        timestamps = sorted(int(start + r.random() * span) for _ in range(message_count))
+
+        messages = []
+        for timestamp in timestamps:
+            message = {"sender": r.choice(senders), "timestamp": timestamp, "content": self.text(), "reactions": []}
+            if r.random() < self.args.reaction_density:
+                message["reactions"].append({"reaction": r.choice(reactions), "actor": r.choice(senders)})
+            messages.append(message)
+        return {"title": title, "participants": participants, "messages": messages}
+
+    def threads(self):
+        for n in range(self.args.threads):
+            yield n, self.thread(n)
+
+    def maybe_mojibake(self, s):
+        if self.mojibake_random.random() < self.args.mojibake_density:
+            return mojibake(s)
+        return s
+
+
+def html_date(timestamp):
+    date = datetime.fromtimestamp(timestamp, html_offset)
+    return date.strftime("%A, %B %d, %Y at %I:%M%p") + " UTC+01"
+
+
+def html_messages(thread, with_reactions):
+    # no whitespace between the tags, since the parsers treat every piece of text as data
+    parts = []
+    # facebook lists the newest messages first
+    for message in reversed(thread["messages"]):
+        parts.append('<div class="message"><div class="message_header"><span class="user">')
+        parts.append(html.escape(message["sender"]))
+        parts.append('</span><span class="meta">')
+        parts.append(html_date(message["timestamp"]))
+        parts.append('</span></div></div><p>')
+        parts.append(html.escape(message["content"]))
+        parts.append('</p>')
+        if with_reactions and len(message["reactions"]) > 0:
+            parts.append('<ul class="meta">')
+            for reaction in message["reactions"]:
+                parts.append('<li>' + html.escape(reaction["reaction"] + reaction["actor"]) + '</li>')
+            parts.append('</ul>')
+    return "".join(parts)
+
+
+class V1Writer:
+
+    def __init__(self, directory, user):
+        os.makedirs(directory, exist_ok=True)
+        self.user = user
+        self.file = open(os.path.join(directory, "messages.htm"), "w")
+        self.file.write('<html><head><title>Messages</title></head><body><div class="contents">')
+
+    def write(self, n, thread):
+        self.file.write('<div class="thread">')
+        self.file.write(html.escape(", ".join(thread["participants"] + [self.user])))
+        self.file.write(html_messages(thread, False))
+        self.file.write('</div>')
+
+    def close(self):
+        self.file.write('</div></body></html>')
+        self.file.close()
+
+
+class V2Writer:
+
+    def __init__(self, directory, user):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def write(self, n, thread):
+        with open(os.path.join(self.directory, str(n) + ".html"), "w") as f:
+            f.write('<html><head><title>' + html.escape(thread["title"]) + '</title></head><body>')
+            f.write('<div class="thread"><h3>' + html.escape(thread["title"]) + '</h3>')
+            f.write(html.escape("Participants: " + ", ".join(thread["participants"])))
+            f.write(html_messages(thread, True))
+            f.write('</div></body></html>')
+
+    def close(self):
+        pass
+
+
+class V3Writer:
+
+    def __init__(self, directory, user, generator):
+        self.user = user
+        self.directory = os.path.join(directory, "inbox")
+        os.makedirs(self.directory, exist_ok=True)
+        self.generator = generator
+
+    def write(self, n, thread):
+        g = self.generator
+        threadname = "thread" + str(n)
+        messages = []
+        for message in reversed(thread["messages"]):
+            json_message = {"sender_name": g.maybe_mojibake(message["sender"]), "timestamp": message["timestamp"]}
+            # messages with only a photo or a sticker have no content
+            if message["content"] != "":
+                json_message["content"] = g.maybe_mojibake(message["content"])
+            if len(message["reactions"]) > 0:
+                json_message["reactions"] = [{"reaction": mojibake(reaction["reaction"]), "actor": g.maybe_mojibake(reaction["actor"])}
+                                             for reaction in message["reactions"]]
+            json_message["type"] = "Generic"
+            messages.append(json_message)
+        participants = thread["participants"] + ([self.user] if g.args.owner_participant else [])
+        threaddict = {"participants": [g.maybe_mojibake(participant) for participant in participants],
+                      "messages": messages,
+                      "title": g.maybe_mojibake(thread["title"]),
+                      "is_still_participant": True,
+                      "status": "active",
+                      "thread_type": "Regular" if len(thread["participants"]) == 1 else "RegularGroup",
+                      "thread_path": "inbox/" + threadname}
+        os.makedirs(os.path.join(self.directory, threadname), exist_ok=True)
+        with open(os.path.join(self.directory, threadname, "message.json"), "w") as f:
+            json.dump(threaddict, f)
+
+    def close(self):
+        pass
+
+
+# the directory that each analysis script should be given, for an export generated into directory
+def input_path(directory, export_format):
+    if export_format == "v1":
+        return os.path.join(directory, "v1", "messages.htm")
+    if export_format == "v2":
+        return os.path.join(directory, "v2")
+    return os.path.join(directory, "v3", "inbox")
+
+
+def generate(args):
+    generator = ExportGenerator(args)
+    writers = []
+    for export_format in args.formats:
+        directory = os.path.join(args.output, export_format)
+        if export_format == "v1":
+            writers.append(V1Writer(directory, args.user))
+        elif export_format == "v2":
+            writers.append(V2Writer(directory, args.user))
+        else:
+            writers.append(V3Writer(directory, args.user, generator))
+    message_count = 0
+    for n, thread in generator.threads():
+        message_count += len(thread["messages"])
+        for writer in writers:
+            writer.write(n, thread)
+    for writer in writers:
+        writer.close()
+    return message_count
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Facebook Messenger export.")
+    parser.add_argument("output", help="directory to write the export to")
+    parser.add_argument("--formats", nargs="+", choices=["v1", "v2", "v3"], default=["v1", "v2", "v3"])
+    parser.add_argument("--user", default="My Name", help="the name of the owner of the export (setup.user)")
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=1000, help="average number of messages per thread")
+    parser.add_argument("--participants", type=float, default=2, help="average number of participants per thread, besides the user")
+    parser.add_argument("--words", type=float, default=6, help="average number of words per message")
+    parser.add_argument("--vocabulary", type=int, default=len(vocabulary), help="number of distinct words, zipf distributed")
+    parser.add_argument("--start-year", type=int, default=2010)
+    parser.add_argument("--years", type=float, default=8, help="number of years the messages are spread over")
+    parser.add_argument("--emoji-density", type=float, default=0.02, help="probability that a word is an emoji")
+    parser.add_argument("--mojibake-density", type=float, default=1.0, help="probability that a json string is mojibake encoded")
+    parser.add_argument("--empty-density", type=float, default=0.03, help="probability that a message has no text")
+    parser.add_argument("--reaction-density", type=float, default=0.05, help="probability that a message has a reaction")
+    parser.add_argument("--owner-participant", action="store_true", help="list the owner as a participant in the json export, like newer exports do")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+if __name__ == "__main__":
+    args = argument_parser().parse_args()
+    count = generate(args)
+    print("wrote " + str(count) + " messages in " + str(args.threads) + " threads to " + args.output)
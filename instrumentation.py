@@ -0,0 +1,188 @@
+# Timing and memory measurements of the stages of the analysis pipeline, and progress reporting while loading
+# Used by main() in the analysis scripts, like so:
+#
+#     with instrumentation.stage("calculate_meta_data"):
+#         calculate_meta_data()
+#
+# Every stage records its wall time, cpu time, peak traced memory and message throughput.
+# write_report writes them all as json, for finding out which stage a slow run spends its time in.
+
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+# the measurements of the stages run so far, in order
+stages = []
+
+# number of messages the pipeline works on, used for the throughput. set it once the data is loaded.
+message_count = 0
+
+# tracemalloc slows everything down, so peak memory is only traced when it is enabled
+trace_memory = False
+
+
+def reset():
+    global message_count
+    stages.clear()
+    message_count = 0
+
+
+@contextmanager
+def stage(name):
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        measurement = {"stage": name,
+                       "seconds": time.perf_counter() - wall,
+                       "cpu_seconds": time.process_time() - cpu}
+        if trace_memory:
+            measurement["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        measurement["messages"] = message_count
+        if measurement["seconds"] > 0:
+            measurement["messages_per_second"] = message_count / measurement["seconds"]
+        stages.append(measurement)
+
+
+# decorator version of stage, named after the function
+def timed(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def report():
+    return {"messages": message_count,
+            "seconds": sum(measurement["seconds"] for measurement in stages),
+            "stages": list(stages)}
+
+
+# write the report as json to filename, or to stdout if filename is None
+def write_report(filename = None):
+    if filename is None:
+        json.dump(report(), sys.stdout, indent=2)
+        print()
+        return
+    with open(filename, "w") as f:
+        json.dump(report(), f, indent=2)
+
+
+# Progress of the ingestion of an export: threads done out of the total, bytes read, messages per second and an ETA
+# The loaders call update after every thread. It is safe to call from several threads at once.
+# Every snapshot is handed to the sinks, which show or store it: a ProgressBar on the terminal,
+# or a MetricsFile with one json object per line, for monitoring to tail.
+class Progress:
+
+    # snapshots are sent to the sinks at most this often, in seconds, except for the last one
+    interval = 0.5
+
+    def __init__(self, total_threads, total_bytes = None, sinks = ()):
+        self.total_threads = total_threads
+        self.total_bytes = total_bytes
+        self.sinks = list(sinks)
+        self.threads_done = 0
+        self.bytes_read = 0
+        self.messages = 0
+        self.start = time.perf_counter()
+        self.last_emit = None
+        self.lock = threading.Lock()
+
+    def update(self, threads = 1, messages = 0, bytes_read = 0):
+        with self.lock:
+            self.threads_done += threads
+            self.messages += messages
+            self.bytes_read += bytes_read
+            now = time.perf_counter()
+            if self.last_emit is not None and now - self.last_emit < self.interval:
+                return
+            self.last_emit = now
+            self.emit(False)
+
+    def finish(self):
+        with self.lock:
+            self.emit(True)
+            for sink in self.sinks:
+                sink.close()
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        snapshot = {"time": time.time(),
+                    "elapsed": elapsed,
+                    "threads_done": self.threads_done,
+                    "total_threads": self.total_threads,
+                    "bytes_read": self.bytes_read,
+                    "total_bytes": self.total_bytes,
+                    "messages": self.messages,
+                    "messages_per_second": self.messages / elapsed if elapsed > 0 else 0,
+                    "bytes_per_second": self.bytes_read / elapsed if elapsed > 0 else 0,
+                    "eta": None}
+        # estimate the time left from the bytes if the total is known, since threads differ a lot in size
+        if self.total_bytes and self.bytes_read > 0:
+            snapshot["eta"] = elapsed * (self.total_bytes - self.bytes_read) / self.bytes_read
+        elif self.total_threads and self.threads_done > 0:
+            snapshot["eta"] = elapsed * (self.total_threads - self.threads_done) / self.threads_done
+        return snapshot
+
+    def emit(self, final):
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot, final)
+
+
+# shows the progress as a single line on the terminal, which is redrawn for every snapshot
+class ProgressBar:
+
+    width = 30
+
+    def __init__(self, stream = None):
+        self.stream = stream if stream is not None else sys.stderr
+        self.line_length = 0
+
+    def write(self, snapshot, final):
+        fraction = 0
+        if snapshot["total_bytes"]:
+            fraction = snapshot["bytes_read"] / snapshot["total_bytes"]
+        elif snapshot["total_threads"]:
+            fraction = snapshot["threads_done"] / snapshot["total_threads"]
+        filled = int(self.width * min(fraction, 1))
+        line = "[" + "#" * filled + " " * (self.width - filled) + "]"
+        line += " %d/%d threads" % (snapshot["threads_done"], snapshot["total_threads"] or 0)
+        line += " %.1f MB" % (snapshot["bytes_read"] / 2**20)
+        line += " %.0f messages/s" % snapshot["messages_per_second"]
+        if snapshot["eta"] is not None and not final:
+            line += " ETA %ds" % snapshot["eta"]
+        # pad with spaces to overwrite all of the previous line
+        padded = line.ljust(self.line_length)
+        self.line_length = len(line)
+        self.stream.write("\r" + padded + ("\n" if final else ""))
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+# appends every snapshot as a json line to a file
+class MetricsFile:
+
+    def __init__(self, filename):
+        self.file = open(filename, "a")
+
+    def write(self, snapshot, final):
+        snapshot = dict(snapshot)
+        snapshot["final"] = final
+        self.file.write(json.dumps(snapshot) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,72 @@
+# A static interval tree, for finding the intervals that overlap a query interval without looking at all of them
+# Used by analyze_messenger_v3_json.py for the spans of the threads, from the first to the last message,
+# to answer questions like "which threads were active in this month".
+
+# Each node has a center point. The intervals containing the center are kept in the node, sorted by start and by end,
+# the ones entirely before the center go to the left subtree and the ones entirely after it to the right.
+# A query visits one path down the tree, plus the subtrees inside the query interval,
+# so it takes O(log n + k) for k overlapping intervals.
+
+
+class Node:
+
+    def __init__(self, intervals):
+        points = sorted([interval[0] for interval in intervals] + [interval[1] for interval in intervals])
+        self.center = points[len(points) // 2]
+        here = [interval for interval in intervals if interval[0] <= self.center <= interval[1]]
+        left = [interval for interval in intervals if interval[1] < self.center]
+        right = [interval for interval in intervals if interval[0] > self.center]
+        self.by_start = sorted(here, key = lambda interval: interval[0])
+        self.by_end = sorted(here, key = lambda interval: interval[1], reverse = True)
+        self.left = Node(left) if len(left) > 0 else None
+        self.right = Node(right) if len(right) > 0 else None
+
+    def overlapping(self, start, end, result):
+        if end < self.center:
+            # the intervals here end after the query, so they overlap if they start before its end
+            for interval in self.by_start:
+                if interval[0] > end:
+                    break
+                result.append(interval)
+            if self.left is not None:
+                self.left.overlapping(start, end, result)
+        elif start > self.center:
+            for interval in self.by_end:
+                if interval[1] < start:
+                    break
+                result.append(interval)
+            if self.right is not None:
+                self.right.overlapping(start, end, result)
+        else:
+            result.extend(self.by_start)
+            if self.left is not None:
+                self.left.overlapping(start, end, result)
+            if self.right is not None:
+                self.right.overlapping(start, end, result)
+
+
+class IntervalTree:
+
+    # intervals is a list of (start, end, value) tuples, where start <= end and both ends are included
+    # the starts and ends can be anything that can be compared, like dates
+    def __init__(self, intervals):
+        # the position of each interval is kept as a fourth element, for returning the values in order
+        intervals = [(start, end, value, i) for i, (start, end, value) in enumerate(intervals)]
+        self.root = Node(intervals) if len(intervals) > 0 else None
+        self.start = min(interval[0] for interval in intervals) if len(intervals) > 0 else None
+        self.end = max(interval[1] for interval in intervals) if len(intervals) > 0 else None
+        self.count = len(intervals)
+
+    def __len__(self):
+        return self.count
+
+    # the values of the intervals that overlap start to end (both included), in the order the intervals were given
+    def overlapping(self, start, end):
+        result = []
+        if self.root is not None:
+            self.root.overlapping(start, end, result)
+        return [interval[2] for interval in sorted(result, key = lambda interval: interval[3])]
+
+    # the values of the intervals that contain point
+    def at(self, point):
+        return self.overlapping(point, point)
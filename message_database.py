@@ -0,0 +1,238 @@
+# Optional SQLite storage of the loaded threads, so that the analysis survives the process
+# load_data in analyze_messenger_v3_json.py writes every thread it reads to the database,
+# and load_threads reads them back again without touching the original export
+
+# Threads are identified by their path in the export (the directory name of the thread).
+# Loading a new export into the same database upserts: threads whose file is unchanged are skipped,
+# and only messages that are not already stored are inserted.
+# A message is identified by its thread, timestamp, sender and a 64-bit hash of its content, so that the unique index
+# does not hold a second copy of every message text.
+
+import hashlib
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+
+schema = """
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    title TEXT,
+    file_size INTEGER,
+    file_mtime REAL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    first_timestamp INTEGER,
+    last_timestamp INTEGER
+);
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS thread_members (
+    thread INTEGER NOT NULL REFERENCES threads (id),
+    member INTEGER NOT NULL REFERENCES members (id),
+    position INTEGER NOT NULL,
+    PRIMARY KEY (thread, member)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    thread INTEGER NOT NULL REFERENCES threads (id),
+    timestamp INTEGER NOT NULL,
+    sender INTEGER NOT NULL REFERENCES members (id),
+    content TEXT NOT NULL,
+    content_hash INTEGER NOT NULL,
+    words INTEGER NOT NULL,
+    duplicate INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (thread, timestamp, sender, content_hash, duplicate)
+);
+CREATE INDEX IF NOT EXISTS messages_thread_timestamp ON messages (thread, timestamp);
+CREATE INDEX IF NOT EXISTS messages_sender_timestamp ON messages (sender, timestamp);
+"""
+
+
+def connect(filename):
+    conn = sqlite3.connect(filename)
+    migrate(conn)
+    conn.executescript(schema)
+    return conn
+
+
+# the first 8 bytes of the blake2b hash of a message text, as a signed 64-bit integer like sqlite stores
+def content_hash(content):
+    return int.from_bytes(hashlib.blake2b(content.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+# databases written before the content hash had the unique index on the content itself
+# the messages table is rebuilt with the hash, since sqlite can not change the constraints of a table
+def migrate(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+    if len(columns) == 0 or "content_hash" in columns:
+        return
+    conn.create_function("content_hash", 1, content_hash, deterministic=True)
+    conn.executescript("BEGIN;"
+                       "DROP INDEX IF EXISTS messages_thread_timestamp;"
+                       "DROP INDEX IF EXISTS messages_sender_timestamp;"
+                       "ALTER TABLE messages RENAME TO old_messages;" + schema +
+                       "INSERT INTO messages (id, thread, timestamp, sender, content, content_hash, words, duplicate) "
+                       "SELECT id, thread, timestamp, sender, content, content_hash(content), words, duplicate FROM old_messages;"
+                       "DROP TABLE old_messages;"
+                       "COMMIT;")
+    conn.execute("VACUUM")
+
+
+def member_id(conn, name, cache):
+    if name not in cache:
+        conn.execute("INSERT OR IGNORE INTO members (name) VALUES (?)", (name,))
+        cache[name] = conn.execute("SELECT id FROM members WHERE name = ?", (name,)).fetchone()[0]
+    return cache[name]
+
+
+# returns True if the thread file with the given size and modification time is already stored
+def is_stored(conn, path, file_size, file_mtime):
+    row = conn.execute("SELECT file_size, file_mtime FROM threads WHERE path = ?", (path,)).fetchone()
+    return row is not None and row[0] == file_size and row[1] == file_mtime
+
+
+# insert or update a thread dictionary (as created by load_data), in one transaction
+def store_thread(conn, path, thread, file_size = None, file_mtime = None):
+    member_cache = {}
+    with conn:
+        conn.execute("INSERT INTO threads (path, title, file_size, file_mtime) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (path) DO UPDATE SET title = excluded.title, "
+                     "file_size = excluded.file_size, file_mtime = excluded.file_mtime",
+                     (path, thread["title"], file_size, file_mtime))
+        thread_id = conn.execute("SELECT id FROM threads WHERE path = ?", (path,)).fetchone()[0]
+
+        conn.execute("DELETE FROM thread_members WHERE thread = ?", (thread_id,))
+        conn.executemany("INSERT OR IGNORE INTO thread_members (thread, member, position) VALUES (?, ?, ?)",
+                         [(thread_id, member_id(conn, member, member_cache), position)
+                          for position, member in enumerate(thread["members"])])
+
+        # identical messages sent in the same second are numbered, so that they are not merged into one
+        seen = Counter()
+        rows = []
+        for message in thread["messages"]:
+            sender = member_id(conn, message["sender"], member_cache)
+            key = (message["timestamp"], sender, message["content"])
+            rows.append((thread_id, message["timestamp"], sender, message["content"], content_hash(message["content"]),
+                         len(message["content"].split()), seen[key]))
+            seen[key] += 1
+        conn.executemany("INSERT OR IGNORE INTO messages (thread, timestamp, sender, content, content_hash, words, duplicate) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+        conn.execute("UPDATE threads SET (message_count, first_timestamp, last_timestamp) = "
+                     "(SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM messages WHERE thread = ?) WHERE id = ?",
+                     (thread_id, thread_id))
+    return thread_id
+
+
+def thread_members(conn, thread_id):
+    return [name for (name,) in conn.execute(
+        "SELECT members.name FROM thread_members JOIN members ON members.id = thread_members.member "
+        "WHERE thread_members.thread = ? ORDER BY thread_members.position", (thread_id,))]
+
+
+# read every stored thread back, in the same dictionary format as load_data creates
+# the messages are returned sorted by date
+# with contents=False, the messages have no "content", for when the contents are read from somewhere else
+def load_threads(conn, contents = True):
+    threads = []
+    content_column = "messages.content" if contents else "NULL"
+    for thread_id, path, title in conn.execute("SELECT id, path, title FROM threads ORDER BY id").fetchall():
+        thread = {"title": title, "path": path, "database_id": thread_id}
+        thread["members"] = thread_members(conn, thread_id)
+        thread["messages"] = []
+        for timestamp, sender, content in conn.execute(
+                "SELECT messages.timestamp, members.name, " + content_column + " FROM messages "
+                "JOIN members ON members.id = messages.sender "
+                "WHERE messages.thread = ? ORDER BY messages.timestamp, messages.id", (thread_id,)):
+            message = {"timestamp": timestamp, "date": datetime.fromtimestamp(timestamp), "sender": sender, "sender_name": sender}
+            if contents:
+                message["content"] = content
+            thread["messages"].append(message)
+        threads.append(thread)
+    return threads
+
+
+# the title, members, message count and first and last timestamp of a stored thread
+def thread_metadata(conn, path):
+    tid = find_thread(conn, path)
+    title, message_count, first_timestamp, last_timestamp = conn.execute(
+        "SELECT title, message_count, first_timestamp, last_timestamp FROM threads WHERE id = ?", (tid,)).fetchone()
+    return {"title": title, "members": thread_members(conn, tid), "message_count": message_count,
+            "first_timestamp": first_timestamp, "last_timestamp": last_timestamp}
+
+
+def find_thread(conn, path):
+    row = conn.execute("SELECT id FROM threads WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        raise KeyError(path)
+    return row[0]
+
+
+# messages and words per member in a thread, like in calculate_meta_data
+def meta_data(conn, path):
+    tid = find_thread(conn, path)
+    members = thread_members(conn, tid)
+    meta = {"number_of_messages": 0,
+            "messages_per_member": {member: 0 for member in members},
+            "words_per_member": {member: 0 for member in members}}
+    meta["number_of_messages"] = conn.execute("SELECT COUNT(*) FROM messages WHERE thread = ?", (tid,)).fetchone()[0]
+    for name, message_count, word_count in conn.execute(
+            "SELECT members.name, COUNT(*), SUM(messages.words) FROM messages "
+            "JOIN members ON members.id = messages.sender "
+            "WHERE messages.thread = ? GROUP BY messages.sender", (tid,)):
+        if name in meta["messages_per_member"]:
+            meta["messages_per_member"][name] = message_count
+            meta["words_per_member"][name] = word_count
+    return meta
+
+
+# the number of threads, messages and words of every member over all stored threads, most messages first
+# like in the meta data, only messages sent by a member of their thread are counted
+# returns a list of (name, threads, messages, words) tuples
+def member_totals(conn):
+    return conn.execute(
+        "SELECT members.name, COUNT(DISTINCT messages.thread), COUNT(*), SUM(messages.words) FROM messages "
+        "JOIN thread_members ON thread_members.thread = messages.thread AND thread_members.member = messages.sender "
+        "JOIN members ON members.id = messages.sender "
+        "GROUP BY messages.sender ORDER BY COUNT(*) DESC, members.name").fetchall()
+
+
+# formats for grouping timestamps into periods, in local time
+period_formats = {"daily": "%Y-%m-%d", "monthly": "%Y-%m-01"}
+
+
+# messages and words per member and day (or month) in a thread, like the time data in generate_time_interval_data
+# returns a dictionary from date to a dictionary with "messages_per_member" and "words_per_member"
+def time_data(conn, path, interval = "daily"):
+    tid = find_thread(conn, path)
+    members = thread_members(conn, tid)
+    data = {}
+    period_format = period_formats[interval]
+    rows = conn.execute(
+        "SELECT strftime(?, timestamp, 'unixepoch', 'localtime') AS period, members.name, COUNT(*), SUM(messages.words) "
+        "FROM messages JOIN members ON members.id = messages.sender "
+        "WHERE messages.thread = ? GROUP BY period, messages.sender ORDER BY period", (period_format, tid)).fetchall()
+    if len(rows) == 0:
+        return data
+
+    # every period between the first and the last message is included, just like in the time data
+    first = datetime.strptime(rows[0][0], "%Y-%m-%d").date()
+    last = datetime.strptime(rows[-1][0], "%Y-%m-%d").date()
+    d = first
+    while d <= last:
+        data[d] = {"messages_per_member": {member: 0 for member in members},
+                   "words_per_member": {member: 0 for member in members}}
+        if interval == "monthly":
+            d = (d + timedelta(days = 32)).replace(day = 1)
+        else:
+            d += timedelta(days = 1)
+
+    for period, name, message_count, word_count in rows:
+        d = datetime.strptime(period, "%Y-%m-%d").date()
+        if name in data[d]["messages_per_member"]:
+            data[d]["messages_per_member"][name] = message_count
+            data[d]["words_per_member"][name] = word_count
+    return data
@@ -0,0 +1,108 @@
+# Cumulative sums of the messages and words of every member in every thread, per day, so that the sum over any
+# range of days is two lookups instead of a scan over the messages or the daily buckets of time_data
+# Used by analyze_messenger_v3_json.py (build_range_index), which builds it from message_columns.
+
+# There is a row for every (thread, member) pair that has messages, and a column for every day of the global day axis,
+# from the first to the last day with a message, plus one. Row r, column d is the sum over the days before d,
+# so the sum from day s to day e (e not included) is row[e] - row[s].
+# The rows of the pairs are also summed per thread, so the top threads of any window are one vectorized subtraction.
+# The memory used is 8 bytes per pair, day and metric.
+
+import numpy as np
+
+seconds_per_day = 24 * 60 * 60
+
+metrics = ["messages", "words"]
+
+
+class RangeIndex:
+
+    # thread, sender, local_time and words are the columns of the messages (see build_message_columns)
+    # thread_count and member_count are the number of threads and members
+    def __init__(self, thread, sender, local_time, words, thread_count, member_count):
+        self.thread_count = thread_count
+        self.member_count = member_count
+        days = local_time // seconds_per_day
+        self.first_day = int(days.min()) if len(days) > 0 else 0
+        self.day_count = int(days.max()) - self.first_day + 1 if len(days) > 0 else 0
+
+        # the (thread, member) pairs, sorted by thread and then member
+        self.pairs, pair = np.unique(thread.astype(np.int64) * member_count + sender, return_inverse=True)
+        self.pair_thread = self.pairs // member_count
+        self.pair_member = self.pairs % member_count
+        cells = pair * self.day_count + (days - self.first_day)
+
+        self.sums = {}
+        self.thread_sums = {}
+        for metric in metrics:
+            weights = words if metric == "words" else None
+            counts = np.bincount(cells, weights=weights, minlength=len(self.pairs) * self.day_count)
+            counts = counts.astype(np.int64).reshape(len(self.pairs), self.day_count)
+            sums = np.zeros((len(self.pairs), self.day_count + 1), dtype=np.int64)
+            np.cumsum(counts, axis=1, out=sums[:, 1:])
+            self.sums[metric] = sums
+            thread_sums = np.zeros((thread_count, self.day_count + 1), dtype=np.int64)
+            np.add.at(thread_sums, self.pair_thread, sums)
+            self.thread_sums[metric] = thread_sums
+
+    # days since epoch -> a column of the sums, clamped to the day axis
+    def column(self, day):
+        return min(max(day - self.first_day, 0), self.day_count)
+
+    # the columns of the range from start to end (days since epoch, end not included). None is the start or end of the data.
+    def columns(self, start, end):
+        first = 0 if start is None else self.column(start)
+        last = self.day_count if end is None else self.column(end)
+        return first, max(first, last)
+
+    # the row of a (thread, member) pair, or None if the member has no messages in the thread
+    def row(self, thread, member):
+        key = thread * self.member_count + member
+        i = int(np.searchsorted(self.pairs, key))
+        if i < len(self.pairs) and self.pairs[i] == key:
+            return i
+        return None
+
+    # the sum of metric from start to end, in a thread, of a member, or of a member in a thread
+    # (thread indices and member ids; None means all of them)
+    def sum(self, metric, start = None, end = None, thread = None, member = None):
+        first, last = self.columns(start, end)
+        if thread is not None and member is not None:
+            row = self.row(thread, member)
+            if row is None:
+                return 0
+            sums = self.sums[metric][row]
+            return int(sums[last] - sums[first])
+        if thread is not None:
+            sums = self.thread_sums[metric][thread]
+            return int(sums[last] - sums[first])
+        sums = self.sums[metric]
+        if member is not None:
+            sums = sums[self.pair_member == member]
+        return int(sums[:, last].sum() - sums[:, first].sum())
+
+    # the sum of metric from start to end in every thread, as an array indexed by thread index,
+    # counting only the messages of member if it is given
+    def thread_totals(self, metric, start = None, end = None, member = None):
+        first, last = self.columns(start, end)
+        if member is None:
+            sums = self.thread_sums[metric]
+            return sums[:, last] - sums[:, first]
+        rows = np.flatnonzero(self.pair_member == member)
+        totals = np.zeros(self.thread_count, dtype=np.int64)
+        totals[self.pair_thread[rows]] = self.sums[metric][rows, last] - self.sums[metric][rows, first]
+        return totals
+
+    # the sum of metric from start to end of every member, as an array indexed by member id
+    def member_totals(self, metric, start = None, end = None, thread = None):
+        first, last = self.columns(start, end)
+        rows = np.arange(len(self.pairs)) if thread is None else np.flatnonzero(self.pair_thread == thread)
+        sums = self.sums[metric]
+        return np.bincount(self.pair_member[rows], weights=sums[rows, last] - sums[rows, first],
+                           minlength=self.member_count).astype(np.int64)
+
+    # the n threads with the highest sum of metric from start to end, as (thread index, sum) pairs, highest first
+    def top_threads(self, metric, start = None, end = None, n = 10, member = None):
+        totals = self.thread_totals(metric, start, end, member)
+        top = np.argsort(-totals, kind="stable")[:n]
+        return [(int(thread), int(totals[thread])) for thread in top if totals[thread] > 0]
@@ -0,0 +1,37 @@
+# Reading the files of an export ahead of the parser, so that waiting for the disk overlaps with parsing
+# Used by load_data in analyze_messenger_v3_json.py and parse_directory in analyze_messenger_v2.py.
+
+# The files are read by a pool of I/O threads (reading releases the GIL, so they really run while the parser works).
+# At most depth files are read ahead of the one the parser is at, so the memory used is bounded by the queue depth
+# times the file size, however many files there are. On a local disk with a warm cache it changes little,
+# on network filesystems and cold caches the parser no longer idles between files.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+default_depth = 8
+default_threads = 4
+
+
+def read_file(path, mode):
+    with open(path, mode) as f:
+        return f.read()
+
+
+# yields (path, contents) for every path, in order. mode is "rb" for bytes or "r" for text.
+def read_files(paths, depth = default_depth, threads = default_threads, mode = "rb"):
+    paths = iter(paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers = max(1, threads)) as pool:
+        for path in paths:
+            pending.append((path, pool.submit(read_file, path, mode)))
+            if len(pending) >= max(1, depth):
+                break
+        while len(pending) > 0:
+            path, future = pending.popleft()
+            contents = future.result()
+            # refill the queue before handing the file to the parser, so the next read starts right away
+            for next_path in paths:
+                pending.append((next_path, pool.submit(read_file, next_path, mode)))
+                break
+            yield path, contents
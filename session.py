@@ -0,0 +1,143 @@
+# An analysis session: loads the data once, and then answers questions about it in milliseconds
+# Meant for a REPL or a notebook, instead of editing main() in analyze_messenger_v3_json.py and running everything again:
+#
+#     from session import Session
+#     s = Session("path/to/messages/inbox", database = "messages.sqlite")
+#     dates, words = s.query("words", "monthly", members = ["My Name"], start = date(2016, 1, 1))
+#     dates, counts = s.query("messages", "weekly", threads = [3, 7], by_member = True)
+#
+# The messages are kept as the columns of build_message_columns, sorted by local time once when the session is created.
+# A date range is then two binary searches, the thread and member filters are boolean masks,
+# and grouping is a bincount over the period numbers, so no query looks at a message dictionary.
+
+from datetime import datetime
+
+import numpy as np
+
+import analyze_messenger_v3_json as analysis
+from time_histogram import period_numbers
+from time_histogram import period_dates
+
+seconds_per_day = 24 * 60 * 60
+
+intervals = ["daily", "weekly", "monthly", "yearly"]
+metrics = ["messages", "words"]
+
+
+# a date or datetime (in local time) -> seconds since epoch, like the local_time column
+def local_seconds(d):
+    if not isinstance(d, datetime):
+        d = datetime(d.year, d.month, d.day)
+    return int((d - analysis.epoch).total_seconds())
+
+
+class Session:
+
+    # the messages are read from messages_directory, and stored in database if it is given (see load_data)
+    # with only a database, the threads stored there are loaded without reading the export at all
+    def __init__(self, messages_directory = None, database = None):
+        if messages_directory is None and database is None:
+            raise ValueError("a session needs a messages directory or a database")
+        # the threads are loaded into a list of their own, so that the threads already loaded in the module
+        # (and other sessions) are left alone
+        saved = {name: getattr(analysis, name) for name in analysis.loaded_state}
+        analysis.threads = []
+        try:
+            if messages_directory is not None:
+                analysis.load_data(messages_directory, database)
+            else:
+                analysis.load_data_from_database(database)
+            analysis.sort_messages()
+            analysis.build_message_columns()
+            self.threads = analysis.threads
+            columns = analysis.message_columns
+        finally:
+            for name, value in saved.items():
+                setattr(analysis, name, value)
+
+        # the columns, sorted by local time
+        order = np.argsort(columns["local_time"], kind="stable")
+        self.columns = {name: column[order] for name, column in columns.items()}
+        # the number of each message in the unsorted columns, which is thread["first_message"] + its index in the thread
+        self.message_numbers = order
+        self.days = self.columns["local_time"] // seconds_per_day
+        # whether the sender of each message is a member of its thread, since only those are counted in time_data
+        self.sent_by_member = self.member_mask()
+
+    def member_mask(self):
+        pairs = set((thread["index"], analysis.member_ids[member]) for thread in self.threads for member in thread["members"])
+        members = np.array(sorted(t * len(analysis.member_names) + m for t, m in pairs), dtype=np.int64)
+        keys = self.columns["thread"].astype(np.int64) * len(analysis.member_names) + self.columns["sender"]
+        return np.isin(keys, members)
+
+    # thread indices or titles -> thread indices. a title matches every thread with that title.
+    def thread_indices(self, threads):
+        indices = []
+        for thread in threads:
+            if isinstance(thread, str):
+                indices.extend(t["index"] for t in self.threads if t["title"] == thread)
+            else:
+                indices.append(thread)
+        return indices
+
+    # member names or ids -> member ids
+    def member_indices(self, members):
+        return [analysis.member_ids[member] if isinstance(member, str) else member for member in members]
+
+    # the positions (in the sorted columns) of the messages that match the filters
+    # start and end are dates or datetimes in local time; end is exclusive
+    def select(self, threads = None, members = None, start = None, end = None):
+        local_time = self.columns["local_time"]
+        first = 0 if start is None else np.searchsorted(local_time, local_seconds(start), side="left")
+        last = len(local_time) if end is None else np.searchsorted(local_time, local_seconds(end), side="left")
+        mask = self.sent_by_member[first:last].copy()
+        if threads is not None:
+            mask &= np.isin(self.columns["thread"][first:last], self.thread_indices(threads))
+        if members is not None:
+            mask &= np.isin(self.columns["sender"][first:last], self.member_indices(members))
+        return first + np.flatnonzero(mask)
+
+    # the number of messages or words in every period between the first and the last matching message
+    # returns (dates, values), where dates is an array with the first day of every period,
+    # and values has a value per period, or a row per period with a column per member if by_member is True
+    # (the columns are in the order of member_names, or of members if it is given)
+    def query(self, metric = "messages", interval = "daily", threads = None, members = None, start = None, end = None, by_member = False):
+        if metric not in metrics:
+            raise ValueError("metric must be one of " + ", ".join(metrics))
+        if interval not in intervals:
+            raise ValueError("interval must be one of " + ", ".join(intervals))
+        selected = self.select(threads, members, start, end)
+        if len(selected) == 0:
+            return np.zeros(0, dtype="datetime64[D]"), np.zeros((0, 0) if by_member else 0, dtype=np.int64)
+
+        periods = period_numbers(self.days[selected], interval)
+        first = periods.min()
+        rows = periods - first
+        period_count = int(periods.max() - first) + 1
+        weights = self.columns["words"][selected] if metric == "words" else None
+
+        if not by_member:
+            values = np.bincount(rows, weights=weights, minlength=period_count)
+        else:
+            member_list = self.member_indices(members) if members is not None else list(range(len(analysis.member_names)))
+            column_of = np.full(len(analysis.member_names), -1, dtype=np.int64)
+            column_of[member_list] = np.arange(len(member_list))
+            cells = rows * len(member_list) + column_of[self.columns["sender"][selected]]
+            values = np.bincount(cells, weights=weights, minlength=period_count * len(member_list))
+            values = values.reshape(period_count, len(member_list))
+        return period_dates(np.arange(first, first + period_count), interval), values.astype(np.int64)
+
+    # the total number of messages or words of every member, as a dictionary from name to value
+    def totals(self, metric = "messages", threads = None, start = None, end = None):
+        selected = self.select(threads, None, start, end)
+        weights = self.columns["words"][selected] if metric == "words" else None
+        values = np.bincount(self.columns["sender"][selected], weights=weights, minlength=len(analysis.member_names))
+        return {name: int(values[i]) for i, name in enumerate(analysis.member_names) if values[i] != 0}
+
+    # the (thread, message) dictionaries of the matching messages, in time order
+    def messages(self, threads = None, members = None, start = None, end = None):
+        result = []
+        for position in self.select(threads, members, start, end):
+            thread = self.threads[self.columns["thread"][position]]
+            result.append((thread, thread["messages"][int(self.message_numbers[position]) - thread["first_message"]]))
+        return result
@@ -10,3 +10,56 @@ user = "My Name"
 # that is, for data downloaded after May 2018 this dictionary is unnecessary
 names_per_id = {"<id-number>@facebook.com": "Real Name",
                 }
+
+# filename of an sqlite database that the loaded threads are stored in, or None to not store them
+# loading a newer export into the same database only adds what is new
+database = None
+
+# filename (e.g. "plot.png") to render the plots to, or None to show them in a window
+plot_file = None
+
+# filename to write the time, cpu time and memory used by every stage of the analysis to, as json
+# if it is None, the measurements are printed when debug is True
+stage_report = None
+# also measure the peak memory use of every stage. this makes the analysis a lot slower.
+trace_memory = False
+
+# show a progress bar while loading the export
+progress_bar = False
+# filename to append the loading progress to as json lines (threads done, bytes read, messages per second, ETA), or None
+metrics_file = None
+
+# when the threads are loaded lazily, at most this many threads keep their messages in memory at once
+max_resident_threads = 16
+
+# filename of a memory-mapped file to keep the contents of all messages in, instead of one string per message, or None
+# when the threads are read from the database, a content buffer written by an earlier run is used without reading the contents
+content_buffer = None
+
+# count the words of every member in fixed memory, instead of keeping a count for every distinct word
+# the top words and the number of distinct words are then estimates, see sketches.py for how accurate they are
+approximate_word_counts = False
+
+# build the index of the words in every message while calculating the meta data, for search_messages
+# it keeps a posting list for every distinct word, so it takes memory that grows with the export, also with approximate_word_counts.
+# without it, the index is built the first time search_messages is used.
+word_index = False
+
+# number of processes that decompress and parse the files when an export is read from its zip archives, or None for all cores
+loader_processes = None
+
+# number of files that are read ahead of the parser when an export directory is loaded, and the threads reading them
+read_ahead = 8
+io_threads = 4
+
+# analyze the threads in batches that fit in memory_budget bytes, and spill what is counted to disk, for exports whose
+# messages do not fit in memory at once. the results are the same, but the word index is not built in this mode.
+out_of_core = False
+memory_budget = 1024 * 1024 * 1024
+# the memory a thread is estimated to take, per byte of its message.json, when the threads are put in batches
+# see memory_per_file_byte in analyze_messenger_v3_json.py for how the default was measured
+memory_per_file_byte = 16
+# directory to make the temporary directory for the spilled partitions in, or None for the system's temporary directory
+spill_directory = None
+# number of rows in each spilled partition
+spill_partition_rows = 1048576
@@ -0,0 +1,269 @@
+# Fixed size summaries of word streams, for counting words approximately on exports too big to count them exactly
+# Used by thread_meta_data in analyze_messenger_v3_json.py when setup.approximate_word_counts is True.
+#
+# Every member of every thread gets a WordSketch instead of a dictionary with a count for every distinct word.
+# A WordSketch is made of three structures, each of a fixed size, whatever the number of words added:
+#
+#   CountMinSketch  the count of any word.
+#                   With width w and depth d, the estimate is never too low, and it is at most e/w * N too high
+#                   with probability 1 - e^-d, where N is the number of words added.
+#                   The default 272 x 4 gives at most 1% of N too high, with probability 98%.
+#   SpaceSaving     the most common words, with k counters.
+#                   Every word used more than N/k times is kept, and no count is more than N/k too high.
+#                   The default k = 200 keeps every word that is more than 0.5% of the words.
+#   HyperLogLog     the number of distinct words, with 2^p registers.
+#                   The standard error is 1.04 / sqrt(2^p), 3.3% for the default p = 10.
+#
+# The words are hashed with blake2b, not hash(), so that sketches made in different processes can be merged.
+# Sketches with the same parameters are merged with merge, which is how the global statistics add up the threads.
+# benchmark.py --sketch-accuracy checks these bounds against the exact counts, on exports with a big zipf vocabulary.
+#
+# QuantileSketch, at the end, keeps the quantiles of reply times, see response_time_statistics.
+
+import hashlib
+import math
+from array import array
+
+
+def hash64(word):
+    return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class CountMinSketch:
+
+    def __init__(self, width = 272, depth = 4):
+        self.width = width
+        self.depth = depth
+        self.table = array("I", bytes(4 * width * depth))
+        self.total = 0
+
+    # the cell of a word in every row, from two halves of its hash (double hashing)
+    def cells(self, h):
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, word, count = 1, h = None):
+        if h is None:
+            h = hash64(word)
+        for cell in self.cells(h):
+            self.table[cell] += count
+        self.total += count
+
+    def count(self, word):
+        return min(self.table[cell] for cell in self.cells(hash64(word)))
+
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("can not merge count-min sketches of different sizes")
+        for i in range(len(self.table)):
+            self.table[i] += other.table[i]
+        self.total += other.total
+
+
+# The Space-Saving algorithm of Metwally, Agrawal and El Abbadi
+# The counters are grouped by count (a "stream summary"), so that the smallest one is found without searching.
+class SpaceSaving:
+
+    def __init__(self, capacity = 200):
+        self.capacity = capacity
+        # word -> estimated count
+        self.counts = {}
+        # word -> how much its count may be too high
+        self.errors = {}
+        # count -> the words with that count, as a dictionary used as an ordered set
+        self.buckets = {}
+        self.min_count = 0
+        self.total = 0
+
+    def add(self, word, count = 1):
+        self.total += count
+        if word in self.counts:
+            self.move(word, self.counts[word] + count)
+        elif len(self.counts) < self.capacity:
+            self.counts[word] = 0
+            self.errors[word] = 0
+            self.move(word, count)
+        else:
+            # replace the word with the smallest count, which the new word inherits as its error
+            bucket = self.buckets[self.min_count]
+            evicted = next(iter(bucket))
+            inherited = self.counts.pop(evicted)
+            del self.errors[evicted]
+            del bucket[evicted]
+            if len(bucket) == 0:
+                del self.buckets[inherited]
+            self.counts[word] = 0
+            self.errors[word] = inherited
+            self.move(word, inherited + count)
+
+    def move(self, word, count):
+        old = self.counts[word]
+        if old in self.buckets:
+            bucket = self.buckets[old]
+            bucket.pop(word, None)
+            if len(bucket) == 0:
+                del self.buckets[old]
+        self.counts[word] = count
+        self.buckets.setdefault(count, {})[word] = None
+        # the smallest count only has to be searched for when its bucket was emptied
+        if count < self.min_count or self.min_count not in self.buckets:
+            self.min_count = min(self.buckets)
+
+    # the n words with the highest estimated counts, as (word, count) tuples
+    # among equal counts, the words that have been kept the longest come first
+    def top(self, n):
+        order = {word: i for i, word in enumerate(self.counts)}
+        return sorted(self.counts.items(), key = lambda word_count: (-word_count[1], order[word_count[0]]))[:n]
+
+    # the merged summary estimates the counts of the two streams together, with the same guarantees
+    def merge(self, other):
+        counts = {}
+        errors = {}
+        # a word that a full summary does not keep may have been used up to its smallest count times
+        self_floor = self.min_count if len(self.counts) >= self.capacity else 0
+        other_floor = other.min_count if len(other.counts) >= other.capacity else 0
+        for word in list(self.counts) + [word for word in other.counts if word not in self.counts]:
+            counts[word] = self.counts.get(word, self_floor) + other.counts.get(word, other_floor)
+            errors[word] = self.errors.get(word, self_floor) + other.errors.get(word, other_floor)
+        kept = sorted(counts, key = lambda word: -counts[word])[:self.capacity]
+        total = self.total + other.total
+        self.__init__(self.capacity)
+        self.total = total
+        for word in kept:
+            self.counts[word] = 0
+            self.errors[word] = errors[word]
+            self.move(word, counts[word])
+
+
+class HyperLogLog:
+
+    def __init__(self, precision = 10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, word, h = None):
+        if h is None:
+            h = hash64(word)
+        index = h >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rest = h & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        # few distinct words: linear counting is more accurate
+        if estimate <= 2.5 * m and zeros > 0:
+            return m * math.log(m / zeros)
+        return estimate
+
+    def merge(self, other):
+        if self.precision != other.precision:
+            raise ValueError("can not merge hyperloglogs of different precision")
+        for i, register in enumerate(other.registers):
+            if register > self.registers[i]:
+                self.registers[i] = register
+
+
+# the word counts of one member, in fixed memory
+class WordSketch:
+
+    def __init__(self, width = 272, depth = 4, capacity = 200, precision = 10):
+        self.counts = CountMinSketch(width, depth)
+        self.top_words = SpaceSaving(capacity)
+        self.distinct = HyperLogLog(precision)
+
+    def add(self, word):
+        h = hash64(word)
+        self.counts.add(word, 1, h)
+        self.top_words.add(word)
+        self.distinct.add(word, h)
+
+    # estimated number of times word was added
+    def count(self, word):
+        return self.counts.count(word)
+
+    # the n most common words, as (word, estimated count) tuples
+    def top(self, n):
+        return self.top_words.top(n)
+
+    # estimated number of distinct words
+    def distinct_count(self):
+        return int(round(self.distinct.count()))
+
+    def total(self):
+        return self.counts.total
+
+    def merge(self, other):
+        self.counts.merge(other.counts)
+        self.top_words.merge(other.top_words)
+        self.distinct.merge(other.distinct)
+
+
+# Quantiles of a stream of positive values (like reply times in seconds) in bounded memory, after DDSketch
+# (Masson, Rim and Lee). A value x is counted in bucket ceil(log(x) / log(gamma)), gamma = (1 + a) / (1 - a),
+# and every quantile is returned with a relative error of at most a (the default 1%).
+# The number of buckets only grows with the logarithm of the range of the values: reply times from a second
+# to a year need less than a thousand. Values below min_value are counted together as zero.
+class QuantileSketch:
+
+    zero_key = -2**62
+
+    def __init__(self, relative_accuracy = 0.01, min_value = 1.0):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        # bucket key -> count
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def key(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, value, count = 1):
+        if value < self.min_value:
+            self.zero_count += count
+        else:
+            k = self.key(value)
+            self.buckets[k] = self.buckets.get(k, 0) + count
+        self.count += count
+
+    # add values whose bucket keys are already computed (for many values at once, with numpy), with their counts
+    # values below min_value have the key zero_key
+    def add_keys(self, keys, counts):
+        for k, count in zip(keys, counts):
+            if k == self.zero_key:
+                self.zero_count += count
+            else:
+                self.buckets[k] = self.buckets.get(k, 0) + count
+            self.count += count
+
+    # the value at quantile q (between 0 and 1), or None if nothing was added
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if rank < seen:
+                # the middle of the bucket, in the sense that both of its ends are at most a relative error away
+                return 2 * self.gamma ** k / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def merge(self, other):
+        if self.gamma != other.gamma or self.min_value != other.min_value:
+            raise ValueError("can not merge quantile sketches with different accuracy")
+        for k, count in other.buckets.items():
+            self.buckets[k] = self.buckets.get(k, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
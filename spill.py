@@ -0,0 +1,78 @@
+# Partial aggregates spilled to disk in fixed-size columnar partitions, and read back when they are merged
+# Used by the out-of-core mode of analyze_messenger_v3_json.py (out_of_core_analysis).
+
+# Rows are appended to a table one at a time, into a typed array per column (a list for strings), so a row takes
+# a few bytes and not a tuple of python objects. When a table has partition_rows rows, they are written to
+# <directory>/<table>-<number>.npz (see columnar_export.write_npz) and the buffers are emptied, so the memory used
+# by a table never grows past one partition. The partitions are read back in the order they were written,
+# one at a time (read_partitions), or all at once as one set of columns (read_table).
+
+import os
+from array import array
+
+import columnar_export
+
+default_partition_rows = 1 << 20
+
+
+def partition_filename(directory, table, number):
+    return os.path.join(directory, "%s-%05d.npz" % (table, number))
+
+
+class PartitionWriter:
+
+    # columns is a list of (name, typecode) pairs, where the typecode is an array typecode like "q", or "str" for strings
+    def __init__(self, directory, table, columns, partition_rows = default_partition_rows):
+        self.directory = directory
+        self.table = table
+        self.columns = columns
+        self.partition_rows = partition_rows
+        self.partitions = 0
+        self.rows = 0
+        self.empty_buffers()
+        os.makedirs(directory, exist_ok = True)
+
+    def empty_buffers(self):
+        self.buffers = [[] if typecode == "str" else array(typecode) for name, typecode in self.columns]
+
+    def append(self, *row):
+        for buffer, value in zip(self.buffers, row):
+            buffer.append(value)
+        self.rows += 1
+        if self.rows >= self.partition_rows:
+            self.flush()
+
+    # write the rows in the buffers as a partition, even if it is not full
+    def flush(self):
+        import numpy as np
+        if self.rows == 0:
+            return
+        columns = {}
+        for (name, typecode), buffer in zip(self.columns, self.buffers):
+            columns[name] = buffer if typecode == "str" else np.frombuffer(buffer, dtype=np.dtype(typecode))
+        columnar_export.write_npz(columns, partition_filename(self.directory, self.table, self.partitions))
+        self.partitions += 1
+        self.rows = 0
+        self.empty_buffers()
+
+
+# the partitions of a table in the order they were written, as dictionaries of columns
+def read_partitions(directory, table):
+    number = 0
+    while os.path.exists(partition_filename(directory, table, number)):
+        yield columnar_export.read_npz_table(partition_filename(directory, table, number))
+        number += 1
+
+
+# all partitions of a table as one dictionary of columns, with the rows in the order they were written
+# columns is the list of (name, typecode) pairs the table was written with, so that a table without rows has them too
+def read_table(directory, table, columns):
+    import numpy as np
+    partitions = list(read_partitions(directory, table))
+    result = {}
+    for name, typecode in columns:
+        if typecode == "str":
+            result[name] = [value for partition in partitions for value in partition[name]]
+        else:
+            result[name] = np.concatenate([np.zeros(0, dtype=np.dtype(typecode))] + [partition[name] for partition in partitions])
+    return result
@@ -0,0 +1,135 @@
+# A histogram of the messages and words of every member in every thread, in quarter hours (or minutes) of UTC time,
+# from which the daily, weekly, monthly and yearly counts are derived for any timezone and hour the day starts at
+# Used by analyze_messenger_v3_json.py (build_time_histogram, rebinned_time_data).
+
+# The dates of the messages come from datetime.fromtimestamp, so they are in the timezone of the machine that ran
+# the analysis, and a day always starts at midnight. The histogram is in UTC instead, and only keeps the slots that
+# have messages: one row per (thread, member, slot), sorted by thread, member and slot. It is built once from the
+# message columns and can be saved, and rebinning it is a vectorized shift of the slots by the UTC offset
+# and a bincount, without looking at the messages again.
+# The UTC offset of a named timezone changes with daylight saving time, so it is looked up once for every distinct
+# quarter hour that has messages. Timezones only change their offset at quarter hours, so this is exact.
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone as fixed_timezone
+
+import numpy as np
+
+seconds_per_day = 24 * 60 * 60
+quarter_hour = 15 * 60
+
+# seconds per slot
+default_resolution = quarter_hour
+
+intervals = ["daily", "weekly", "monthly", "yearly"]
+
+
+# days since epoch -> the number of the period they are in, counted from the epoch
+def period_numbers(days, interval):
+    if interval == "daily":
+        return days
+    if interval == "weekly":
+        # weeks start on monday, and 1970-01-01 was a thursday
+        return (days + 3) // 7
+    months = days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    if interval == "monthly":
+        return months
+    return months // 12
+
+
+# period numbers -> the first day of each period, as numpy dates
+def period_dates(periods, interval):
+    if interval == "daily":
+        return periods.astype("datetime64[D]")
+    if interval == "weekly":
+        return (periods * 7 - 3).astype("datetime64[D]")
+    if interval == "monthly":
+        return periods.astype("datetime64[M]").astype("datetime64[D]")
+    return periods.astype("datetime64[Y]").astype("datetime64[D]")
+
+
+# timezone is None for the timezone of this machine, a number of hours east of UTC,
+# the name of a timezone like "Europe/Stockholm", or a tzinfo
+def tzinfo(timezone):
+    if isinstance(timezone, (int, float)):
+        return fixed_timezone(timedelta(hours = timezone))
+    if isinstance(timezone, str):
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(timezone)
+    return timezone
+
+
+# the UTC offset in seconds at every time in seconds (since epoch, in UTC)
+def utc_offsets(seconds, timezone):
+    zone = tzinfo(timezone)
+    if isinstance(zone, fixed_timezone):
+        return np.full(len(seconds), int(zone.utcoffset(None).total_seconds()), dtype=np.int64)
+    quarters, quarter = np.unique(seconds // quarter_hour, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(q * quarter_hour, fixed_timezone.utc).astimezone(zone).utcoffset().total_seconds()
+                        for q in quarters.tolist()], dtype=np.int64)
+    return offsets[quarter]
+
+
+class TimeHistogram:
+
+    # the rows of the histogram: pair is thread index * member_count + member id, slot is the number of the slot
+    # since epoch in UTC, and messages and words are the counts of the pair in the slot
+    def __init__(self, pair, slot, messages, words, member_count, resolution = default_resolution):
+        self.pair = pair
+        self.slot = slot
+        self.messages = messages
+        self.words = words
+        self.member_count = member_count
+        self.resolution = resolution
+
+    def __len__(self):
+        return len(self.pair)
+
+    def save(self, filename):
+        np.savez_compressed(filename, pair=self.pair, slot=self.slot, messages=self.messages, words=self.words,
+                            member_count=self.member_count, resolution=self.resolution)
+
+    # the counts per period in timezone, where the days start day_start hours after midnight
+    # (with day_start = 2, a message at 01:30 counts on the day before)
+    # returns the rows with a count, as columns "thread", "member", "date" (the first day of the period, days since epoch),
+    # "messages" and "words", sorted by thread, member and date
+    def rebin(self, interval = "daily", timezone = None, day_start = 0):
+        if interval not in intervals:
+            raise ValueError("interval must be one of " + ", ".join(intervals))
+        seconds = self.slot * self.resolution
+        local = seconds + utc_offsets(seconds, timezone) - int(day_start * 60 * 60)
+        periods = period_numbers(local // seconds_per_day, interval)
+
+        first = periods.min() if len(periods) > 0 else 0
+        period_count = int(periods.max() - first) + 1 if len(periods) > 0 else 0
+        keys, row = np.unique(self.pair * period_count + (periods - first), return_inverse=True)
+        messages = np.bincount(row, weights=self.messages, minlength=len(keys)).astype(np.int64)
+        words = np.bincount(row, weights=self.words, minlength=len(keys)).astype(np.int64)
+        pairs = keys // period_count if period_count > 0 else keys
+        dates = period_dates(keys % period_count + first if period_count > 0 else keys, interval)
+        return {"thread": (pairs // self.member_count).astype(np.int32),
+                "member": (pairs % self.member_count).astype(np.int32),
+                "date": dates.astype(np.int64).astype(np.int32),
+                "messages": messages,
+                "words": words}
+
+
+# the histogram of the message columns (see build_message_columns) with slots of resolution seconds
+def build(thread, sender, timestamp, words, member_count, resolution = default_resolution):
+    if seconds_per_day % resolution != 0:
+        raise ValueError("the resolution must divide a day")
+    pair = thread.astype(np.int64) * member_count + sender
+    slot = timestamp // resolution
+    first = slot.min() if len(slot) > 0 else 0
+    slot_count = int(slot.max() - first) + 1 if len(slot) > 0 else 1
+    keys, row = np.unique(pair * slot_count + (slot - first), return_inverse=True)
+    return TimeHistogram(keys // slot_count, keys % slot_count + first,
+                         np.bincount(row, minlength=len(keys)).astype(np.int64),
+                         np.bincount(row, weights=words, minlength=len(keys)).astype(np.int64),
+                         member_count, resolution)
+
+
+def load(filename):
+    with np.load(filename) as data:
+        return TimeHistogram(data["pair"], data["slot"], data["messages"], data["words"], int(data["member_count"]), int(data["resolution"]))
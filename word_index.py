@@ -0,0 +1,191 @@
+# Inverted index over the words in all messages, for finding messages without scanning them all
+# It is built by calculate_meta_data in analyze_messenger_v3_json.py, in the same pass that counts the words
+
+# Every message gets a document number: the messages of the thread added first are numbered 0, 1, 2, ...,
+# and the messages of the next thread continue where those ended. thread_starts holds the first number of each thread.
+# These are the same numbers as the positions in message_columns, when both are built for the same threads.
+
+# Every word of every message also gets a token number: the words of a message are numbered consecutively,
+# and one number is left unused after each message, so that a phrase can never continue into the next message.
+# document_tokens holds the first token number of each document.
+
+# The posting list of a term is the sorted list of token numbers of its occurrences.
+# It is stored as the differences between consecutive numbers, each encoded as a varint (7 bits per byte),
+# and decoded with numpy a whole posting list at a time.
+# A phrase "a b c" occurs at the tokens t where a is at t, b at t + 1 and c at t + 2, which is an intersection of arrays.
+
+import struct
+from array import array
+
+magic = b"MWIX2\n"
+
+
+def encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+# the numbers in a bytes object of varints, as a numpy array
+def decode_varints(data):
+    import numpy as np
+    data = np.frombuffer(data, dtype=np.uint8)
+    last = data < 0x80
+    # the common case, where every difference fits in one byte
+    if last.all():
+        return data.astype(np.int64)
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # the number each byte belongs to, and how far to shift its 7 bits
+    number = np.cumsum(last) - last
+    shift = (np.arange(len(data)) - starts[number]) * 7
+    return np.add.reduceat((data & 0x7f).astype(np.int64) << shift, starts)
+
+
+# the terms of a text, normalized the same way as the word counts in calculate_meta_data
+def terms(text):
+    return [word.lower().strip() for word in text.split()]
+
+
+class WordIndex:
+
+    def __init__(self):
+        # term -> bytearray with the varint encoded posting list
+        self.postings = {}
+        # term -> last token number added to its posting list
+        self.last_token = {}
+        # first document number of every thread, in the order they were added
+        self.thread_starts = []
+        self.document_count = 0
+        # first token number of every document, and the next unused token number
+        self.document_tokens = array("q")
+        self.token_count = 0
+
+    # reserve document numbers for the messages of a thread, and return the first one
+    def add_thread(self, message_count):
+        start = self.document_count
+        self.thread_starts.append(start)
+        self.document_count += message_count
+        return start
+
+    # documents must be added in order; documents that are skipped have no words
+    def add(self, document, words):
+        while len(self.document_tokens) <= document:
+            self.document_tokens.append(self.token_count)
+        token = self.token_count
+        for term in words:
+            last = self.last_token.get(term)
+            if last is None:
+                posting = self.postings[term] = bytearray()
+                encode_varint(token, posting)
+            else:
+                encode_varint(token - last, self.postings[term])
+            self.last_token[term] = token
+            token += 1
+        # the unused token that ends the document
+        self.token_count = token + 1
+
+    # the sorted token numbers of the occurrences of term, as a numpy array
+    def tokens(self, term):
+        import numpy as np
+        posting = self.postings.get(term)
+        if posting is None:
+            return np.empty(0, dtype=np.int64)
+        return np.cumsum(decode_varints(posting))
+
+    # the document numbers of sorted token numbers, without repetitions
+    def token_documents(self, tokens):
+        import numpy as np
+        document_tokens = np.frombuffer(self.document_tokens, dtype=np.int64)
+        documents = np.searchsorted(document_tokens, tokens, side="right") - 1
+        if len(documents) == 0:
+            return documents
+        return documents[np.concatenate(([True], documents[1:] != documents[:-1]))]
+
+    # the sorted document numbers of the messages containing term, as a numpy array
+    def documents(self, term):
+        return self.token_documents(self.tokens(term))
+
+    # the sorted document numbers of the messages containing all of the terms
+    def documents_with_all(self, words):
+        import numpy as np
+        if len(words) == 0:
+            return np.empty(0, dtype=np.int64)
+        # start with the rarest term, so that the candidate set is as small as possible
+        words = sorted(set(words), key=lambda term: len(self.postings.get(term, b"")))
+        documents = self.documents(words[0])
+        for term in words[1:]:
+            if len(documents) == 0:
+                break
+            documents = np.intersect1d(documents, self.documents(term), assume_unique=True)
+        return documents
+
+    # the sorted document numbers of the messages containing the words in phrase, in order and next to each other
+    def documents_with_phrase(self, phrase):
+        import numpy as np
+        if len(phrase) == 0:
+            return np.empty(0, dtype=np.int64)
+        # the token numbers where the phrase would start, for each word of the phrase, rarest first
+        offsets = sorted(range(len(phrase)), key=lambda i: len(self.postings.get(phrase[i], b"")))
+        starts = self.tokens(phrase[offsets[0]]) - offsets[0]
+        for i in offsets[1:]:
+            if len(starts) == 0:
+                break
+            starts = np.intersect1d(starts, self.tokens(phrase[i]) - i, assume_unique=True)
+        return self.token_documents(starts)
+
+    # (thread number, message index) of document numbers, as two numpy arrays
+    def locations(self, documents):
+        import numpy as np
+        thread_starts = np.array(self.thread_starts, dtype=np.int64)
+        threads = np.searchsorted(thread_starts, documents, side="right") - 1
+        return threads, documents - thread_starts[threads]
+
+    # (thread number, message index) of a document number
+    def location(self, document):
+        threads, messages = self.locations([document])
+        return int(threads[0]), int(messages[0])
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            f.write(magic)
+            f.write(struct.pack("<qq", self.document_count, len(self.thread_starts)))
+            f.write(struct.pack("<%dq" % len(self.thread_starts), *self.thread_starts))
+            f.write(struct.pack("<qq", self.token_count, len(self.document_tokens)))
+            f.write(self.document_tokens.tobytes())
+            f.write(struct.pack("<q", len(self.postings)))
+            for term, posting in self.postings.items():
+                encoded = term.encode("utf-8")
+                f.write(struct.pack("<ii", len(encoded), len(posting)))
+                f.write(encoded)
+                f.write(posting)
+
+    # a loaded index can only be queried, not added to
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with open(filename, "rb") as f:
+            data = f.read()
+        if not data.startswith(magic):
+            raise ValueError(filename + " is not a word index, or was saved by an older version")
+        position = len(magic)
+        index.document_count, thread_count = struct.unpack_from("<qq", data, position)
+        position += 16
+        index.thread_starts = list(struct.unpack_from("<%dq" % thread_count, data, position))
+        position += 8 * thread_count
+        index.token_count, document_count = struct.unpack_from("<qq", data, position)
+        position += 16
+        index.document_tokens = array("q")
+        index.document_tokens.frombytes(data[position:position + 8 * document_count])
+        position += 8 * document_count
+        (term_count,) = struct.unpack_from("<q", data, position)
+        position += 8
+        for _ in range(term_count):
+            term_length, posting_length = struct.unpack_from("<ii", data, position)
+            position += 8
+            term = data[position:position + term_length].decode("utf-8")
+            position += term_length
+            index.postings[term] = data[position:position + posting_length]
+            position += posting_length
+        return index